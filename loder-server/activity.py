@@ -0,0 +1,311 @@
+"""Write-behind ingestion for activity_logs.
+
+Heartbeats enqueue activity events; they are written in one transaction per
+batch and shard, either when ACTIVITY_BATCH_SIZE events are pending or every
+ACTIVITY_FLUSH_INTERVAL seconds.
+
+In 'session' storage mode consecutive heartbeats for the same app are
+coalesced into one row: duration_seconds and ended_at grow while the app
+stays the same, and a new row starts when the app changes, the gap exceeds
+OFFLINE_THRESHOLD_SECONDS or the hour changes. Sessions never cross an hour
+boundary, so hourly and daily stats buckets are the same as with raw rows.
+
+Times (logged_at, ended_at) are UTC epoch seconds.
+
+Every flush also adds the batch to the hourly/daily rollups in the same
+transaction (see rollups.py).
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from config import (
+    ACTIVITY_BATCH_SIZE, ACTIVITY_FLUSH_INTERVAL, ACTIVITY_STORAGE_MODE, OFFLINE_THRESHOLD_SECONDS
+)
+from database import db_connection, each_shard, room_pool
+import metrics
+import rollups
+import stats
+from utils import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Seconds heartbeats of a deleted user are dropped for (see forget_user); a
+# roster cached before the deletion lasts PRESENCE_ROSTER_TTL at most
+FORGOTTEN_USER_SECONDS = 60
+
+UPDATE_SESSION_SQL = 'UPDATE activity_logs SET duration_seconds = ?, ended_at = ? WHERE id = ?'
+
+# A session of the previous hour can still be updated by a pending flush for
+# up to a flush interval after the hour ends; compaction leaves it alone that long
+COMPACT_GRACE_SECONDS = ACTIVITY_FLUSH_INTERVAL + 60
+
+
+class Session:
+    __slots__ = ('row_id', 'room_id', 'user_id', 'app_name', 'started_at', 'ended_at', 'duration_seconds')
+
+    def __init__(self, room_id, user_id, app_name, started_at, duration_seconds):
+        self.row_id = None
+        self.room_id = room_id
+        self.user_id = user_id
+        self.app_name = app_name
+        self.started_at = started_at
+        self.ended_at = started_at
+        self.duration_seconds = duration_seconds
+
+    def accepts(self, app_name, at):
+        """Whether a heartbeat for app_name at `at` extends this session."""
+        return (
+            app_name == self.app_name
+            and rollups.hour_bucket(at) == rollups.hour_bucket(self.started_at)
+            and at - self.ended_at <= OFFLINE_THRESHOLD_SECONDS
+        )
+
+
+class _ShardBatch:
+    """Changes of one flush that go to the same shard."""
+    __slots__ = ('sessions', 'inserts', 'updates', 'deltas')
+
+    def __init__(self):
+        self.sessions = []
+        self.inserts = []   # (session, (duration_seconds, ended_at))
+        self.updates = []   # (duration_seconds, ended_at, row_id)
+        self.deltas = {}    # rollup key -> seconds
+
+    @staticmethod
+    def get(batches, room_id):
+        shard_pool = room_pool(room_id)
+        batch = batches.get(shard_pool)
+        if batch is None:
+            batch = batches[shard_pool] = _ShardBatch()
+        return batch
+
+
+class ActivityBuffer:
+    def __init__(self, flush_interval=ACTIVITY_FLUSH_INTERVAL, batch_size=ACTIVITY_BATCH_SIZE,
+                 mode=ACTIVITY_STORAGE_MODE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.coalesce = mode == 'session'
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._open = {}     # (room_id, user_id) -> Session being extended
+        self._dirty = {}    # id(session) -> session with unwritten changes
+        self._pending = 0   # events since the last flush
+        self._rollup = defaultdict(int)  # (room_id, user_id, app_name, hour bucket) -> seconds
+        self._forgotten = {}  # deleted user_id -> monotonic time until which events are dropped
+        self._flusher = PeriodicTask('activity-flush', flush_interval, self.flush)
+
+    def __len__(self):
+        return self._pending
+
+    def add(self, room_id, user_id, app_name, duration_seconds, logged_at):
+        self.add_rooms([room_id], user_id, app_name, duration_seconds, logged_at)
+
+    def add_rooms(self, room_ids, user_id, app_name, duration_seconds, logged_at):
+        """Queue the same event for each of room_ids."""
+        with self._lock:
+            if self._forgotten and self._is_forgotten(user_id):
+                return
+            for room_id in room_ids:
+                key = (room_id, user_id)
+                session = self._open.get(key) if self.coalesce else None
+                if session and session.accepts(app_name, logged_at):
+                    session.duration_seconds += duration_seconds
+                    session.ended_at = logged_at
+                else:
+                    session = Session(room_id, user_id, app_name, logged_at, duration_seconds)
+                    if self.coalesce:
+                        self._open[key] = session
+                self._dirty[id(session)] = session
+                self._rollup[(room_id, user_id, app_name, rollups.hour_bucket(logged_at))] += duration_seconds
+                self._pending += 1
+            pending = self._pending
+
+        if self.flush_interval <= 0:
+            self.flush()
+        elif pending >= self.batch_size:
+            self._flusher.trigger()
+        else:
+            self._flusher.ensure_started()
+
+    def _is_forgotten(self, user_id):
+        """Called with the lock held."""
+        now = time.monotonic()
+        for forgotten, until in list(self._forgotten.items()):
+            if until <= now:
+                del self._forgotten[forgotten]
+        return user_id in self._forgotten
+
+    def forget_user(self, user_id, anon_id):
+        """Move a deleted user's queued activity to anon_id, as
+        repository.forget_member does for written rows, and drop their
+        heartbeats for FORGOTTEN_USER_SECONDS. Call it before forget_member,
+        so nothing under user_id is written after the shards are anonymized."""
+        # Waits for a flush in progress, whose batch still has user_id
+        with self._flush_lock, self._lock:
+            self._forgotten[user_id] = time.monotonic() + FORGOTTEN_USER_SECONDS
+            for key in [key for key in self._open if key[1] == user_id]:
+                self._open[(key[0], anon_id)] = self._open.pop(key)
+            for session in self._dirty.values():
+                if session.user_id == user_id:
+                    session.user_id = anon_id
+            for session in self._open.values():
+                if session.user_id == user_id:
+                    session.user_id = anon_id
+            for key in [key for key in self._rollup if key[1] == user_id]:
+                room_id, _, app_name, bucket = key
+                self._rollup[(room_id, anon_id, app_name, bucket)] += self._rollup.pop(key)
+
+    def flush(self):
+        """Write all queued changes, in a single transaction per shard."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                dirty, self._dirty = self._dirty, {}
+                pending, self._pending = self._pending, 0
+                deltas, self._rollup = self._rollup, defaultdict(int)
+                batches = {}   # shard pool -> _ShardBatch
+                for session in dirty.values():
+                    batch = _ShardBatch.get(batches, session.room_id)
+                    batch.sessions.append(session)
+                    values = (session.duration_seconds, session.ended_at)
+                    if session.row_id is None:
+                        batch.inserts.append((session, values))
+                    else:
+                        batch.updates.append(values + (session.row_id,))
+                for key, seconds in deltas.items():
+                    _ShardBatch.get(batches, key[0]).deltas[key] = seconds
+
+            error = None
+            for shard_pool, batch in batches.items():
+                try:
+                    with db_connection(shard_pool) as conn:
+                        self._write(conn.cursor(), batch)
+                        conn.commit()
+                except Exception as e:
+                    for session, _ in batch.inserts:
+                        session.row_id = None
+                    with self._lock:
+                        for session in batch.sessions:
+                            self._dirty.setdefault(id(session), session)
+                        self._pending += len(batch.sessions)
+                        for key, seconds in batch.deltas.items():
+                            self._rollup[key] += seconds
+                    logger.exception('Failed to flush %d activity sessions', len(batch.sessions))
+                    error = e
+                    continue
+
+                for room_id in {key[0] for key in batch.deltas}:
+                    stats.cache.invalidate(room_id)
+
+            if error:
+                raise error
+            self._close_idle_sessions()
+            return pending
+
+    def _write(self, cursor, batch):
+        if self.coalesce:
+            # Row ids are needed to extend these rows on later flushes
+            for session, (duration_seconds, ended_at) in batch.inserts:
+                cursor.execute('''
+                    INSERT INTO activity_logs
+                        (room_id, user_id, app_name, duration_seconds, logged_at, ended_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (session.room_id, session.user_id, session.app_name,
+                      duration_seconds, session.started_at, ended_at))
+                session.row_id = cursor.lastrowid
+        else:
+            cursor.executemany('''
+                INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(s.room_id, s.user_id, s.app_name, duration_seconds, s.started_at)
+                  for s, (duration_seconds, _) in batch.inserts])
+        cursor.executemany(UPDATE_SESSION_SQL, batch.updates)
+        rollups.add(cursor, batch.deltas)
+
+    def _close_idle_sessions(self):
+        now = int(time.time())
+        with self._lock:
+            for key, session in list(self._open.items()):
+                idle = now - session.ended_at > OFFLINE_THRESHOLD_SECONDS
+                new_hour = rollups.hour_bucket(now) != rollups.hour_bucket(session.started_at)
+                if (idle or new_hour) and id(session) not in self._dirty:
+                    del self._open[key]
+
+
+def compact_activity_logs(conn=None):
+    """Rewrite existing activity_logs rows into sessions.
+
+    Rows older than the current hour (or the previous one, for
+    COMPACT_GRACE_SECONDS after it ends) are merged using the same rules as
+    the live 'session' mode, one (room, user) at a time. Reads and rewrites
+    happen in one BEGIN IMMEDIATE transaction per shard, so no flush can
+    extend a row between them. Safe to run repeatedly and while the server
+    is running. Returns (rows_before, rows_after); without `conn`, summed
+    over every shard.
+    """
+    if conn is None:
+        counts = [compact_activity_logs(shard_conn) for shard_conn in each_shard()]
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    cutoff = rollups.hour_bucket(int(time.time()) - COMPACT_GRACE_SECONDS)
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        rows_before, rows_after = _compact(cursor, cutoff)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return rows_before, rows_after
+
+
+def _compact(cursor, cutoff):
+    cursor.execute('SELECT COUNT(*) FROM activity_logs')
+    rows_before = cursor.fetchone()[0]
+
+    cursor.execute('SELECT DISTINCT room_id, user_id FROM activity_logs')
+    pairs = cursor.fetchall()
+    for room_id, user_id in pairs:
+        cursor.execute('''
+            SELECT id, app_name, duration_seconds, logged_at, ended_at
+            FROM activity_logs
+            WHERE room_id = ? AND user_id = ? AND logged_at < ?
+            ORDER BY logged_at, id
+        ''', (room_id, user_id, cutoff))
+
+        updates = []
+        deletes = []
+        session = None
+        for row_id, app_name, duration_seconds, logged_at, ended_at in cursor.fetchall():
+            ended_at = ended_at or logged_at
+            if session and session.accepts(app_name, logged_at):
+                session.duration_seconds += duration_seconds or 0
+                session.ended_at = max(session.ended_at, ended_at)
+                deletes.append((row_id,))
+                continue
+            if session:
+                updates.append((session.duration_seconds, session.ended_at, session.row_id))
+            session = Session(room_id, user_id, app_name, logged_at, duration_seconds or 0)
+            session.row_id = row_id
+            session.ended_at = ended_at
+        if session:
+            updates.append((session.duration_seconds, session.ended_at, session.row_id))
+
+        if deletes:
+            cursor.executemany(UPDATE_SESSION_SQL, updates)
+            cursor.executemany('DELETE FROM activity_logs WHERE id = ?', deletes)
+
+    cursor.execute('SELECT COUNT(*) FROM activity_logs')
+    rows_after = cursor.fetchone()[0]
+    return rows_before, rows_after
+
+
+buffer = ActivityBuffer()
+atexit.register(buffer.flush)
+metrics.registry.gauge('loder_activity_pending', 'Activity events waiting to be written.',
+                       lambda: len(buffer))
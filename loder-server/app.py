@@ -1,12 +1,27 @@
 import os
-from flask import Flask, render_template_string
+import click
+from flask import Flask, Response, jsonify, render_template_string, request
 from flask_cors import CORS
-from database import init_db, get_db
-from config import AVATARS_DIR
+from database import init_db, init_app, get_db, get_room_db, each_shard
+from config import AVATARS_DIR, METRICS_ENABLED
 from routes.users import users_bp
 from routes.rooms import rooms_bp
 from routes.auth import auth_bp
-from datetime import datetime, timedelta
+from routes.avatars import avatars_bp
+from routes.heartbeat import heartbeat_bp
+from presence import store as presence
+import avatars
+import database
+import google_avatars
+import indexes
+import metrics
+import repository
+import retention
+import sessions
+import sqltrace
+import stats
+from sessions import SessionError
+from datetime import datetime
 
 app = Flask(__name__)
 CORS(app)
@@ -16,15 +31,112 @@ os.makedirs(AVATARS_DIR, exist_ok=True)
 
 # Initialize database
 init_db()
+indexes.report()
+init_app(app)
+metrics.init_app(app)
+sqltrace.tracer.check_timed()
+retention.task.ensure_started()
 
 # Register blueprints
 app.register_blueprint(users_bp, url_prefix='/api/v1/users')
 app.register_blueprint(rooms_bp, url_prefix='/api/v1/rooms')
 app.register_blueprint(auth_bp, url_prefix='/api/v1/auth')
+app.register_blueprint(avatars_bp, url_prefix='/api/v1/avatars')
+app.register_blueprint(heartbeat_bp, url_prefix='/api/v1')
+
+@app.errorhandler(SessionError)
+def session_error(e):
+    return jsonify({'error': e.message}), e.status
+
+@app.cli.command('compact-activity')
+def compact_activity_command():
+    """Merge consecutive activity_logs rows into sessions."""
+    from activity import compact_activity_logs
+    rows_before, rows_after = compact_activity_logs()
+    click.echo(f'activity_logs: {rows_before} -> {rows_after} rows')
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute activity_hourly and activity_daily from activity_logs."""
+    import rollups
+    for conn in each_shard():
+        rollups.rebuild(conn)
+    click.echo('Rollups rebuilt')
+
+@app.cli.command('apply-retention')
+@click.option('--vacuum', is_flag=True, help='Run a full VACUUM afterwards (also enables incremental vacuum on older databases).')
+def apply_retention_command(vacuum):
+    """Archive old activity_logs rows and drop old hourly rollups."""
+    summary = retention.apply()
+    click.echo(f"{summary['archived']} activity rows archived, "
+               f"{summary['hourlyDeleted']} hourly rollups deleted")
+    if vacuum:
+        for target in dict.fromkeys(database.shard_pools + [database.pool]):
+            with database.db_connection(target) as conn:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+        click.echo('Database vacuumed')
+    elif summary['pagesReleased'] is None:
+        click.echo('auto_vacuum is not INCREMENTAL; run with --vacuum once to enable it')
+
+@app.cli.command('rebalance-shards')
+def rebalance_shards_command():
+    """Move rooms into the shard files ROOM_SHARDS assigns them (server stopped)."""
+    import shards
+    moved = shards.rebalance(log=click.echo)
+    click.echo(f'{moved} rooms moved')
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Report hot queries without a usable index and indexes no hot query uses."""
+    problems = 0
+    for path, findings in indexes.check_all().items():
+        for finding in findings:
+            click.echo(f'{path}: {indexes.describe(finding)}')
+        problems += sum(map(indexes.is_problem, findings))
+    if problems:
+        raise SystemExit(1)
+    click.echo('No missing or unused indexes')
+
+@app.cli.command('process-avatars')
+def process_avatars_command():
+    """Convert avatars stored as original uploads or Google URLs into resized variants."""
+    conn = get_db()
+    converted = 0
+    for user_id, avatar_path in repository.users_with_avatars(conn):
+        if avatar_path.startswith('http'):
+            try:
+                if google_avatars.fetcher.fetch(user_id, avatar_path, avatar_path):
+                    converted += 1
+            except Exception as e:
+                click.echo(f'{user_id}: skipped ({e})')
+            continue
+        if avatars.parse_name(avatar_path):
+            continue
+        filepath = os.path.join(AVATARS_DIR, os.path.basename(avatar_path))
+        try:
+            with open(filepath, 'rb') as f:
+                new_path = avatars.store(f.read())
+        except (OSError, avatars.InvalidImage) as e:
+            click.echo(f'{user_id}: skipped ({e})')
+            continue
+        repository.set_avatar_path(conn, user_id, new_path)
+        conn.commit()
+        avatars.cache.forget_user(user_id)
+        avatars.remove(avatar_path)
+        converted += 1
+    click.echo(f'{converted} avatars converted')
 
 @app.route('/api/v1/health')
 def health():
-    return {'status': 'ok'}
+    return {'status': 'ok', 'statsCache': stats.cache.info(), 'avatarCache': avatars.cache.info()}
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint (see metrics.py)"""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 DEBUG_HTML = '''
 <!DOCTYPE html>
@@ -92,45 +204,41 @@ DEBUG_HTML = '''
 </html>
 '''
 
+@app.route('/debug/sql', methods=['GET', 'POST'])
+def debug_sql():
+    """Tracing state and the last slow statements; POST {"enabled": bool}
+    turns tracing on or off in this worker (see sqltrace.py). Admin only."""
+    sessions.require_admin()
+    if request.method == 'POST':
+        enabled = (request.get_json(silent=True) or {}).get('enabled')
+        if not isinstance(enabled, bool):
+            return jsonify({'error': 'enabled must be true or false'}), 400
+        sqltrace.tracer.set_enabled(enabled)
+    return jsonify(sqltrace.tracer.info())
+
 @app.route('/debug/<room_id>')
 def debug_room(room_id):
-    conn = get_db()
-    cursor = conn.cursor()
-
     # Check if room exists
-    cursor.execute('SELECT id FROM rooms WHERE id = ?', (room_id,))
-    if not cursor.fetchone():
-        conn.close()
+    if not repository.get_room(get_room_db(room_id), room_id):
         return f'Room {room_id} not found', 404
 
     # Get members
-    threshold = datetime.utcnow() - timedelta(seconds=15)
-    cursor.execute('''
-        SELECT u.id as user_id, u.avatar_path, rm.active_app, rm.last_seen
-        FROM room_members rm
-        JOIN users u ON rm.user_id = u.id
-        WHERE rm.room_id = ?
-    ''', (room_id,))
-
+    now = datetime.utcnow()
     members = []
-    for row in cursor.fetchall():
-        last_seen = datetime.fromisoformat(row['last_seen']) if row['last_seen'] else None
-        is_online = bool(last_seen and last_seen > threshold)
+    for member in presence.members(room_id):
         members.append({
-            'user_id': row['user_id'],
-            'avatar_path': row['avatar_path'],
-            'active_app': row['active_app'] if is_online else None,
-            'is_online': is_online,
-            'last_seen': row['last_seen']
+            'user_id': member.user_id,
+            'avatar_path': member.avatar_path,
+            'active_app': member.active_app if member.online else None,
+            'is_online': member.online,
+            'last_seen': member.last_seen_text()
         })
 
-    conn.close()
-
     return render_template_string(
         DEBUG_HTML,
         room_id=room_id,
         members=members,
-        now=datetime.utcnow().strftime('%H:%M:%S')
+        now=now.strftime('%H:%M:%S')
     )
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+"""ASGI entry point: serve the API from an asyncio event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Google sign-in and room event streams are handled natively on the loop:
+the OAuth calls go through an httpx.AsyncClient and each SSE connection is
+an AsyncSubscription, so neither holds a thread while it waits. Every other
+route runs the existing Flask app through a2wsgi's WSGIMiddleware on a pool
+of ASGI_THREADS threads. Like the gthread setup, run a single process:
+presence and event streams live in memory.
+
+Database access is not async: sqlite3 has no non-blocking API, and an async
+driver (aiosqlite) would only run the same calls on a thread of its own.
+The SQLite work of the native handlers instead runs on a second pool of
+ASGI_THREADS threads through run_blocking(), which keeps it off the loop.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+import activity
+import events
+import google_oauth
+import metrics
+import sessions
+from app import app as flask_app
+from config import ASGI_THREADS
+from database import db_connection
+from google_oauth import GoogleAuthError
+from presence import store as presence
+from routes.auth import sign_in
+from routes.rooms import EVENTS_KEEPALIVE_SECONDS
+from sessions import SessionError
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH = re.compile(r'^/api/v1/rooms/([^/]+)/events$')
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+# Every other route: the Flask app on its own pool, responses streamed as produced
+_flask = WSGIMiddleware(flask_app, workers=ASGI_THREADS)
+_http = None   # shared httpx.AsyncClient, see _http_client()
+
+
+async def run_blocking(func, *args):
+    """Run func on the worker pool and await its result. It runs in a copy of
+    the caller's context, so its SQL counts toward the current request."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(context.run, func, *args))
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin1')
+    return None
+
+
+def _response_headers(scope, content_type, extra=()):
+    headers = [(b'content-type', content_type)]
+    if _header(scope, b'origin'):
+        headers.append((b'access-control-allow-origin', b'*'))   # as flask-cors
+    headers.extend(extra)
+    return headers
+
+
+async def _send_json(scope, send, body, status=200):
+    payload = json.dumps(body).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': _response_headers(scope, b'application/json')})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+# Native handlers
+
+async def google_auth(scope, receive, send):
+    """Async version of routes.auth.google_auth."""
+    # The profiler samples threads, not coroutines
+    tracker = metrics.RequestTracker(profile=False)
+    status = 500
+    try:
+        status = await _google_auth(scope, receive, send)
+    finally:
+        tracker.finish('auth.google_auth', 'POST', status)
+
+
+async def _google_auth(scope, receive, send):
+    try:
+        data = json.loads(await _read_body(receive) or b'null')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not data:
+        await _send_json(scope, send, {'error': 'No data provided'}, 400)
+        return 400
+
+    try:
+        profile = await google_oauth.fetch_profile_async(data, _http_client())
+    except GoogleAuthError as e:
+        await _send_json(scope, send, {'error': e.message}, e.status)
+        return e.status
+
+    def upsert():
+        with db_connection() as conn:
+            return sign_in(conn, profile)
+
+    body, status = await run_blocking(upsert)
+    await _send_json(scope, send, body, status)
+    return status
+
+
+async def room_events(scope, receive, send, room_id):
+    """Async version of routes.rooms.room_events."""
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    token = sessions.bearer_token(_header(scope, b'authorization')) or query.get('token', [None])[0]
+    try:
+        user_id = sessions.resolve_user(token, query.get('userId', [None])[0])
+    except SessionError as e:
+        return await _send_json(scope, send, {'error': e.message}, e.status)
+    if not user_id:
+        return await _send_json(scope, send, {'error': 'userId is required'}, 400)
+    if not await run_blocking(presence.is_member, room_id, user_id):
+        return await _send_json(scope, send, {'error': 'Not a member of this room'}, 403)
+
+    subscription = events.bus.subscribe(room_id, loop=asyncio.get_running_loop())
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': _response_headers(
+            scope, b'text/event-stream; charset=utf-8',
+            [(b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')])})
+
+        version, members = await run_blocking(presence.snapshot, room_id)
+        await _send_event(send, events.format_sse('snapshot', {'members': members, 'version': version}, version))
+        while True:
+            waiter = asyncio.ensure_future(subscription.get(EVENTS_KEEPALIVE_SECONDS))
+            await asyncio.wait((waiter, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                return
+            event = waiter.result()
+            if subscription.overflowed:
+                # Dropped events; the client should reconnect for a fresh snapshot
+                await _send_event(send, events.format_sse('resync', {}))
+                break
+            if event is None:
+                await _send_event(send, ': keepalive\n\n')
+                continue
+            await _send_event(send, events.format_sse(*event))
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        subscription.close()
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_event(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+
+# Lifespan
+
+def _http_client():
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient()
+    return _http
+
+
+async def _shutdown():
+    # Drain write-behind buffers, as gunicorn.conf.py's worker_exit does
+    for flush in (activity.buffer.flush, presence.flush):
+        try:
+            await run_blocking(flush)
+        except Exception:
+            logger.exception('Failed to drain buffers on shutdown')
+    if _http is not None:
+        await _http.aclose()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _http_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path == '/api/v1/auth/google':
+        return await google_auth(scope, receive, send)
+    match = EVENTS_PATH.match(path)
+    if method == 'GET' and match:
+        return await room_events(scope, receive, send, match.group(1))
+    await _flask(scope, receive, send)
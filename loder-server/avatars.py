@@ -0,0 +1,254 @@
+"""Avatar processing and content-addressed storage.
+
+An uploaded image is cropped to a square and resized to each of
+AVATAR_SIZES, encoded as AVATAR_FORMAT and written to AVATARS_DIR as
+<hash>-<size>.<ext>, where <hash> is derived from the uploaded bytes.
+users.avatar_path holds the avatar name "<hash>.<ext>". The same image
+always gets the same name and a new image gets a new one, so variants are
+served as immutable (see routes/avatars.py).
+
+Avatars stored before this scheme (<user_id>.<ext>, the original upload)
+are still served as they are; `flask process-avatars` converts them.
+
+AvatarCache keeps file metadata (and the bytes of small files) plus each
+user's avatar name in memory, so serving an avatar needs neither SQLite
+nor the filesystem once warm.
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageOps
+
+from config import (
+    AVATAR_CACHE_BYTES, AVATAR_CACHE_FILE_BYTES, AVATAR_FORMAT, AVATAR_SIZES,
+    AVATAR_USER_TTL, AVATARS_DIR,
+)
+
+# Refuse images that would decode to more pixels than this (decompression bombs)
+MAX_SOURCE_PIXELS = 40_000_000
+
+_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 85, 'method': 6}),
+    'png': ('PNG', 'image/png', {'optimize': True}),
+}
+_NAME = re.compile(r'^([0-9a-f]{32})\.(webp|png)$')
+
+
+# Bytes charged per cache entry on top of any file data
+_ENTRY_OVERHEAD = 256
+# Bound on cached user -> avatar entries; expired ones are dropped beyond it
+MAX_CACHED_USERS = 10000
+
+AvatarFile = namedtuple('AvatarFile', 'filename path mimetype etag mtime size data')
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def parse_name(avatar_path):
+    """(hash, ext) for a content-addressed avatar name, else None."""
+    match = _NAME.match(avatar_path or '')
+    return match.groups() if match else None
+
+
+def pick_size(requested):
+    """The smallest variant at least `requested` px; the largest if none is."""
+    if requested is None:
+        return max(AVATAR_SIZES)
+    for size in sorted(AVATAR_SIZES):
+        if size >= requested:
+            return size
+    return max(AVATAR_SIZES)
+
+
+def version(avatar_path):
+    """Short identifier that changes whenever a user's avatar does."""
+    if not avatar_path:
+        return None
+    parsed = parse_name(avatar_path)
+    if parsed:
+        return parsed[0][:12]
+    return hashlib.sha256(avatar_path.encode()).hexdigest()[:12]
+
+
+def variant_filename(avatar_path, size):
+    digest, ext = parse_name(avatar_path)
+    return f'{digest}-{size}.{ext}'
+
+
+def variant_path(avatar_path, size):
+    return os.path.join(AVATARS_DIR, variant_filename(avatar_path, size))
+
+
+def mimetype(avatar_path):
+    return _FORMATS[parse_name(avatar_path)[1]][1]
+
+
+def store(data):
+    """Process uploaded image bytes into all variants. Returns the avatar name.
+
+    Raises InvalidImage if the data is not a readable image.
+    """
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    pil_format, _, options = _FORMATS[AVATAR_FORMAT]
+    avatar_path = f'{digest}.{AVATAR_FORMAT}'
+    if all(os.path.exists(variant_path(avatar_path, size)) for size in AVATAR_SIZES):
+        return avatar_path   # same image uploaded before
+
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            if source.width * source.height > MAX_SOURCE_PIXELS:
+                raise InvalidImage('Image is too large')
+            image = ImageOps.exif_transpose(source)   # first frame of animations
+            image = image.convert('RGBA')
+    except InvalidImage:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise InvalidImage('Not a valid image')
+
+    side = min(image.size)
+    square = ImageOps.fit(image, (side, side), Image.LANCZOS)
+    os.makedirs(AVATARS_DIR, exist_ok=True)
+    for size in AVATAR_SIZES:
+        buffer = io.BytesIO()
+        square.resize((size, size), Image.LANCZOS).save(buffer, pil_format, **options)
+        _write_atomic(variant_path(avatar_path, size), buffer.getvalue())
+    return avatar_path
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def remove(avatar_path):
+    """Delete an avatar's files (variants, or a legacy original)."""
+    if not avatar_path or avatar_path.startswith('http'):
+        return
+    cache.discard(avatar_path)
+    if parse_name(avatar_path):
+        paths = [variant_path(avatar_path, size) for size in AVATAR_SIZES]
+    else:
+        paths = [os.path.join(AVATARS_DIR, os.path.basename(avatar_path))]
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class AvatarCache:
+    """LRU of AvatarFile by filename, bounded by max_bytes in total, plus a
+    TTL cache of user_id -> avatar name."""
+
+    def __init__(self, max_bytes=AVATAR_CACHE_BYTES, max_file_bytes=AVATAR_CACHE_FILE_BYTES,
+                 user_ttl=AVATAR_USER_TTL):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.user_ttl = user_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict()   # filename -> AvatarFile
+        self._bytes = 0
+        self._users = {}              # user_id -> (avatar_path, expires_at)
+
+    def file(self, avatar_path, size):
+        """AvatarFile for avatar_path's variant nearest `size`, or None if missing."""
+        if parse_name(avatar_path):
+            size = pick_size(size)
+            filename = variant_filename(avatar_path, size)
+            mime = mimetype(avatar_path)
+        else:
+            filename = os.path.basename(avatar_path)   # original upload
+            mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        with self._lock:
+            entry = self._files.get(filename)
+            if entry:
+                self._files.move_to_end(filename)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        path = os.path.join(AVATARS_DIR, filename)
+        try:
+            stat = os.stat(path)
+            data = None
+            if stat.st_size <= self.max_file_bytes:
+                with open(path, 'rb') as f:
+                    data = f.read()
+        except OSError:
+            return None
+        mtime = int(stat.st_mtime)
+        # Variant names are content hashes; originals can be rewritten in place
+        etag = filename if parse_name(avatar_path) else f'{filename}-{mtime}'
+        entry = AvatarFile(filename, path, mime, etag, mtime, stat.st_size, data)
+        self._add(entry)
+        return entry
+
+    def _add(self, entry):
+        cost = _ENTRY_OVERHEAD + (len(entry.data) if entry.data else 0)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            old = self._files.pop(entry.filename, None)
+            if old:
+                self._bytes -= _ENTRY_OVERHEAD + (len(old.data) if old.data else 0)
+            self._files[entry.filename] = entry
+            self._bytes += cost
+            while self._bytes > self.max_bytes:
+                _, evicted = self._files.popitem(last=False)
+                self._bytes -= _ENTRY_OVERHEAD + (len(evicted.data) if evicted.data else 0)
+
+    def discard(self, avatar_path):
+        """Drop cached files of an avatar that was deleted."""
+        if parse_name(avatar_path):
+            filenames = [variant_filename(avatar_path, size) for size in AVATAR_SIZES]
+        else:
+            filenames = [os.path.basename(avatar_path)]
+        with self._lock:
+            for filename in filenames:
+                old = self._files.pop(filename, None)
+                if old:
+                    self._bytes -= _ENTRY_OVERHEAD + (len(old.data) if old.data else 0)
+
+    # user_id -> avatar name
+
+    def user_avatar(self, user_id):
+        """(found, avatar_path); found is False if not cached."""
+        with self._lock:
+            cached = self._users.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return True, cached[0]
+        return False, None
+
+    def set_user_avatar(self, user_id, avatar_path):
+        if self.user_ttl <= 0:
+            return
+        with self._lock:
+            if len(self._users) > MAX_CACHED_USERS:
+                now = time.monotonic()
+                self._users = {k: v for k, v in self._users.items() if v[1] > now}
+            self._users[user_id] = (avatar_path, time.monotonic() + self.user_ttl)
+
+    def forget_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'files': len(self._files),
+                    'bytes': self._bytes, 'maxBytes': self.max_bytes}
+
+
+cache = AvatarCache()
@@ -0,0 +1,206 @@
+"""Heartbeat latency under slow Google logins and open event streams, sync vs ASGI.
+
+    python -m benchmarks.asgi_concurrency [--streams 500] [--logins 20] [--duration 10]
+
+Each mode starts a real server on a local port with its own database:
+"sync" is the gthread deployment (gunicorn -c gunicorn.conf.py app:app),
+"async" is uvicorn asgi:app. Sign-ins use the authorization code flow
+against a local Google stub that answers each call after --google-latency
+seconds. The client opens --streams SSE connections, then for --duration
+seconds keeps --logins sign-ins in flight while 10 members heartbeat back
+to back, and reports heartbeat latency.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REQUEST_TIMEOUT = 5
+
+MODES = {
+    'sync': ['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+    'async': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--log-level', 'warning'],
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_google_stub(latency):
+    class GoogleStub(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # /token: the code becomes the access token
+            length = int(self.headers.get('Content-Length', 0))
+            code = parse_qs(self.rfile.read(length).decode()).get('code', [''])[0]
+            self._reply({'access_token': code})
+
+        def do_GET(self):
+            # /userinfo
+            token = self.headers.get('Authorization', '').rsplit(' ', 1)[-1]
+            self._reply({'email': f'bench-{token}@example.com', 'name': 'Bench', 'id': token})
+
+        def _reply(self, data):
+            time.sleep(latency)
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GoogleStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def _wait_until_up(base_url):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f'{base_url}/api/v1/health')
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f'server at {base_url} did not start')
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 1)
+
+
+async def load(base_url, streams, logins, duration):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=REQUEST_TIMEOUT) as client:
+        users = []
+        for i in range(10):
+            response = await client.post('/api/v1/users/register', json={'deviceId': f'bench-{i}'})
+            users.append(response.json()['id'])
+        room_id = (await client.post('/api/v1/rooms/create', json={'userId': users[0]})).json()['roomId']
+        for user_id in users[1:]:
+            await client.post(f'/api/v1/rooms/{room_id}/join', json={'userId': user_id})
+
+        # Open event streams; count those that got their snapshot in time
+        connected = 0
+
+        async def stream(i):
+            nonlocal connected
+            try:
+                async with client.stream('GET', f'/api/v1/rooms/{room_id}/events',
+                                         params={'userId': users[i % len(users)]}) as response:
+                    async for line in response.aiter_lines():
+                        if line.startswith('event: snapshot'):
+                            connected += 1
+                        await asyncio.sleep(0)
+            except (httpx.HTTPError, asyncio.CancelledError):
+                pass
+
+        stream_tasks = [asyncio.ensure_future(stream(i)) for i in range(streams)]
+        await asyncio.sleep(min(REQUEST_TIMEOUT, 1 + streams / 500))
+
+        deadline = time.perf_counter() + duration
+        latencies = []
+        errors = {'heartbeat': 0, 'login': 0}
+        sign_ins = 0
+
+        async def heartbeats(user_id):
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(f'/api/v1/rooms/{room_id}/heartbeat',
+                                                 json={'userId': user_id, 'activeApp': 'Xcode'})
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    errors['heartbeat'] += 1
+
+        async def sign_in_loop(worker):
+            nonlocal sign_ins
+            n = 0
+            while time.perf_counter() < deadline:
+                n += 1
+                try:
+                    response = await client.post('/api/v1/auth/google', json={'code': f'{worker}-{n}'})
+                    response.raise_for_status()
+                    sign_ins += 1
+                except httpx.HTTPError:
+                    errors['login'] += 1
+
+        await asyncio.gather(*[heartbeats(u) for u in users], *[sign_in_loop(w) for w in range(logins)])
+        for task in stream_tasks:
+            task.cancel()
+        await asyncio.gather(*stream_tasks, return_exceptions=True)
+
+    return {
+        'streamsConnected': connected,
+        'heartbeatsPerSecond': round(len(latencies) / duration, 1),
+        'heartbeatP50Ms': _percentile(latencies, 0.5),
+        'heartbeatP99Ms': _percentile(latencies, 0.99),
+        'signInsPerSecond': round(sign_ins / duration, 1),
+        'errors': errors,
+    }
+
+
+def run_mode(mode, args, google_url):
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ, DATA_DIR=data_dir, DATABASE_PATH=os.path.join(data_dir, 'loder.db'),
+                   AVATARS_DIR=os.path.join(data_dir, 'avatars'),
+                   GOOGLE_CLIENT_ID='bench', GOOGLE_CLIENT_SECRET='bench',
+                   GOOGLE_TOKEN_URL=f'{google_url}/token', GOOGLE_USERINFO_URL=f'{google_url}/userinfo',
+                   GUNICORN_BIND=f'127.0.0.1:{port}')
+        command = MODES[mode] + (['--port', str(port)] if mode == 'async' else [])
+        server = subprocess.Popen(command, cwd=SERVER_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base_url = f'http://127.0.0.1:{port}'
+            asyncio.run(_wait_until_up(base_url))
+            return asyncio.run(load(base_url, args.streams, args.logins, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, default=500)
+    parser.add_argument('--logins', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--google-latency', type=float, default=0.3)
+    parser.add_argument('--mode', choices=sorted(MODES))
+    args = parser.parse_args()
+
+    google = start_google_stub(args.google_latency)
+    google_url = f'http://127.0.0.1:{google.server_address[1]}'
+    results = {}
+    for mode in [args.mode] if args.mode else MODES:
+        results[mode] = run_mode(mode, args, google_url)
+        r = results[mode]
+        print(f"{mode:>6}: {r['streamsConnected']}/{args.streams} streams, "
+              f"{r['heartbeatsPerSecond']} heartbeats/sec (p50 {r['heartbeatP50Ms']} ms, "
+              f"p99 {r['heartbeatP99Ms']} ms), {r['signInsPerSecond']} sign-ins/sec, errors {r['errors']}")
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Heartbeats/sec against a local SQLite file, with and without write-behind.
+
+    python -m benchmarks.heartbeat_throughput [--heartbeats 5000] [--users 10]
+
+"before" writes presence and activity through on every heartbeat (flush
+intervals 0) with sqlite3's default PRAGMAs; "after" uses the in-memory presence store and the batched
+activity buffer. Each mode runs in a fresh process with its own database.
+Users are put in rooms of at most MAX_MEMBERS_PER_ROOM.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {
+    'before': {'PRESENCE_FLUSH_INTERVAL': '0', 'ACTIVITY_FLUSH_INTERVAL': '0',
+               'SQLITE_PRAGMA_PROFILE': 'legacy'},
+    'after': {'PRESENCE_FLUSH_INTERVAL': '2', 'ACTIVITY_FLUSH_INTERVAL': '5',
+              'SQLITE_PRAGMA_PROFILE': 'tuned'},
+}
+
+
+def run(heartbeats, users):
+    from app import app
+    import activity
+    from presence import store
+    from routes.rooms import MAX_MEMBERS_PER_ROOM
+
+    client = app.test_client()
+    user_ids = [client.post('/api/v1/users/register', json={'deviceId': f'bench-{i}'}).get_json()['id']
+                for i in range(users)]
+    # A new room for every MAX_MEMBERS_PER_ROOM users
+    rooms = {}   # user_id -> room_id
+    for i, user_id in enumerate(user_ids):
+        if i % MAX_MEMBERS_PER_ROOM == 0:
+            room_id = client.post('/api/v1/rooms/create', json={'userId': user_id}).get_json()['roomId']
+        else:
+            response = client.post(f'/api/v1/rooms/{room_id}/join', json={'userId': user_id})
+            assert response.status_code == 200, response.data
+        rooms[user_id] = room_id
+
+    started = time.perf_counter()
+    for i in range(heartbeats):
+        user_id = user_ids[i % users]
+        response = client.post(f'/api/v1/rooms/{rooms[user_id]}/heartbeat', json={
+            'userId': user_id,
+            'activeApp': 'Xcode',
+        })
+        assert response.status_code == 200, response.data
+    # Pending writes are part of the cost
+    activity.buffer.flush()
+    store.flush()
+    elapsed = time.perf_counter() - started
+
+    return {'heartbeats': heartbeats, 'seconds': round(elapsed, 3),
+            'heartbeatsPerSecond': round(heartbeats / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--heartbeats', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--mode', choices=sorted(MODES))
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.heartbeats, args.users)))
+        return
+
+    results = {}
+    for mode, env in MODES.items():
+        with tempfile.TemporaryDirectory() as data_dir:
+            child_env = dict(os.environ, DATA_DIR=data_dir,
+                             DATABASE_PATH=os.path.join(data_dir, 'loder.db'),
+                             AVATARS_DIR=os.path.join(data_dir, 'avatars'), **env)
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.heartbeat_throughput', '--mode', mode,
+                 '--heartbeats', str(args.heartbeats), '--users', str(args.users)],
+                env=child_env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            results[mode] = json.loads(output.decode().strip().splitlines()[-1])
+        print(f"{mode:>6}: {results[mode]['heartbeatsPerSecond']:>8} heartbeats/sec")
+
+    print(f"speedup: {results['after']['heartbeatsPerSecond'] / results['before']['heartbeatsPerSecond']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Hot queries with the previous and the current index set.
+
+    python -m benchmarks.indexes [--rooms 1000] [--room-size 5] [--days 60] [--memberships 4]
+                                 [--repeat 300] [--data-dir DIR] [--output result.json]
+
+Seeds a database like benchmarks.load (--rooms rooms of --room-size users
+with --days of session-style activity), then puts every user in
+--memberships - 1 more rooms and gives them avatars. The same queries are
+then timed twice: with the indexes as migration 2 left them ("before")
+and after migrations 3 and 5 ("after"). Reads are the /stats
+week query, the membership lookups behind batch heartbeats and the avatar
+check; account deletion (forget_member) and 500-session activity flushes
+run in transactions that are rolled back, so every repetition sees the
+same data. Reports the mean and p95 per query in ms and writes JSON.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+FLUSH_SESSIONS = 500
+
+
+def _previous_indexes(conn):
+    """The index set before migration 3: idx_activity_logs_room_user only."""
+    import indexes
+
+    for name in indexes.created_indexes(conn, indexes.TABLES['users'] + indexes.TABLES['rooms']):
+        conn.execute(f'DROP INDEX {name}')
+    conn.execute('CREATE INDEX idx_activity_logs_room_user ON activity_logs(room_id, user_id, logged_at)')
+    conn.commit()
+
+
+def _current_indexes(conn):
+    import migrations
+
+    migrations.access_path_indexes(conn)
+    migrations.user_id_indexes(conn)
+    conn.commit()
+
+
+def _add_memberships(conn, seeded, memberships, rng):
+    """Put every user in memberships - 1 more rooms; returns all user ids."""
+    room_ids = [room_id for room_id, _ in seeded]
+    user_ids = [row[0] for row in conn.execute('SELECT user_id FROM room_members')]
+    for user_id in user_ids:
+        for room_id in rng.sample(room_ids, memberships - 1):
+            conn.execute('INSERT OR IGNORE INTO room_members (room_id, user_id, last_seen) VALUES (?, ?, 0)',
+                         (room_id, user_id))
+    conn.execute("UPDATE users SET avatar_path = 'av-' || id || '.webp'")
+    conn.commit()
+    return user_ids
+
+
+def _timed(func, repeat):
+    samples = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {'meanMs': round(sum(samples) / repeat * 1000, 3),
+            'p95Ms': round(samples[min(repeat - 1, int(repeat * 0.95))] * 1000, 3)}
+
+
+def measure(conn, room_ids, user_ids, repeat, rng):
+    import repository
+    import rollups
+    import stats
+
+    now = datetime.utcnow()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    week_start = now - timedelta(days=7)
+    rooms = [rng.choice(room_ids) for _ in range(repeat)]
+    users = [rng.choice(user_ids) for _ in range(repeat)]
+    cursor = conn.cursor()
+
+    last_id = conn.execute('SELECT MAX(id) FROM activity_logs').fetchone()[0]
+    # (room_id, user_id, app_name, bucket) already in the rollups
+    buckets = [tuple(row) for row in conn.execute(
+        'SELECT room_id, user_id, app_name, bucket FROM activity_hourly ORDER BY random() LIMIT 5000')]
+
+    def flush(new_buckets):
+        """Half new sessions, half sessions extended, as the activity buffer
+        writes them. The new sessions start rollup buckets (the first flush
+        of an hour) or add to existing ones (every later flush)."""
+        def write(i):
+            at = int(time.time())
+            if new_buckets:
+                keys = [(rng.choice(room_ids), rng.choice(user_ids), 'Xcode', rollups.hour_bucket(at))
+                        for _ in range(FLUSH_SESSIONS // 2)]
+            else:
+                keys = rng.sample(buckets, FLUSH_SESSIONS // 2)
+            cursor.executemany('''
+                INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [key[:3] + (60, key[3]) for key in keys])
+            cursor.executemany('''
+                UPDATE activity_logs SET duration_seconds = ?, ended_at = ? WHERE id = ?
+            ''', [(65, at, rng.randint(1, last_id)) for _ in range(FLUSH_SESSIONS // 2)])
+            rollups.add(cursor, dict.fromkeys(keys, 60))
+            conn.rollback()
+        return write
+
+    def forget(i):
+        repository.forget_member(conn, users[i], f'deleted-{i}')
+        conn.rollback()
+
+    queries = {
+        'stats_week': lambda i: stats.aggregate(cursor, rooms[i], week_start, today_start, set(stats.SECTIONS)),
+        'user_room_ids': lambda i: repository.user_room_ids(conn, users[i]),
+        'memberships': lambda i: repository.memberships(conn, users[i], rooms[i:i + 5]),
+        'avatar_in_use': lambda i: repository.avatar_in_use(conn, f'av-{users[i]}.webp'),
+        'forget_member': forget,
+        'flush_new_hour': flush(new_buckets=True),
+        'flush_same_hour': flush(new_buckets=False),
+    }
+    # Fewer repetitions for the writes, which touch many pages each
+    return {name: _timed(func, repeat if not name.startswith(('forget', 'flush')) else max(repeat // 10, 5))
+            for name, func in queries.items()}
+
+
+def run(args, data_dir):
+    os.environ.update({'DATA_DIR': data_dir, 'DATABASE_PATH': os.path.join(data_dir, 'loder.db'),
+                       'AVATARS_DIR': os.path.join(data_dir, 'avatars'), 'ROOM_SHARDS': '1'})
+    import database
+    import indexes
+    from benchmarks.load import seed
+
+    rng = random.Random(args.random_seed)
+    started = time.perf_counter()
+    seeded, activity_rows = seed(args.rooms, args.room_size, args.days, rng)
+    with database.db_connection() as conn:
+        user_ids = _add_memberships(conn, seeded, args.memberships, rng)
+        room_ids = [room_id for room_id, _ in seeded]
+        seed_seconds = round(time.perf_counter() - started, 1)
+
+        results = {}
+        for label, apply in (('before', _previous_indexes), ('after', _current_indexes)):
+            apply(conn)
+            missing = [indexes.describe(f) for f in indexes.check(conn, ['users', 'rooms']) if f[0] == 'missing']
+            timings = measure(conn, room_ids, user_ids, args.repeat, random.Random(args.random_seed))
+            size = conn.execute('SELECT (page_count - freelist_count) * page_size '
+                                'FROM pragma_page_count(), pragma_freelist_count(), pragma_page_size()')
+            results[label] = {'queries': timings, 'missingIndexes': missing,
+                              'databaseBytes': size.fetchone()[0]}
+
+    return {
+        'sqlite': sqlite3.sqlite_version,
+        'seed': {'rooms': args.rooms, 'users': len(user_ids), 'memberships': args.memberships,
+                 'days': args.days, 'activityRows': activity_rows, 'seconds': seed_seconds},
+        **results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--room-size', type=int, default=5)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--memberships', type=int, default=4, help='rooms per user')
+    parser.add_argument('--repeat', type=int, default=300)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--data-dir', help='keep the database here instead of a temporary directory')
+    parser.add_argument('--output', help='write the JSON result here instead of stdout')
+    args = parser.parse_args()
+    if not 1 <= args.memberships <= args.rooms:
+        parser.error('--memberships must be between 1 and --rooms')
+
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        result = run(args, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            result = run(args, data_dir)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    print(f"{'query':>15} {'before mean/p95 ms':>20} {'after mean/p95 ms':>20}", file=sys.stderr)
+    for name, before in result['before']['queries'].items():
+        after = result['after']['queries'][name]
+        print(f"{name:>15} {before['meanMs']:>11} / {before['p95Ms']:<8} {after['meanMs']:>11} / {after['p95Ms']:<8}",
+              file=sys.stderr)
+    for label in ('before', 'after'):
+        print(f"{label}: {result[label]['databaseBytes'] // 2**20} MiB, missing indexes: "
+              f"{', '.join(result[label]['missingIndexes']) or 'none'}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""Load generator: simulated clients against a seeded database, results as JSON.
+
+    python -m benchmarks.load [--clients 50] [--duration 60] [--target inprocess|sync|async]
+                              [--seed-days 90] [--extra-rooms 200] [--output result.json]
+                              [--baseline previous.json [--max-regression 0.2]]
+
+A fresh database (or --data-dir) is first filled with synthetic users and
+rooms and --seed-days of session-style activity_logs plus their rollups.
+Every client then follows the app's protocol: register, join its room (or
+create one), heartbeat every --interval seconds and now and then ask for
+/stats. "inprocess" drives the Flask app through its test client from
+threads, so SQLite lock errors surface as exceptions and are counted;
+"sync" and "async" start gunicorn or uvicorn on a local port (as in
+asgi_concurrency) and go over HTTP, where they show up as 5xx responses.
+--url targets a server that is already running and skips seeding.
+
+Reports per endpoint: requests, requests/sec, p50/p95/p99/max latency in
+ms, errors and lock errors. With --baseline, p95 latency and throughput of
+heartbeat and stats are compared with an earlier result and the exit status
+is 1 if either got worse by more than --max-regression.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REQUEST_TIMEOUT = 10
+
+SERVERS = {
+    'sync': ['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+    'async': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--log-level', 'warning'],
+}
+APPS = ('Xcode', 'Safari', 'Slack', 'Terminal', 'Figma', 'Notes', 'Mail', 'Music')
+PERIODS = ('today', 'week', 'all')
+# Endpoints compared against --baseline
+WATCHED = ('heartbeat', 'stats')
+
+
+def seed(rooms, room_size, days, rng):
+    """Create rooms of room_size users with `days` of activity. Returns
+    [(room_id, [device_id])], the first member being the creator."""
+    import database
+    import repository
+    import rollups
+
+    database.init_db()
+    now = int(time.time())
+    start_day = (now - days * rollups.DAY) // rollups.DAY * rollups.DAY
+    seeded = []
+    activity_rows = {}   # shard pool -> rows
+    with database.db_connection() as users_conn:
+        for r in range(rooms):
+            devices = [f'load-{r}-{m}' for m in range(room_size)]
+            user_ids = [str(uuid.uuid4()) for _ in devices]
+            for user_id, device_id in zip(user_ids, devices):
+                repository.create_user(users_conn, user_id, device_id)
+            users_conn.commit()
+            room_id = f'L{r:05d}'
+            with database.room_connection(room_id) as conn:
+                repository.create_room(conn, room_id, user_ids[0], None, max(room_size, 10), start_day)
+                for user_id in user_ids[1:]:
+                    repository.add_member(conn, room_id, user_id, start_day)
+                conn.commit()
+            rows = activity_rows.setdefault(database.room_pool(room_id), [])
+            for day in range(days):
+                for user_id in user_ids:
+                    for _ in range(rng.randint(0, 8)):
+                        # Sessions stay inside one hour, like the activity buffer's
+                        hour_start = start_day + day * rollups.DAY + rng.randint(8, 20) * rollups.HOUR
+                        offset = rng.randrange(0, rollups.HOUR - 60, 5)
+                        duration = rng.randrange(60, rollups.HOUR - offset + 5, 5)
+                        logged_at = hour_start + offset
+                        rows.append((room_id, user_id, rng.choice(APPS), duration, logged_at,
+                                     logged_at + duration - 5))
+            seeded.append((room_id, devices))
+
+    total = 0
+    for shard_pool, rows in activity_rows.items():
+        with database.db_connection(shard_pool) as conn:
+            conn.executemany('''
+                INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at, ended_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+            rollups.rebuild(conn)
+        total += len(rows)
+    return seeded, total
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}   # endpoint -> [(started, seconds, outcome)]
+
+    def add(self, endpoint, started, seconds, outcome):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append((started, seconds, outcome))
+
+    def summary(self):
+        result = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds for _, seconds, outcome in samples if outcome == 'ok')
+            first = min(started for started, _, _ in samples)
+            last = max(started + seconds for started, seconds, _ in samples)
+            result[endpoint] = {
+                'requests': len(samples),
+                'requestsPerSecond': round(len(samples) / max(last - first, 1e-9), 1),
+                'p50Ms': _percentile(latencies, 0.5),
+                'p95Ms': _percentile(latencies, 0.95),
+                'p99Ms': _percentile(latencies, 0.99),
+                'maxMs': round(latencies[-1] * 1000, 1) if latencies else None,
+                'errors': sum(outcome != 'ok' for _, _, outcome in samples),
+                'lockErrors': sum(outcome == 'locked' for _, _, outcome in samples),
+            }
+        return result
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 1)
+
+
+class InProcessTransport:
+    def __init__(self):
+        from app import app
+
+        app.testing = True  # let exceptions reach the client thread
+        self._client = app.test_client()
+
+    def request(self, method, path, json=None, params=None):
+        try:
+            response = self._client.open(path, method=method, json=json, query_string=params)
+        except sqlite3.OperationalError as e:
+            return ('locked' if 'locked' in str(e) else 'error'), None
+        return ('ok' if response.status_code < 400 else 'error'), response.get_json(silent=True)
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        import httpx
+
+        self._httpx = httpx
+        self._client = httpx.Client(base_url=base_url, timeout=REQUEST_TIMEOUT)
+
+    def request(self, method, path, json=None, params=None):
+        try:
+            response = self._client.request(method, path, json=json, params=params)
+        except self._httpx.HTTPError:
+            return 'error', None
+        return ('ok' if response.status_code < 400 else 'error'), (
+            response.json() if response.headers.get('content-type', '').startswith('application/json') else None)
+
+
+class Client(threading.Thread):
+    """One simulated app: setup requests, then heartbeats on a fixed interval."""
+
+    def __init__(self, index, transport, recorder, plan, args, ready, rng):
+        super().__init__(daemon=True)
+        self.index = index
+        self.transport = transport
+        self.recorder = recorder
+        self.plan = plan      # shared: seeded rooms, created rooms and their events, deadline
+        self.args = args
+        self.ready = ready    # barrier passed once every client is set up
+        self.rng = rng
+
+    def call(self, endpoint, method, path, **kwargs):
+        started = time.perf_counter()
+        outcome, body = self.transport.request(method, path, **kwargs)
+        self.recorder.add(endpoint, started, time.perf_counter() - started, outcome)
+        return body if outcome == 'ok' else None
+
+    def setup(self):
+        group, position = divmod(self.index, self.args.room_size)
+        seeded = self.plan['seeded']
+        device_id = seeded[group][1][position] if group < len(seeded) else f'load-client-{self.index}'
+        user = self.call('register', 'POST', '/api/v1/users/register', json={'deviceId': device_id})
+        if not user:
+            return None, None
+        user_id = user['id']
+
+        if group < len(seeded):
+            room_id = seeded[group][0]
+        elif position == 0:
+            body = self.call('create', 'POST', '/api/v1/rooms/create', json={'userId': user_id})
+            room_id = body and body['roomId']
+            self.plan['rooms'][group] = room_id
+            self.plan['created'][group].set()
+            return user_id, room_id
+        else:
+            self.plan['created'][group].wait(REQUEST_TIMEOUT)
+            room_id = self.plan['rooms'].get(group)
+        if room_id and self.call('join', 'POST', f'/api/v1/rooms/{room_id}/join', json={'userId': user_id}) is None:
+            room_id = None
+        return user_id, room_id
+
+    def run(self):
+        user_id, room_id = self.setup()
+        self.ready.wait()
+        if not room_id:
+            return
+        interval = self.args.interval
+        # Spread clients over the interval like real apps starting at random times
+        time.sleep(self.rng.uniform(0, interval))
+        since_version = None
+        while time.perf_counter() < self.plan['deadline']:
+            tick = time.perf_counter()
+            body = self.call('heartbeat', 'POST', f'/api/v1/rooms/{room_id}/heartbeat', json={
+                'userId': user_id, 'activeApp': self.rng.choice(APPS[:3]), 'sinceVersion': since_version,
+            })
+            since_version = body.get('version') if body else None
+            if self.rng.random() < self.args.stats_probability:
+                self.call('stats', 'GET', f'/api/v1/rooms/{room_id}/stats',
+                          params={'userId': user_id, 'period': self.rng.choice(PERIODS)})
+            time.sleep(max(0, interval - (time.perf_counter() - tick)))
+
+
+def simulate(transport_factory, seeded, args):
+    recorder = Recorder()
+    groups = -(-args.clients // args.room_size)
+    plan = {'seeded': seeded, 'rooms': {}, 'created': {g: threading.Event() for g in range(groups)}}
+    rng = random.Random(args.random_seed)
+
+    def start_measuring():
+        plan['deadline'] = time.perf_counter() + args.duration
+
+    ready = threading.Barrier(args.clients, action=start_measuring)
+    clients = [Client(i, transport_factory(), recorder, plan, args, ready, random.Random(rng.random()))
+               for i in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return recorder.summary()
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(base_url):
+    import httpx
+
+    for _ in range(100):
+        try:
+            httpx.get(f'{base_url}/api/v1/health')
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server at {base_url} did not start')
+
+
+def compare(result, baseline, max_regression):
+    """Regressions of the watched endpoints against an earlier result."""
+    regressions = []
+    for endpoint in WATCHED:
+        current = result['endpoints'].get(endpoint)
+        previous = baseline.get('endpoints', {}).get(endpoint)
+        if not current or not previous:
+            continue
+        if previous['p95Ms'] and current['p95Ms'] and current['p95Ms'] > previous['p95Ms'] * (1 + max_regression):
+            regressions.append(f"{endpoint} p95 {previous['p95Ms']} -> {current['p95Ms']} ms")
+        if current['requestsPerSecond'] < previous['requestsPerSecond'] * (1 - max_regression):
+            regressions.append(f"{endpoint} {previous['requestsPerSecond']} -> "
+                               f"{current['requestsPerSecond']} requests/sec")
+    return regressions
+
+
+def run(args, data_dir):
+    env = {'DATA_DIR': data_dir, 'DATABASE_PATH': os.path.join(data_dir, 'loder.db'),
+           'AVATARS_DIR': os.path.join(data_dir, 'avatars')}
+    os.environ.update(env)
+    rng = random.Random(args.random_seed)
+
+    seeded, activity_rows = [], 0
+    seed_seconds = 0
+    if not args.url:
+        started = time.perf_counter()
+        client_rooms = args.clients // args.room_size
+        seeded, activity_rows = seed(client_rooms + args.extra_rooms, args.room_size, args.seed_days, rng)
+        seeded = seeded[:client_rooms]
+        seed_seconds = round(time.perf_counter() - started, 1)
+
+    server = None
+    if args.url or args.target != 'inprocess':
+        base_url = args.url
+        if not base_url:
+            port = _free_port()
+            command = SERVERS[args.target] + (['--port', str(port)] if args.target == 'async' else [])
+            server = subprocess.Popen(command, cwd=SERVER_DIR, env=dict(os.environ, GUNICORN_BIND=f'127.0.0.1:{port}'),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            base_url = f'http://127.0.0.1:{port}'
+        _wait_until_up(base_url)
+        transport_factory = lambda: HttpTransport(base_url)
+    else:
+        transport_factory = InProcessTransport
+
+    try:
+        endpoints = simulate(transport_factory, seeded, args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    return {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'target': args.url or args.target,
+        'clients': args.clients,
+        'durationSeconds': args.duration,
+        'intervalSeconds': args.interval,
+        'seed': {'rooms': len(seeded) + (args.extra_rooms if not args.url else 0),
+                 'days': args.seed_days if not args.url else 0,
+                 'activityRows': activity_rows, 'seconds': seed_seconds},
+        'endpoints': endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=5, help='seconds between heartbeats (0: back to back)')
+    parser.add_argument('--stats-probability', type=float, default=0.05, help='chance of a /stats call per heartbeat')
+    parser.add_argument('--room-size', type=int, default=5)
+    parser.add_argument('--seed-days', type=int, default=90)
+    parser.add_argument('--extra-rooms', type=int, default=200, help='seeded rooms no client uses')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--target', choices=['inprocess'] + sorted(SERVERS), default='inprocess')
+    parser.add_argument('--url', help='running server to load instead; nothing is seeded')
+    parser.add_argument('--data-dir', help='keep the database here instead of a temporary directory')
+    parser.add_argument('--output', help='write the JSON result here instead of stdout')
+    parser.add_argument('--baseline', help='earlier JSON result to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+    if not 1 <= args.room_size <= 10:
+        parser.error('--room-size must be between 1 and 10')
+
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        result = run(args, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            result = run(args, data_dir)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        result['regressions'] = regressions
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    for endpoint, r in result['endpoints'].items():
+        print(f"{endpoint:>9}: {r['requests']} requests, {r['requestsPerSecond']}/sec, "
+              f"p50 {r['p50Ms']} p95 {r['p95Ms']} p99 {r['p99Ms']} ms, "
+              f"{r['errors']} errors ({r['lockErrors']} locked)", file=sys.stderr)
+    for regression in regressions:
+        print(f'regression: {regression}', file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Concurrent heartbeat clients against one SQLite file from several processes.
+
+    python -m benchmarks.lock_contention [--clients 500] [--workers 2] [--duration 10]
+
+Each worker process imports the app (like a gunicorn worker) and runs
+clients/workers threads that heartbeat as fast as they can. Reports requests
+and 'database is locked' errors for the legacy setup (write-through, default
+PRAGMAs) and the current one (pooled connections, WAL profile, write-behind).
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+MODES = {
+    'legacy': {'PRESENCE_FLUSH_INTERVAL': '0', 'ACTIVITY_FLUSH_INTERVAL': '0',
+               'SQLITE_PRAGMA_PROFILE': 'legacy', 'SQLITE_BUSY_TIMEOUT': '5000'},
+    'tuned': {'SQLITE_PRAGMA_PROFILE': 'tuned'},
+}
+ROOM_SIZE = 10
+
+
+def _setup(users):
+    """Create users and rooms; returns [(room_id, user_id)]."""
+    from app import app
+
+    client = app.test_client()
+    pairs = []
+    room_id = None
+    for i in range(users):
+        user_id = client.post('/api/v1/users/register', json={'deviceId': f'load-{i}'}).get_json()['id']
+        if i % ROOM_SIZE == 0:
+            room_id = client.post('/api/v1/rooms/create', json={'userId': user_id}).get_json()['roomId']
+        else:
+            client.post(f'/api/v1/rooms/{room_id}/join', json={'userId': user_id})
+        pairs.append((room_id, user_id))
+    return pairs
+
+
+def _worker(env, pairs, duration, results):
+    os.environ.update(env)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app
+    import activity
+    from presence import store
+
+    app.testing = True  # let exceptions reach the client thread
+    logging.disable(logging.CRITICAL)  # lock errors are counted, not logged
+    counts = {'requests': 0, 'errors': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    start = threading.Barrier(len(pairs))
+
+    def client(room_id, user_id):
+        http = app.test_client()
+        start.wait()
+        done = errors = locked = 0
+        while time.monotonic() < deadline:
+            try:
+                response = http.post(f'/api/v1/rooms/{room_id}/heartbeat',
+                                     json={'userId': user_id, 'activeApp': 'Xcode'})
+                if response.status_code != 200:
+                    errors += 1
+            except sqlite3.OperationalError as e:
+                errors += 1
+                locked += 'locked' in str(e)
+            done += 1
+        with lock:
+            counts['requests'] += done
+            counts['errors'] += errors
+            counts['locked'] += locked
+
+    threads = [threading.Thread(target=client, args=pair) for pair in pairs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        activity.buffer.flush()
+        store.flush()
+    except sqlite3.OperationalError as e:
+        counts['locked'] += 'locked' in str(e)
+    results.put(counts)
+
+
+def run(mode, clients, workers, duration):
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(MODES[mode], DATA_DIR=data_dir, DATABASE_PATH=os.path.join(data_dir, 'loder.db'),
+                   AVATARS_DIR=os.path.join(data_dir, 'avatars'))
+        os.environ.update(env)
+        ctx = multiprocessing.get_context('spawn')
+        setup = ctx.Pool(1)
+        pairs = setup.apply(_setup, (clients,))
+        setup.close()
+
+        results = ctx.Queue()
+        processes = [ctx.Process(target=_worker, args=(env, pairs[i::workers], duration, results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        totals = {'requests': 0, 'errors': 0, 'locked': 0}
+        for _ in processes:
+            for key, value in results.get().items():
+                totals[key] += value
+        for process in processes:
+            process.join()
+
+    totals['requestsPerSecond'] = round(totals['requests'] / duration, 1)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--mode', choices=sorted(MODES), action='append')
+    args = parser.parse_args()
+
+    for mode in args.mode or list(MODES):
+        result = run(mode, args.clients, args.workers, args.duration)
+        print(f'{mode:>6}: {json.dumps(result)}')
+
+
+if __name__ == '__main__':
+    main()
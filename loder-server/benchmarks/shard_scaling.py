@@ -0,0 +1,120 @@
+"""Write throughput of room shards as the shard count grows.
+
+    python -m benchmarks.shard_scaling [--rooms 200] [--workers 8] [--duration 5] [--shards 1 2 4 8]
+                                       [--synchronous FULL]
+
+For every shard count, worker processes commit heartbeat-like transactions
+(a room_members update plus an activity_logs insert) for random rooms as
+fast as they can, each through the shard that holds the room. With one
+shard every commit waits for the same write lock; more shards let commits
+for different rooms proceed side by side. Reports commits per second and
+the speedup over the first count. With the tuned synchronous=NORMAL commits
+are cheap and CPU-bound; --synchronous FULL holds the lock across an fsync
+per commit, which is where separate files pay off most. Workers only run
+side by side with as many cores as workers.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOM_SIZE = 5
+
+
+def _setup(rooms):
+    """Create users and rooms; returns [(room_id, [user_id])]."""
+    from app import app
+
+    client = app.test_client()
+    result = []
+    for i in range(rooms):
+        user_ids = [client.post('/api/v1/users/register', json={'deviceId': f'shard-{i}-{j}'}).get_json()['id']
+                    for j in range(ROOM_SIZE)]
+        room_id = client.post('/api/v1/rooms/create', json={'userId': user_ids[0]}).get_json()['roomId']
+        for user_id in user_ids[1:]:
+            client.post(f'/api/v1/rooms/{room_id}/join', json={'userId': user_id})
+        result.append((room_id, user_ids))
+    return result
+
+
+def _worker(env, rooms, duration, seed, results):
+    os.environ.update(env)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import repository
+    from database import room_connection
+
+    rng = random.Random(seed)
+    commits = locked = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        room_id, user_ids = rng.choice(rooms)
+        user_id = rng.choice(user_ids)
+        now = int(time.time())
+        try:
+            with room_connection(room_id) as conn:
+                repository.update_presence(conn, [('Xcode', now, False, room_id, user_id, now)])
+                conn.execute('''
+                    INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (room_id, user_id, 'Xcode', 5, now))
+                conn.commit()
+            commits += 1
+        except sqlite3.OperationalError as e:
+            locked += 'locked' in str(e)
+    results.put({'commits': commits, 'locked': locked})
+
+
+def run(shards, rooms, workers, duration, synchronous=None):
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = {'DATA_DIR': data_dir, 'DATABASE_PATH': os.path.join(data_dir, 'loder.db'),
+               'AVATARS_DIR': os.path.join(data_dir, 'avatars'), 'ROOM_SHARDS': str(shards),
+               'RETENTION_INTERVAL': '0'}
+        if synchronous:
+            env['SQLITE_SYNCHRONOUS'] = synchronous
+        os.environ.update(env)
+        ctx = multiprocessing.get_context('spawn')
+        setup = ctx.Pool(1)
+        room_list = setup.apply(_setup, (rooms,))
+        setup.close()
+
+        results = ctx.Queue()
+        processes = [ctx.Process(target=_worker, args=(env, room_list, duration, seed, results))
+                     for seed in range(workers)]
+        for process in processes:
+            process.start()
+        totals = {'commits': 0, 'locked': 0}
+        for _ in processes:
+            for key, value in results.get().items():
+                totals[key] += value
+        for process in processes:
+            process.join()
+
+    totals['commitsPerSecond'] = round(totals['commits'] / duration, 1)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--synchronous', choices=['OFF', 'NORMAL', 'FULL'])
+    args = parser.parse_args()
+
+    baseline = None
+    for count in args.shards:
+        result = run(count, args.rooms, args.workers, args.duration, args.synchronous)
+        baseline = baseline or result['commitsPerSecond'] or None
+        if baseline:
+            result['speedup'] = round(result['commitsPerSecond'] / baseline, 2)
+        print(f'{count:>2} shards: {json.dumps(result)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,141 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.environ.get('DATA_DIR', BASE_DIR)
 DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(DATA_DIR, 'loder.db'))
 AVATARS_DIR = os.environ.get('AVATARS_DIR', os.path.join(DATA_DIR, 'avatars'))
+
+# SQLite connection settings. Connections are pooled per worker process and
+# the PRAGMA profile is applied once when a connection is opened.
+SQLITE_PRAGMA_PROFILES = {
+    # WAL lets readers run alongside the single writer; NORMAL skips the
+    # fsync on every commit (still durable across application crashes)
+    'tuned': {
+        # Lets retention.py hand freed pages back with incremental_vacuum.
+        # Only takes effect on new databases (or after `flask apply-retention --vacuum`)
+        'auto_vacuum': 'INCREMENTAL',
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,       # KiB
+        'mmap_size': 64 * 1024 * 1024,
+        'busy_timeout': 5000,       # ms
+        'temp_store': 'MEMORY',
+    },
+    # sqlite3 defaults (rollback journal, synchronous=FULL)
+    'legacy': {},
+}
+SQLITE_PRAGMA_PROFILE = os.environ.get('SQLITE_PRAGMA_PROFILE', 'tuned')
+SQLITE_PRAGMAS = dict(SQLITE_PRAGMA_PROFILES[SQLITE_PRAGMA_PROFILE])
+for _name in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout'):
+    if f'SQLITE_{_name.upper()}' in os.environ:
+        SQLITE_PRAGMAS[_name] = os.environ[f'SQLITE_{_name.upper()}']
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', '8'))
+
+# Rooms and their data (members, activity, rollups) can be spread over
+# ROOM_SHARDS SQLite files, ROOM_SHARDS_DIR/rooms-<n>.db, each with its own
+# write lock; users stay in DATABASE_PATH. 1 keeps everything in
+# DATABASE_PATH. After changing it, run `flask rebalance-shards` with the
+# server stopped (see shards.py).
+ROOM_SHARDS = int(os.environ.get('ROOM_SHARDS', '1'))
+ROOM_SHARDS_DIR = os.environ.get('ROOM_SHARDS_DIR', DATA_DIR)
+
 MAX_AVATAR_SIZE = 1 * 1024 * 1024  # 1MB
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Uploaded avatars are cropped square and stored in these sizes (px), named
+# by content hash; ?size= picks the smallest variant at least that large.
+AVATAR_SIZES = tuple(int(s) for s in os.environ.get('AVATAR_SIZES', '32,64,128').split(','))
+AVATAR_FORMAT = os.environ.get('AVATAR_FORMAT', 'webp')   # 'webp' or 'png'
+# Avatar file metadata, and the bytes of files up to AVATAR_CACHE_FILE_BYTES,
+# are kept in an LRU bounded by AVATAR_CACHE_BYTES in total. A user's avatar
+# name is cached for AVATAR_USER_TTL seconds.
+AVATAR_CACHE_BYTES = int(os.environ.get('AVATAR_CACHE_BYTES', str(8 * 1024 * 1024)))
+AVATAR_CACHE_FILE_BYTES = int(os.environ.get('AVATAR_CACHE_FILE_BYTES', str(64 * 1024)))
+AVATAR_USER_TTL = float(os.environ.get('AVATAR_USER_TTL', '60'))
+# Let the front proxy send avatar bytes: an nginx internal location prefix
+# for X-Accel-Redirect (e.g. /protected-avatars/), or X-Sendfile for
+# Apache/lighttpd. Empty/false sends bytes from the app.
+AVATAR_ACCEL_REDIRECT = os.environ.get('AVATAR_ACCEL_REDIRECT', '')
+AVATAR_SENDFILE = os.environ.get('AVATAR_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+# Users are considered offline after 15 seconds without heartbeat
+OFFLINE_THRESHOLD_SECONDS = 15
+
+# Presence (active app, last seen, focus mode) is kept in memory and written
+# to room_members in the background. 0 writes every heartbeat through.
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '2'))
+# How long a room's member list is trusted before it is re-read from SQLite
+# (picks up joins/leaves handled by other workers)
+PRESENCE_ROSTER_TTL = float(os.environ.get('PRESENCE_ROSTER_TTL', '5'))
+# Event streams served by a thread (gthread workers) each hold that thread
+# while connected. Past EVENTS_MAX_STREAMS per process, new streams get a 503
+# so the remaining threads stay free for the API; keep it well below
+# GUNICORN_THREADS. Streams served natively by asgi.py are not counted.
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', '32'))
+
+# Activity log rows are queued and inserted in batches, flushed when the
+# queue reaches ACTIVITY_BATCH_SIZE or every ACTIVITY_FLUSH_INTERVAL seconds.
+# An interval of 0 inserts every heartbeat immediately.
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', '5'))
+ACTIVITY_BATCH_SIZE = int(os.environ.get('ACTIVITY_BATCH_SIZE', '500'))
+# 'session' extends the open activity_logs row while the app stays the same;
+# 'raw' stores one 5-second row per heartbeat.
+ACTIVITY_STORAGE_MODE = os.environ.get('ACTIVITY_STORAGE_MODE', 'session')
+
+# Retention (see retention.py). activity_logs rows older than
+# ACTIVITY_RETENTION_DAYS are appended to monthly gzipped JSONL files in
+# ACTIVITY_ARCHIVE_DIR and deleted; hourly rollups older than
+# HOURLY_ROLLUP_RETENTION_DAYS are deleted, the daily rollups keep their
+# totals. 0 keeps everything. Deletes run RETENTION_BATCH_SIZE rows per
+# transaction. With RETENTION_INTERVAL > 0 one worker applies the policy
+# every that many seconds; otherwise run `flask apply-retention` from cron.
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', '30'))
+HOURLY_ROLLUP_RETENTION_DAYS = int(os.environ.get('HOURLY_ROLLUP_RETENTION_DAYS', '90'))
+ACTIVITY_ARCHIVE_DIR = os.environ.get('ACTIVITY_ARCHIVE_DIR', os.path.join(DATA_DIR, 'archive'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '1000'))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '0'))
+
+# Computed /stats aggregates are cached per (room, period, sections, hour)
+# and dropped when new activity for the room is flushed.
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', '30'))
+STATS_CACHE_SIZE = int(os.environ.get('STATS_CACHE_SIZE', '1024'))
+
+# Session tokens (see sessions.py). Without SESSION_SECRET a random secret is
+# generated once and kept in DATA_DIR/session_secret.
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+SESSION_TOKEN_TTL = int(os.environ.get('SESSION_TOKEN_TTL', str(90 * 24 * 3600)))
+# Reject requests that identify themselves by userId alone
+REQUIRE_SESSION_TOKEN = os.environ.get('REQUIRE_SESSION_TOKEN', '').lower() in ('1', 'true', 'yes')
 
 # Google OAuth Configuration (set via environment variables)
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID', '')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET', '')
+# Google endpoints used by sign-in (overridable for local testing)
+GOOGLE_CERTS_URL = os.environ.get('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v3/certs')
+GOOGLE_TOKEN_URL = os.environ.get('GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+GOOGLE_USERINFO_URL = os.environ.get('GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v2/userinfo')
+GOOGLE_HTTP_TIMEOUT = float(os.environ.get('GOOGLE_HTTP_TIMEOUT', '10'))
+# ID tokens are verified locally against Google's signing keys. Point this at
+# a JWKS file to use fixed keys instead (offline testing).
+GOOGLE_JWKS_FILE = os.environ.get('GOOGLE_JWKS_FILE', '')
+
+# Request metrics (see metrics.py), served in Prometheus format at /metrics:
+# per-endpoint request counts and latency, SQL statements and time, time
+# waiting for the SQLite write lock and outbound HTTP time. Counters are per
+# process.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+# Sampling profiler (see profiler.py): requests slower than
+# PROFILE_SLOW_REQUEST_MS get their sampled stacks written to PROFILE_DIR in
+# folded format (flamegraph.pl, speedscope). 0 disables sampling.
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', '0'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+# Slow SQL log (see sqltrace.py, needs METRICS_ENABLED): statements slower
+# than SQL_TRACE_SLOW_MS are logged with their query plan. POST /debug/sql
+# turns tracing on or off in a running worker.
+SQL_TRACE = os.environ.get('SQL_TRACE', '').lower() in ('1', 'true', 'yes')
+SQL_TRACE_SLOW_MS = float(os.environ.get('SQL_TRACE_SLOW_MS', '50'))
+# Bearer token for the admin endpoints (/debug/sql). Without one they
+# answer 404.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Threads used by the ASGI server (asgi.py), once for Flask routes and once
+# for the SQLite work of its native handlers; everything else runs on the
+# event loop.
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '64'))
@@ -1,86 +1,137 @@
+import os
+import queue
 import sqlite3
-from config import DATABASE_PATH
+from contextlib import contextmanager
+from flask import g, has_app_context
+from config import DATABASE_PATH, METRICS_ENABLED, SQLITE_PRAGMAS, SQLITE_POOL_SIZE
+import metrics
+import migrations
+import shards
+
+
+class ConnectionPool:
+    """Per-process pool of SQLite connections.
+
+    PRAGMAs are applied once when a connection is opened. Idle connections
+    are reused LIFO; at most `size` are kept, extra ones are closed on release.
+    """
+
+    def __init__(self, path, pragmas, size):
+        self.path = path
+        self.pragmas = pragmas
+        self.size = size
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        # busy_timeout below replaces the sqlite3 module's own timeout when set
+        timeout = int(self.pragmas.get('busy_timeout', 5000)) / 1000
+        factory = metrics.InstrumentedConnection if METRICS_ENABLED else sqlite3.Connection
+        conn = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False, factory=factory)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            # Never share connections with the parent after a fork
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def clear(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+pool = ConnectionPool(DATABASE_PATH, SQLITE_PRAGMAS, SQLITE_POOL_SIZE)
+# One pool per room shard (see shards.py); with a single shard it is `pool`
+shard_pools = [
+    pool if path == DATABASE_PATH else ConnectionPool(path, SQLITE_PRAGMAS, SQLITE_POOL_SIZE)
+    for path in shards.shard_paths()
+]
+
+
+@contextmanager
+def db_connection(target=None):
+    """Pooled connection for code running outside a request, from `target`
+    (default: the DATABASE_PATH pool)."""
+    target = target or pool
+    conn = target.acquire()
+    try:
+        yield conn
+    finally:
+        target.release(conn)
+
+
+def room_pool(room_id):
+    return shard_pools[shards.shard_index(room_id)]
+
+
+def room_connection(room_id):
+    """db_connection() to the shard holding room_id."""
+    return db_connection(room_pool(room_id))
+
+
+def each_shard():
+    """Yields a pooled connection to every room shard in turn."""
+    for shard_pool in shard_pools:
+        with db_connection(shard_pool) as conn:
+            yield conn
+
 
 def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """Connection for the current request, released on app context teardown."""
+    if not has_app_context():
+        raise RuntimeError('get_db() needs an app context; use db_connection() instead')
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+def get_room_db(room_id):
+    """Request connection to room_id's shard; get_db() itself with a single shard."""
+    shard_pool = room_pool(room_id)
+    if shard_pool is pool:
+        return get_db()
+    if 'shard_dbs' not in g:
+        g.shard_dbs = {}
+    conn = g.shard_dbs.get(shard_pool)
+    if conn is None:
+        conn = g.shard_dbs[shard_pool] = shard_pool.acquire()
     return conn
 
-def init_db():
-    conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            device_id TEXT UNIQUE,
-            email TEXT UNIQUE,
-            name TEXT,
-            avatar_path TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Add email and name columns if they don't exist (migration for existing DBs)
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN email TEXT UNIQUE')
-    except:
-        pass  # Column already exists
 
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN name TEXT')
-    except:
-        pass  # Column already exists
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rooms (
-            id TEXT PRIMARY KEY,
-            created_by TEXT NOT NULL,
-            password TEXT,
-            max_members INTEGER DEFAULT 10,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (created_by) REFERENCES users(id)
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS room_members (
-            room_id TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            active_app TEXT,
-            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            focus_mode BOOLEAN DEFAULT 0,
-            PRIMARY KEY (room_id, user_id),
-            FOREIGN KEY (room_id) REFERENCES rooms(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-
-    # Add focus_mode column if it doesn't exist (migration for existing DBs)
-    try:
-        cursor.execute('ALTER TABLE room_members ADD COLUMN focus_mode BOOLEAN DEFAULT 0')
-    except:
-        pass  # Column already exists
-
-    # Activity logs for statistics
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS activity_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            room_id TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            app_name TEXT NOT NULL,
-            duration_seconds INTEGER DEFAULT 5,
-            logged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (room_id) REFERENCES rooms(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-
-    # Index for faster stats queries
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_activity_logs_room_user
-        ON activity_logs(room_id, user_id, logged_at)
-    ''')
-
-    conn.commit()
-    conn.close()
+def close_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+    for shard_pool, conn in g.pop('shard_dbs', {}).items():
+        shard_pool.release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+
+def init_db():
+    """Bring the schema of DATABASE_PATH and every shard up to date (see migrations.py)."""
+    for target in dict.fromkeys([pool] + shard_pools):
+        os.makedirs(os.path.dirname(os.path.abspath(target.path)), exist_ok=True)
+        with db_connection(target) as conn:
+            migrations.migrate(conn)
@@ -0,0 +1,134 @@
+"""In-process fan-out of room events to streaming clients.
+
+The presence store publishes member deltas (join, leave, update, online,
+offline) here; each GET /rooms/<id>/events connection holds a Subscription
+and receives them as server-sent events. Delivery is per worker process.
+Streams served by asgi.py use an AsyncSubscription, which is fed through the
+event loop instead of blocking a thread. Blocking subscriptions each hold a
+server thread, so at most EVENTS_MAX_STREAMS of them are open at a time.
+"""
+import asyncio
+import json
+import queue
+import threading
+
+from config import EVENTS_MAX_STREAMS
+
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, bus, room_id):
+        self.bus = bus
+        self.room_id = room_id
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # A stalled client; it is told to resync when it catches up
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next (event_type, data, event_id) or None after `timeout` seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """Subscription read from an event loop; publishers may be on any thread."""
+
+    def __init__(self, bus, room_id, loop):
+        super().__init__(bus, room_id)
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # loop already closed
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBus:
+    def __init__(self, max_blocking=EVENTS_MAX_STREAMS):
+        self.max_blocking = max_blocking
+        self._lock = threading.Lock()
+        self._subscribers = {}   # room_id -> set of Subscription
+        self._blocking = 0
+
+    def subscribe(self, room_id, loop=None):
+        """Subscribe to room_id; pass the running loop for an AsyncSubscription.
+
+        Raises TooManyStreams when max_blocking blocking subscriptions are open.
+        """
+        if loop is None:
+            subscription = Subscription(self, room_id)
+        else:
+            subscription = AsyncSubscription(self, room_id, loop)
+        with self._lock:
+            if loop is None:
+                if self._blocking >= self.max_blocking:
+                    raise TooManyStreams()
+                self._blocking += 1
+            self._subscribers.setdefault(room_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Safe to call more than once."""
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.room_id)
+            if not subscribers or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.room_id]
+            if not isinstance(subscription, AsyncSubscription):
+                self._blocking -= 1
+
+    def blocking_streams(self):
+        return self._blocking
+
+    def has_subscribers(self, room_id):
+        return room_id in self._subscribers
+
+    def publish(self, room_id, event_type, data, event_id=None):
+        with self._lock:
+            subscribers = list(self._subscribers.get(room_id, ()))
+        for subscription in subscribers:
+            subscription.put((event_type, data, event_id))
+
+
+def format_sse(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+bus = EventBus()
@@ -0,0 +1,90 @@
+"""Local copies of Google profile pictures.
+
+Sign-in stores the Google picture URL as the user's avatar (clients can
+show it straight away) and queues it here. A background thread downloads
+it once, runs it through avatars.store() like an upload and swaps the URL
+for the stored avatar, remembering the URL in users.avatar_source_url so
+the picture is only fetched again when Google hands out a different one.
+"""
+import logging
+import re
+import threading
+
+import requests
+
+import avatars
+from config import AVATAR_SIZES, GOOGLE_HTTP_TIMEOUT, MAX_AVATAR_SIZE
+from database import db_connection
+import metrics
+from presence import store as presence
+import repository
+from utils import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Google pictures are larger than uploads may be, before resizing
+MAX_PICTURE_BYTES = 4 * MAX_AVATAR_SIZE
+# Size suffix of googleusercontent URLs (e.g. "=s96-c"); ask for our largest variant
+_SIZE_SUFFIX = re.compile(r'=s\d+(-c)?$')
+
+
+def picture_url_for_download(url):
+    size = max(AVATAR_SIZES)
+    return _SIZE_SUFFIX.sub(f'=s{size}-c', url) if _SIZE_SUFFIX.search(url) else url
+
+
+def download(url):
+    """Picture bytes, or raises (requests errors, ValueError if too large)."""
+    with metrics.http_call('google'), \
+            requests.get(picture_url_for_download(url), timeout=GOOGLE_HTTP_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        data = b''
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > MAX_PICTURE_BYTES:
+                raise ValueError('Picture too large')
+        return data
+
+
+class PictureFetcher:
+    def __init__(self, interval=5):
+        self._lock = threading.Lock()
+        self._pending = {}   # user_id -> (picture_url, avatar_path when queued)
+        self._task = PeriodicTask('google-avatars', interval, self.run_pending)
+
+    def enqueue(self, user_id, picture_url, current_avatar_path):
+        with self._lock:
+            self._pending[user_id] = (picture_url, current_avatar_path)
+        self._task.trigger()
+
+    def run_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for user_id, (picture_url, current_avatar_path) in pending.items():
+            try:
+                self.fetch(user_id, picture_url, current_avatar_path)
+            except Exception:
+                # Tried again on the user's next sign-in
+                logger.warning('Fetching Google picture for %s failed', user_id, exc_info=True)
+
+    def fetch(self, user_id, picture_url, current_avatar_path):
+        """Download and store one picture. Returns the new avatar name, or
+        None if the user's avatar changed in the meantime."""
+        avatar_path = avatars.store(download(picture_url))
+        with db_connection() as conn:
+            user = repository.get_user(conn, user_id)
+            if not user or not repository.set_fetched_avatar(
+                    conn, user_id, avatar_path, picture_url, current_avatar_path):
+                conn.rollback()
+                return None
+            conn.commit()
+            previous = user.avatar_path
+            if previous and previous != avatar_path and not repository.avatar_in_use(conn, previous):
+                avatars.remove(previous)
+
+        avatars.cache.forget_user(user_id)
+        presence.refresh_user(user_id)
+        return avatar_path
+
+
+fetcher = PictureFetcher()
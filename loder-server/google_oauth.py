@@ -0,0 +1,158 @@
+"""Google sign-in: turn an ID token or authorization code into a profile.
+
+ID tokens are verified locally (google_tokens); Google is only contacted
+to refresh its signing keys. The calls to Google are written once, as a
+generator that yields each HTTP request and receives the response.
+fetch_profile() drives it with requests (WSGI routes); fetch_profile_async()
+drives it with an httpx.AsyncClient so the ASGI server (asgi.py) does not
+hold a thread while Google answers.
+"""
+import logging
+from collections import namedtuple
+
+import requests
+
+from config import (
+    GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_HTTP_TIMEOUT,
+    GOOGLE_TOKEN_URL, GOOGLE_USERINFO_URL,
+)
+import google_tokens
+import metrics
+from google_tokens import InvalidToken
+
+logger = logging.getLogger(__name__)
+
+GoogleProfile = namedtuple('GoogleProfile', 'email name google_id picture_url')
+
+# Reused across logins so Google connections stay open
+_session = requests.Session()
+
+DEFAULT_REDIRECT_URI = 'com.googleusercontent.apps.397708767571-b87cc4q5a6h6lokubas6ho8squ9ipv02:/oauth2callback'
+
+
+class GoogleAuthError(Exception):
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _sign_in_steps(data):
+    """Yields (method, url, options) per Google call, receives the response.
+
+    Returns a GoogleProfile; raises GoogleAuthError with the HTTP status to
+    answer with.
+    """
+    # Option 1: ID Token verification (for mobile/desktop apps), checked
+    # locally against Google's signing keys
+    if 'idToken' in data:
+        if not GOOGLE_CLIENT_ID:
+            raise GoogleAuthError('Google OAuth not configured', 500)
+        id_token = data['idToken']
+        keys = google_tokens.keys
+        kid = google_tokens.unverified_kid(id_token)
+        try:
+            if keys.needs_refresh(kid):
+                try:
+                    response = yield ('GET', keys.url, {})
+                    keys.update(response)
+                except Exception:
+                    # Keep verifying with the cached keys while Google is unreachable
+                    keys.refresh_failed()
+                    if keys.get(kid) is None:
+                        raise
+                    logger.warning('Refreshing Google signing keys failed; using cached keys', exc_info=True)
+            token_info = google_tokens.verify(id_token, keys, GOOGLE_CLIENT_ID)
+        except InvalidToken:
+            raise GoogleAuthError('Invalid token')
+        except Exception as e:
+            raise GoogleAuthError(f'Token verification failed: {str(e)}')
+
+        email = token_info.get('email')
+        if not email:
+            raise GoogleAuthError('Email not found in token', 400)
+        return GoogleProfile(
+            email,
+            token_info.get('name', email.split('@')[0]),
+            token_info.get('sub'),
+            token_info.get('picture'),
+        )
+
+    # Option 2: Authorization code exchange (for web flow)
+    if 'code' in data:
+        if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
+            raise GoogleAuthError('Google OAuth not configured', 500)
+
+        try:
+            # Exchange code for tokens
+            response = yield ('POST', GOOGLE_TOKEN_URL, {'data': {
+                'code': data['code'],
+                'client_id': GOOGLE_CLIENT_ID,
+                'client_secret': GOOGLE_CLIENT_SECRET,
+                'redirect_uri': data.get('redirectUri', DEFAULT_REDIRECT_URI),
+                'grant_type': 'authorization_code'
+            }})
+            if response.status_code != 200:
+                raise GoogleAuthError('Failed to exchange code')
+            access_token = response.json().get('access_token')
+
+            # Get user info
+            response = yield ('GET', GOOGLE_USERINFO_URL, {
+                'headers': {'Authorization': f'Bearer {access_token}'}
+            })
+            if response.status_code != 200:
+                raise GoogleAuthError('Failed to get user info')
+            userinfo = response.json()
+        except GoogleAuthError:
+            raise
+        except Exception as e:
+            raise GoogleAuthError(f'Code exchange failed: {str(e)}')
+
+        email = userinfo.get('email')
+        if not email:
+            raise GoogleAuthError('Email not found', 400)
+        # v2 userinfo calls it verified_email, the OpenID Connect endpoint email_verified
+        if userinfo.get('verified_email', userinfo.get('email_verified')) is not True:
+            raise GoogleAuthError('Email not verified')
+        return GoogleProfile(
+            email,
+            userinfo.get('name', email.split('@')[0]),
+            userinfo.get('id'),
+            userinfo.get('picture'),
+        )
+
+    raise GoogleAuthError('idToken or code required', 400)
+
+
+def fetch_profile(data):
+    """Run the sign-in calls with requests (blocking)."""
+    steps = _sign_in_steps(data)
+    try:
+        method, url, options = next(steps)
+        while True:
+            try:
+                with metrics.http_call('google'):
+                    response = _session.request(method, url, timeout=GOOGLE_HTTP_TIMEOUT, **options)
+            except Exception as e:
+                method, url, options = steps.throw(e)
+            else:
+                method, url, options = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+
+async def fetch_profile_async(data, client):
+    """Run the sign-in calls on an httpx.AsyncClient."""
+    steps = _sign_in_steps(data)
+    try:
+        method, url, options = next(steps)
+        while True:
+            try:
+                with metrics.http_call('google'):
+                    response = await client.request(method, url, timeout=GOOGLE_HTTP_TIMEOUT, **options)
+            except Exception as e:
+                method, url, options = steps.throw(e)
+            else:
+                method, url, options = steps.send(response)
+    except StopIteration as done:
+        return done.value
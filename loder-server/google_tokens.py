@@ -0,0 +1,182 @@
+"""Local verification of Google ID tokens.
+
+ID tokens are RS256 JWTs signed with one of Google's rotating keys. The
+keys are cached here and refreshed when their Cache-Control max-age runs
+out (or when a token names a key we have not seen), so verifying a login
+costs one RSA public-key operation instead of a tokeninfo round trip. The
+signature check itself is left to the cryptography package.
+
+With GOOGLE_JWKS_FILE set, keys are read from that JWKS file instead and
+never refreshed, so tokens signed with a fixture key verify offline.
+"""
+import base64
+import json
+import re
+import threading
+import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from config import GOOGLE_CERTS_URL, GOOGLE_JWKS_FILE
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# Allowed clock difference when checking exp/iat
+CLOCK_SKEW_SECONDS = 60
+# Used when the certs response has no max-age
+DEFAULT_KEYS_MAX_AGE = 300
+# A token with an unknown kid triggers at most one refresh per interval
+UNKNOWN_KID_REFRESH_INTERVAL = 60
+# After a failed refresh, cached keys are used this long before trying again
+FAILED_REFRESH_RETRY_SECONDS = 30
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def parse_jwks(jwks):
+    """{kid: RSA public key} for the RSA keys of a JWKS document."""
+    return {
+        key['kid']: rsa.RSAPublicNumbers(
+            int.from_bytes(_b64decode(key['e']), 'big'),
+            int.from_bytes(_b64decode(key['n']), 'big'),
+        ).public_key()
+        for key in jwks.get('keys', ())
+        if key.get('kty') == 'RSA' and 'kid' in key
+    }
+
+
+class KeySource:
+    """Signing keys by kid; subclasses decide where they come from."""
+
+    url = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+
+    def get(self, kid):
+        with self._lock:
+            return self._keys.get(kid)
+
+    def needs_refresh(self, kid):
+        return False
+
+    def refresh_failed(self):
+        pass
+
+
+class HttpKeySource(KeySource):
+    """Keys fetched from Google's JWKS endpoint, cached per Cache-Control.
+
+    The fetch itself is done by the caller (see google_oauth), with whatever
+    HTTP client it uses; update() takes the response.
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self._expires_at = 0
+        self._refreshed_at = 0
+
+    def needs_refresh(self, kid):
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._expires_at:
+                return True
+            return kid not in self._keys and now - self._refreshed_at >= UNKNOWN_KID_REFRESH_INTERVAL
+
+    def update(self, response):
+        if response.status_code != 200:
+            raise RuntimeError(f'fetching Google keys returned {response.status_code}')
+        keys = parse_jwks(response.json())
+        max_age = _max_age(response.headers)
+        now = time.monotonic()
+        with self._lock:
+            self._keys = keys
+            self._refreshed_at = now
+            self._expires_at = now + max_age
+
+    def refresh_failed(self):
+        now = time.monotonic()
+        with self._lock:
+            self._refreshed_at = now
+            self._expires_at = now + FAILED_REFRESH_RETRY_SECONDS
+
+
+class FileKeySource(KeySource):
+    """Keys from a JWKS file, loaded once."""
+
+    def __init__(self, path):
+        super().__init__()
+        with open(path) as f:
+            self._keys = parse_jwks(json.load(f))
+
+
+def _max_age(headers):
+    match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+    if not match:
+        return DEFAULT_KEYS_MAX_AGE
+    try:
+        age = int(headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    return max(0, int(match.group(1)) - age)
+
+
+def unverified_kid(token):
+    """The kid named in the token header (None if the token is malformed)."""
+    try:
+        return json.loads(_b64decode(token.split('.')[0])).get('kid')
+    except (ValueError, AttributeError):
+        return None
+
+
+def verify(token, keys, audience, now=None):
+    """Check signature, issuer, audience, expiry and that the email is verified.
+
+    Returns the claims.
+    """
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64decode(header_b64))
+        claims = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except (ValueError, AttributeError):
+        raise InvalidToken('Malformed token')
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise InvalidToken('Malformed token')
+
+    if header.get('alg') != 'RS256':
+        raise InvalidToken('Unsupported algorithm')
+    key = keys.get(header.get('kid'))
+    if key is None:
+        raise InvalidToken('Unknown signing key')
+    try:
+        key.verify(signature, f'{header_b64}.{payload_b64}'.encode('ascii'),
+                   padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise InvalidToken('Bad signature')
+
+    now = time.time() if now is None else now
+    if claims.get('iss') not in GOOGLE_ISSUERS:
+        raise InvalidToken('Wrong issuer')
+    if claims.get('aud') != audience:
+        raise InvalidToken('Wrong audience')
+    if not isinstance(claims.get('exp'), (int, float)) or claims['exp'] + CLOCK_SKEW_SECONDS < now:
+        raise InvalidToken('Token expired')
+    if isinstance(claims.get('iat'), (int, float)) and claims['iat'] - CLOCK_SKEW_SECONDS > now:
+        raise InvalidToken('Token issued in the future')
+    # The email ends up on the user, so only accept addresses Google has verified
+    if claims.get('email_verified') is not True:
+        raise InvalidToken('Email not verified')
+    return claims
+
+
+keys = FileKeySource(GOOGLE_JWKS_FILE) if GOOGLE_JWKS_FILE else HttpKeySource(GOOGLE_CERTS_URL)
@@ -0,0 +1,23 @@
+# Gunicorn settings for the Docker image (gunicorn -c gunicorn.conf.py app:app)
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+# Presence and room event streams live in process memory, so one worker
+# with many threads sees every heartbeat and can push to every stream.
+# Event streams each hold a thread for as long as the client is connected;
+# EVENTS_MAX_STREAMS (default 32) caps them so heartbeats keep a thread.
+workers = int(os.environ.get('GUNICORN_WORKERS', '1'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '64'))
+
+
+def worker_exit(server, worker):
+    """Drain write-behind buffers before the worker goes away."""
+    from activity import buffer
+    from presence import store
+
+    for flush in (buffer.flush, store.flush):
+        try:
+            flush()
+        except Exception:
+            server.log.exception('Failed to drain buffers on worker exit')
@@ -0,0 +1,164 @@
+"""Index advisor.
+
+HOT_QUERIES lists the statements the server runs per request or per flush,
+plus the ones that touch every row of a user (account deletion) and the
+retention batches. Entries are the SQL constants the code runs
+(repository.py, activity.py, rollups.py, stats.py, retention.py), not
+copies of them. check() asks SQLite for each one's EXPLAIN QUERY PLAN and
+reports
+
+- missing indexes: a query whose plan scans a whole table,
+- unused indexes: an index on the same tables that no plan uses, which
+  only costs writes, and
+- accepted scans: full scans listed in ACCEPTED_SCANS with the reason no
+  index is kept for them. These are informational, not problems.
+
+Users are checked against DATABASE_PATH and rooms against every shard.
+report() runs at startup and logs what it finds (accepted scans at INFO);
+`flask check-indexes` prints it and fails on problems only. A new hot
+statement needs a constant and an entry here.
+"""
+import logging
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+import activity
+import repository
+import retention
+import rollups
+import stats
+from database import db_connection, pool, shard_pools
+from sqltrace import full_scans
+
+logger = logging.getLogger(__name__)
+
+# A Monday, so the week below starts mid-hour and spans logs, hourly and daily rollups
+_TODAY = datetime(2024, 1, 8)
+_STATS_WEEK = stats.aggregate_query('room', _TODAY - timedelta(days=6, minutes=-30), _TODAY, set(stats.SECTIONS))[0]
+
+HOT_QUERIES = {
+    'users': {
+        'get_user': repository.GET_USER_SQL,
+        'get_user_by_device': repository.GET_USER_BY_DEVICE_SQL,
+        'get_user_by_email': repository.GET_USER_BY_EMAIL_SQL,
+        'user_avatars': repository.USER_AVATARS_SQL,
+        'user_profiles': repository.USER_PROFILES_SQL,
+        'avatar_in_use': repository.AVATAR_IN_USE_SQL,
+        'delete_user': repository.DELETE_USER_SQL[0],
+        'delete_archive_id': repository.DELETE_USER_SQL[1],
+    },
+    'rooms': {
+        'get_room': repository.GET_ROOM_SQL,
+        'join_check': repository.JOIN_CHECK_SQL,
+        'memberships': repository.MEMBERSHIPS_SQL,
+        'user_room_ids': repository.USER_ROOM_IDS_SQL,
+        'room_members': repository.ROOM_MEMBERS_SQL,
+        'update_presence': repository.UPDATE_PRESENCE_SQL,
+        'remove_member': repository.REMOVE_MEMBER_SQL,
+        'activity_update': activity.UPDATE_SESSION_SQL,
+        'rollup_upsert_hourly': rollups.UPSERT_SQL.format(table='activity_hourly'),
+        'rollup_upsert_daily': rollups.UPSERT_SQL.format(table='activity_daily'),
+        'stats_week': _STATS_WEEK,
+        'forget_logs': repository.FORGET_ACTIVITY_SQL[0],
+        'forget_hourly': repository.FORGET_ACTIVITY_SQL[1],
+        'forget_daily': repository.FORGET_ACTIVITY_SQL[2],
+        'forget_memberships': repository.FORGET_MEMBERSHIPS_SQL,
+        'archive_batch': retention.ARCHIVE_BATCH_SQL,
+        'drop_hourly_batch': retention.DROP_HOURLY_BATCH_SQL,
+    },
+}
+
+# Hot queries left to scan on purpose: {query name: why no index}. They are
+# reported at INFO, not as missing indexes.
+ACCEPTED_SCANS = {
+    'archive_batch': 'retention reads the oldest rows in id order, which are the '
+                     'first ones the scan meets, once per RETENTION_INTERVAL',
+}
+
+TABLES = {
+    'users': ('users',),
+    'rooms': ('rooms', 'room_members', 'activity_logs', 'activity_hourly', 'activity_daily'),
+}
+
+_INDEX_NAME = re.compile(r'INDEX (\w+)')
+
+
+def query_plan(conn, sql):
+    """EXPLAIN QUERY PLAN details for sql, with NULL for every parameter."""
+    names = re.findall(r':(\w+)', sql)
+    parameters = dict.fromkeys(names) if names else (None,) * sql.count('?')
+    cursor = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+    return [row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+
+
+def created_indexes(conn, tables):
+    """{index name: table} for the explicitly created indexes on tables."""
+    rows = conn.execute(f'''
+        SELECT name, tbl_name FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL
+          AND tbl_name IN ({', '.join('?' * len(tables))})
+    ''', tables).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def check(conn, roles):
+    """Findings for the given roles on one database file: a list of
+    ('missing' or 'accepted', query name, tables scanned) and
+    ('unused', index name, table)."""
+    findings = []
+    used = set()
+    tables = ()
+    for role in roles:
+        tables += TABLES[role]
+        for name, sql in HOT_QUERIES[role].items():
+            plan = query_plan(conn, sql)
+            for detail in plan:
+                used.update(_INDEX_NAME.findall(detail))
+            scans = full_scans(plan)
+            if scans:
+                kind = 'accepted' if name in ACCEPTED_SCANS else 'missing'
+                findings.append((kind, name, ', '.join(sorted(set(scans)))))
+    for index, table in sorted(created_indexes(conn, tables).items()):
+        if index not in used:
+            findings.append(('unused', index, table))
+    return findings
+
+
+def check_all():
+    """{database path: findings} for DATABASE_PATH and every shard."""
+    results = {}
+    for target in dict.fromkeys([pool] + shard_pools):
+        roles = []
+        if target is pool:
+            roles.append('users')
+        if target in shard_pools:
+            roles.append('rooms')
+        with db_connection(target) as conn:
+            results[target.path] = check(conn, roles)
+    return results
+
+
+def describe(finding):
+    kind, name, detail = finding
+    if kind == 'missing':
+        return f'{name} scans {detail} (no usable index)'
+    if kind == 'accepted':
+        return f'{name} scans {detail} (accepted: {ACCEPTED_SCANS[name]})'
+    return f'{name} on {detail} is not used by any hot query'
+
+
+def is_problem(finding):
+    return finding[0] != 'accepted'
+
+
+def report():
+    """Log missing and unused indexes, and accepted scans at INFO. Returns
+    the number of problems."""
+    count = 0
+    for path, findings in check_all().items():
+        for finding in findings:
+            level = logging.WARNING if is_problem(finding) else logging.INFO
+            logger.log(level, 'Index check, %s: %s', path, describe(finding))
+        count += sum(map(is_problem, findings))
+    return count
@@ -0,0 +1,336 @@
+"""Per-endpoint request metrics, served in Prometheus text format.
+
+A RequestTracker follows each request (Flask hooks from init_app(), or the
+native handlers in asgi.py) and keeps its counts in a context variable, so
+code deeper down only adds to whatever request is current:
+
+- SQLite connections from the pool are InstrumentedConnections (see
+  database.py): every statement and commit is timed. Before the first write
+  of a transaction the connection issues BEGIN IMMEDIATE itself, which is
+  what the implicit deferred BEGIN would do at that write anyway; the time
+  that BEGIN takes is the time spent waiting for the write lock.
+- http_call() times outbound requests (Google sign-in, picture downloads).
+
+Slow statements are also handed to sqltrace.tracer while tracing is on.
+
+Work outside a request (write-behind flushes, retention) is counted under
+the endpoint "background". Everything is plain counters behind a lock per
+metric, cheap enough to leave on; counts are per process.
+"""
+import bisect
+import contextvars
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+from config import METRICS_ENABLED
+from profiler import profiler
+from sqltrace import tracer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BACKGROUND = 'background'
+
+_WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, _label_text(self.labels, labels), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}   # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (f'{self.name}_bucket', _label_text(self.labels + ('le',), labels + (bound,)),
+                       cumulative)
+            yield f'{self.name}_sum', _label_text(self.labels, labels), counts[-1]
+            yield f'{self.name}_count', _label_text(self.labels, labels), cumulative
+
+
+class Gauge:
+    """Value read from a callback when /metrics is scraped."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def samples(self):
+        yield self.name, '', self.func()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func):
+        return self._add(Gauge(name, help, func))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+requests_total = registry.counter('loder_requests_total', 'Requests handled.', ('endpoint', 'method', 'status'))
+request_seconds = registry.histogram('loder_request_duration_seconds', 'Request latency.', ('endpoint',))
+sql_statements = registry.counter('loder_sql_statements_total', 'SQLite statements and commits run.',
+                                  ('endpoint',))
+sql_seconds = registry.counter('loder_sql_seconds_total', 'Time spent in SQLite statements and commits.',
+                               ('endpoint',))
+lock_wait_seconds = registry.counter('loder_sqlite_lock_wait_seconds_total',
+                                     'Time spent waiting for the SQLite write lock.', ('endpoint',))
+http_requests = registry.counter('loder_http_client_requests_total', 'Outbound HTTP requests.',
+                                 ('endpoint', 'service'))
+http_seconds = registry.counter('loder_http_client_seconds_total', 'Time spent in outbound HTTP requests.',
+                                ('endpoint', 'service'))
+
+
+class RequestStats:
+    __slots__ = ('sql_statements', 'sql_seconds', 'lock_wait_seconds', 'http')
+
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.lock_wait_seconds = 0.0
+        self.http = {}   # service -> [requests, seconds]
+
+
+_current = contextvars.ContextVar('loder_request_stats', default=None)
+
+
+class RequestTracker:
+    """Counts one request from construction to finish()."""
+
+    def __init__(self, profile=True):
+        self.stats = RequestStats()
+        self._token = _current.set(self.stats)
+        self._profiled = profile and profiler.enabled
+        if self._profiled:
+            profiler.start()
+        self.started = time.perf_counter()
+
+    def finish(self, endpoint, method, status):
+        seconds = time.perf_counter() - self.started
+        _current.reset(self._token)
+        if self._profiled:
+            profiler.finish(endpoint, seconds, profiler.stop())
+        if not METRICS_ENABLED:
+            return
+        stats = self.stats
+        requests_total.inc((endpoint, method, str(status)))
+        request_seconds.observe((endpoint,), seconds)
+        if stats.sql_statements:
+            sql_statements.inc((endpoint,), stats.sql_statements)
+            sql_seconds.inc((endpoint,), stats.sql_seconds)
+            lock_wait_seconds.inc((endpoint,), stats.lock_wait_seconds)
+        for service, (count, spent) in stats.http.items():
+            http_requests.inc((endpoint, service), count)
+            http_seconds.inc((endpoint, service), spent)
+
+
+def _record_sql(seconds, lock_wait=0.0):
+    stats = _current.get()
+    if stats is None:
+        sql_statements.inc((BACKGROUND,))
+        sql_seconds.inc((BACKGROUND,), seconds)
+        if lock_wait:
+            lock_wait_seconds.inc((BACKGROUND,), lock_wait)
+        return
+    stats.sql_statements += 1
+    stats.sql_seconds += seconds
+    stats.lock_wait_seconds += lock_wait
+
+
+@contextmanager
+def http_call(service):
+    """Time an outbound HTTP request made inside the block."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stats = _current.get()
+        if stats is None:
+            http_requests.inc((BACKGROUND, service))
+            http_seconds.inc((BACKGROUND, service), seconds)
+        else:
+            spent = stats.http.setdefault(service, [0, 0.0])
+            spent[0] += 1
+            spent[1] += seconds
+
+
+def _begin(cursor, sql):
+    """Start the transaction sql would start; returns the seconds spent
+    waiting for the write lock.
+
+    A write outside a transaction gets BEGIN IMMEDIATE ahead of it (the
+    implicit BEGIN would take the lock at the write anyway). An explicit
+    BEGIN (migrations) is timed whole, in the caller.
+    """
+    conn = cursor.connection
+    if conn.in_transaction:
+        return 0.0
+    head = sql.lstrip()[:7].upper()
+    if head.startswith('BEGIN'):
+        return None
+    if not head.startswith(_WRITES) or conn.isolation_level is None:
+        return 0.0
+    started = time.perf_counter()
+    try:
+        sqlite3.Cursor.execute(cursor, 'BEGIN IMMEDIATE')
+    finally:
+        waited = time.perf_counter() - started
+        _record_sql(waited, waited)
+    return waited
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        lock_wait = _begin(self, sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            seconds = time.perf_counter() - started
+            _record_sql(seconds, seconds if lock_wait is None else 0.0)
+            if tracer.enabled and seconds >= tracer.threshold:
+                tracer.record(self.connection, sql, parameters, seconds)
+
+    def executemany(self, sql, seq_of_parameters):
+        _begin(self, sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            seconds = time.perf_counter() - started
+            _record_sql(seconds)
+            if tracer.enabled and seconds >= tracer.threshold:
+                # Generators are used up by now; lists give a sample row for the plan
+                sample = None
+                if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters:
+                    sample = seq_of_parameters[0]
+                tracer.record(self.connection, sql, sample, seconds)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements are counted in the metrics."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            _record_sql(time.perf_counter() - started)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _record_sql(time.perf_counter() - started)
+
+
+# Flask
+
+def _start_request():
+    g.request_tracker = RequestTracker()
+
+
+def _note_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+def _finish_request(exception=None):
+    tracker = g.pop('request_tracker', None)
+    if tracker is not None:
+        status = 500 if exception is not None else g.pop('response_status', 500)
+        tracker.finish(request.endpoint or 'unmatched', request.method, status)
+
+
+def init_app(app):
+    if not METRICS_ENABLED and not profiler.enabled:
+        return
+    app.before_request(_start_request)
+    app.after_request(_note_status)
+    app.teardown_request(_finish_request)
@@ -0,0 +1,280 @@
+"""Versioned schema migrations.
+
+The schema_version table holds the number of the last migration applied.
+migrate() runs at startup and applies the newer steps of MIGRATIONS in
+order, each in its own transaction together with the version bump. Workers
+booting at the same time serialize on BEGIN IMMEDIATE and re-read the
+version, so every step runs exactly once; an up-to-date database costs a
+single SELECT.
+
+To change the schema, append a step; never edit one that has shipped.
+"""
+import logging
+
+import rollups
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []   # (version, function), in order
+
+
+def migration(version):
+    def register(func):
+        MIGRATIONS.append((version, func))
+        return func
+    return register
+
+
+def current_version(conn):
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def migrate(conn):
+    """Apply pending migrations. Returns the number applied."""
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    conn.commit()
+    if current_version(conn) >= latest_version():
+        return 0
+
+    applied = 0
+    for version, func in MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another worker may have applied it while we waited for the lock
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            logger.info('Applying schema migration %d (%s)', version, func.__name__)
+            func(conn)
+            conn.execute('DELETE FROM schema_version')
+            conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied += 1
+    return applied
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _add_column(conn, table, column, definition):
+    if column not in _columns(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+@migration(1)
+def baseline(conn):
+    """The schema as it was before versioning, including the columns that
+    older databases gained through ad hoc ALTER TABLEs."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            device_id TEXT UNIQUE,
+            email TEXT UNIQUE,
+            name TEXT,
+            avatar_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # SQLite cannot add a UNIQUE column, so older databases get an index instead
+    if 'email' not in _columns(conn, 'users'):
+        conn.execute('ALTER TABLE users ADD COLUMN email TEXT')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users(email)')
+    _add_column(conn, 'users', 'name', 'TEXT')
+    # Google picture URL an avatar was downloaded from (NULL for uploads)
+    _add_column(conn, 'users', 'avatar_source_url', 'TEXT')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id TEXT PRIMARY KEY,
+            created_by TEXT NOT NULL,
+            password TEXT,
+            max_members INTEGER DEFAULT 10,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS room_members (
+            room_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            active_app TEXT,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            focus_mode BOOLEAN DEFAULT 0,
+            PRIMARY KEY (room_id, user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    _add_column(conn, 'room_members', 'focus_mode', 'BOOLEAN DEFAULT 0')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS activity_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            app_name TEXT NOT NULL,
+            duration_seconds INTEGER DEFAULT 5,
+            logged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ended_at TIMESTAMP,
+            FOREIGN KEY (room_id) REFERENCES rooms(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    _add_column(conn, 'activity_logs', 'ended_at', 'TIMESTAMP')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_logs_room_user
+        ON activity_logs(room_id, user_id, logged_at)
+    ''')
+
+    # Hourly/daily rollups for /stats (see rollups.py)
+    rollups_exist = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activity_daily'"
+    ).fetchone() is not None
+    for table in ('activity_hourly', 'activity_daily'):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                room_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                app_name TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                total_seconds INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (room_id, bucket, user_id, app_name)
+            ) WITHOUT ROWID
+        ''')
+    if not rollups_exist:
+        _rebuild_rollups_from_text_timestamps(conn)
+
+
+def _rebuild_rollups_from_text_timestamps(conn):
+    # rollups.rebuild() expects epoch logged_at, which only exists from migration 2
+    for table, size in (('activity_hourly', rollups.HOUR), ('activity_daily', rollups.DAY)):
+        conn.execute(f'''
+            INSERT INTO {table} (room_id, user_id, app_name, bucket, total_seconds)
+            SELECT room_id, user_id, app_name,
+                   CAST(strftime('%s', logged_at) AS INTEGER) / {size} * {size} AS bucket,
+                   SUM(duration_seconds)
+            FROM activity_logs
+            GROUP BY room_id, user_id, app_name, bucket
+        ''')
+
+
+# Text timestamp (as written by sqlite3's datetime adapter or CURRENT_TIMESTAMP) -> epoch seconds
+_EPOCH_OF = "CASE WHEN typeof({0}) = 'text' THEN CAST(strftime('%s', {0}) AS INTEGER) ELSE {0} END"
+_NOW = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+
+@migration(2)
+def epoch_timestamps(conn):
+    """room_members.last_seen and activity_logs.logged_at/ended_at become
+    INTEGER UTC epoch seconds. SQLite cannot change a column's type, so
+    both tables are rebuilt."""
+    conn.execute(f'''
+        CREATE TABLE room_members_new (
+            room_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            active_app TEXT,
+            last_seen INTEGER DEFAULT {_NOW},
+            focus_mode BOOLEAN DEFAULT 0,
+            PRIMARY KEY (room_id, user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO room_members_new (room_id, user_id, active_app, last_seen, focus_mode)
+        SELECT room_id, user_id, active_app, {_EPOCH_OF.format('last_seen')}, focus_mode
+        FROM room_members
+    ''')
+    conn.execute('DROP TABLE room_members')
+    conn.execute('ALTER TABLE room_members_new RENAME TO room_members')
+
+    conn.execute(f'''
+        CREATE TABLE activity_logs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            app_name TEXT NOT NULL,
+            duration_seconds INTEGER DEFAULT 5,
+            logged_at INTEGER DEFAULT {_NOW},
+            ended_at INTEGER,
+            FOREIGN KEY (room_id) REFERENCES rooms(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO activity_logs_new (id, room_id, user_id, app_name, duration_seconds, logged_at, ended_at)
+        SELECT id, room_id, user_id, app_name, duration_seconds,
+               {_EPOCH_OF.format('logged_at')}, {_EPOCH_OF.format('ended_at')}
+        FROM activity_logs
+    ''')
+    conn.execute('DROP TABLE activity_logs')
+    conn.execute('ALTER TABLE activity_logs_new RENAME TO activity_logs')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_logs_room_user
+        ON activity_logs(room_id, user_id, logged_at)
+    ''')
+
+
+@migration(3)
+def access_path_indexes(conn):
+    """Indexes for the queries in indexes.HOT_QUERIES (timings in
+    benchmarks/indexes.py).
+
+    - activity_logs(room_id, logged_at) replaces (room_id, user_id,
+      logged_at): /stats reads a room's rows by time range for all users.
+      duration_seconds stays out so extending a session never touches it.
+    - room_members(user_id, room_id) covers user_room_ids() and
+      memberships() (batch heartbeats), which used to scan the table.
+    - users(avatar_path), partial: replacing or deleting an avatar checks
+      whether another user still has it.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_logs_room_time ON activity_logs(room_id, logged_at)')
+    conn.execute('DROP INDEX IF EXISTS idx_activity_logs_room_user')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_room_members_user ON room_members(user_id, room_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_avatar ON users(avatar_path) WHERE avatar_path IS NOT NULL')
+
+
+@migration(4)
+def archive_ids(conn):
+    """Random per-user ids that activity archives are written under instead
+    of user ids (see retention.py); deleting an account drops its row."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_ids (
+            user_id TEXT PRIMARY KEY,
+            archive_id TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+@migration(5)
+def user_id_indexes(conn):
+    """user_id indexes on activity_logs and the rollups, so deleting an
+    account (repository.forget_member) no longer scans them.
+
+    Measured with benchmarks/indexes.py (1.2M activity rows, 5000 users),
+    forget_member goes from ~300 ms to ~5 ms. All of that time is spent
+    holding the write lock, which stalls heartbeats in every room of the
+    shard, and it grows with the activity kept. Activity flushes pay for
+    it by maintaining one more index per table. The first flush of an hour,
+    which starts new rollup buckets, goes from ~12 to ~33 ms; later flushes
+    go from ~12 to ~15 ms. That cost stays off the request path: the
+    activity buffer flushes in the background unless ACTIVITY_FLUSH_INTERVAL
+    is 0.
+
+    Dropping idx_activity_logs_room_user in migration 3 did not slow flushes:
+    with (room_id, user_id, logged_at) restored, they measure the same
+    9-15 ms from run to run.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_logs_user ON activity_logs(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_hourly_user ON activity_hourly(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_daily_user ON activity_daily(user_id)')
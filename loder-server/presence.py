@@ -0,0 +1,441 @@
+"""In-memory presence for room members.
+
+Heartbeats update (active_app, last_seen, focus_mode) here instead of in
+SQLite. Dirty entries are written to room_members in one transaction every
+PRESENCE_FLUSH_INTERVAL seconds, so a heartbeat costs no disk write.
+
+Member changes (join, leave, update, online, offline) bump a per-room
+version, are kept in a short per-room change log (for delta heartbeat
+responses) and are published to events.bus for streaming clients.
+
+Online status is state, not a per-read computation: each member carries an
+`online` flag, set by heartbeats (and roster loads) and cleared by the
+sweeper. Every online member is filed under the second its heartbeat
+expires in a timer wheel; the sweeper pops the seconds that have passed,
+flips the members still due offline and publishes 'offline' for them, so
+reads never compare timestamps and a sweep only touches expiring members.
+A member goes offline within one sweep interval of the threshold.
+
+Only rooms that exist are cached. Rosters nobody has read for
+PRESENCE_ROSTER_TTL, with no online or unflushed member, are evicted
+together with their version and change log (evict_idle), so probing random
+room ids cannot grow memory. Versions of an evicted room restart above
+every version it handed out, so old ones are never taken for current ones.
+"""
+import atexit
+import logging
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from config import OFFLINE_THRESHOLD_SECONDS, PRESENCE_FLUSH_INTERVAL, PRESENCE_ROSTER_TTL
+from database import db_connection, each_shard, room_connection, room_pool
+import avatars
+import events
+import repository
+from utils import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Changes remembered per room for delta responses; older clients get a full list
+ROOM_CHANGE_LOG_SIZE = 64
+# Minimum seconds between roster reloads caused by membership misses
+MEMBER_MISS_RELOAD_INTERVAL = 1
+# Seconds between sweeps of the timer wheel
+SWEEP_INTERVAL = 1
+
+
+class Member:
+    __slots__ = ('user_id', 'avatar_path', 'active_app', 'last_seen', 'focus_mode', 'online')
+
+    def __init__(self, user_id, avatar_path, active_app, last_seen, focus_mode, online=False):
+        self.user_id = user_id
+        self.avatar_path = avatar_path
+        self.active_app = active_app
+        self.last_seen = last_seen
+        self.focus_mode = focus_mode
+        self.online = online
+
+    def copy(self):
+        return Member(self.user_id, self.avatar_path, self.active_app, self.last_seen,
+                      self.focus_mode, self.online)
+
+    def expires_at(self):
+        """When (epoch seconds) the member goes offline without another heartbeat."""
+        if not self.last_seen:
+            return None
+        return self.last_seen + OFFLINE_THRESHOLD_SECONDS
+
+    def last_seen_text(self):
+        """last_seen as 'YYYY-MM-DD HH:MM:SS' UTC, for display."""
+        if not self.last_seen:
+            return None
+        return str(datetime.fromtimestamp(self.last_seen, timezone.utc).replace(tzinfo=None))
+
+    def expired(self, now):
+        expires_at = self.expires_at()
+        return expires_at is None or expires_at <= now
+
+    def view(self):
+        """Member as returned by heartbeat and pushed to event streams."""
+        return {
+            'userId': self.user_id,
+            'avatarPath': self.avatar_path,
+            'avatarVersion': avatars.version(self.avatar_path),
+            'activeApp': None if self.focus_mode else (self.active_app if self.online else None),
+            'isOnline': self.online,
+            'focusMode': self.focus_mode
+        }
+
+
+class PresenceStore:
+    def __init__(self, flush_interval=PRESENCE_FLUSH_INTERVAL, roster_ttl=PRESENCE_ROSTER_TTL):
+        self.flush_interval = flush_interval
+        self.roster_ttl = roster_ttl
+        self._lock = threading.Lock()
+        self._rooms = {}       # room_id -> {user_id: Member}
+        self._loaded_at = {}   # room_id -> monotonic time of last roster load
+        self._dirty = set()    # (room_id, user_id)
+        self._timers = {}      # second -> {(room_id, user_id)} expiring then
+        # Versions start at the process start time (ms) so a version seen
+        # from an earlier process is never mistaken for a current one, and
+        # above the versions of evicted rooms for the same reason
+        self._version_floor = int(time.time() * 1000)
+        self._versions = {}    # room_id -> version
+        self._changes = {}     # room_id -> deque of (version, user_id)
+        self._user_rooms = {}  # user_id -> (monotonic load time, [room_id])
+        self._flusher = PeriodicTask('presence-flush', flush_interval, self.flush)
+        self._sweeper = PeriodicTask('presence-sweep', SWEEP_INTERVAL, self.sweep)
+        self._evictor = PeriodicTask('presence-evict', max(roster_ttl, SWEEP_INTERVAL), self.evict_idle)
+
+    # Roster
+
+    def _load_room(self, room_id):
+        """The room's roster from SQLite, cached unless the room does not exist."""
+        with room_connection(room_id) as conn:
+            rows = repository.room_members(conn, room_id)
+            if not rows and not repository.get_room(conn, room_id):
+                return {}
+        with db_connection() as conn:
+            avatar_paths = repository.user_avatars(conn, [row.user_id for row in rows])
+
+        now = time.time()
+        changes = []
+        with self._lock:
+            previous = self._rooms.get(room_id)
+            current = previous or {}
+            # Member objects are reused below, so note their state before reloading
+            previous_state = {user_id: (m.avatar_path, m.online) for user_id, m in current.items()}
+            roster = {}
+            for row in rows:
+                if row.user_id not in avatar_paths:
+                    continue   # deleted through another worker
+                stored = Member(
+                    row.user_id,
+                    avatar_paths[row.user_id],
+                    row.active_app,
+                    row.last_seen,
+                    bool(row.focus_mode)
+                )
+                # Keep our own state if it is newer than what was flushed
+                mine = current.get(row.user_id)
+                if mine and mine.last_seen and (not stored.last_seen or mine.last_seen >= stored.last_seen):
+                    mine.avatar_path = stored.avatar_path
+                    stored = mine
+                elif not stored.expired(now):
+                    # Heartbeats that reached another worker
+                    stored.online = True
+                    self._schedule(room_id, stored)
+                roster[row.user_id] = stored
+            self._rooms[room_id] = roster
+            self._loaded_at[room_id] = time.monotonic()
+
+            # Joins, leaves, status and avatar changes made through other workers
+            if previous is not None:
+                for user_id, member in roster.items():
+                    if user_id not in previous_state:
+                        changes.append(('join', user_id, member.view()))
+                        continue
+                    avatar_path, online = previous_state[user_id]
+                    if online != member.online:
+                        changes.append(('online' if member.online else 'offline', user_id, member.view()))
+                    elif avatar_path != member.avatar_path:
+                        changes.append(('update', user_id, member.view()))
+                for user_id in previous_state.keys() - roster.keys():
+                    changes.append(('leave', user_id, {'userId': user_id}))
+
+        for event_type, user_id, data in changes:
+            self._publish(room_id, event_type, user_id, data)
+        if self._timers:
+            self._sweeper.ensure_started()
+        self._evictor.ensure_started()
+        return roster
+
+    def evict_idle(self):
+        """Drop rosters not loaded for roster_ttl and without online or
+        unflushed members, with their version, change log and timers.
+        Returns the number of rooms evicted."""
+        cutoff = time.monotonic() - self.roster_ttl
+        with self._lock:
+            busy = {room_id for room_id, _ in self._dirty}
+            idle = {
+                room_id for room_id, roster in self._rooms.items()
+                if self._loaded_at.get(room_id, 0) < cutoff and room_id not in busy
+                and not any(member.online for member in roster.values())
+            }
+            for room_id in idle:
+                del self._rooms[room_id]
+                self._loaded_at.pop(room_id, None)
+            # Rooms that published changes without being loaded are idle too
+            for room_id in (self._versions.keys() | self._changes.keys()) - self._rooms.keys():
+                version = self._versions.pop(room_id, None)
+                if version is not None:
+                    self._version_floor = max(self._version_floor, version + 1)
+                self._changes.pop(room_id, None)
+            if idle:
+                for keys in self._timers.values():
+                    keys.difference_update([key for key in keys if key[0] in idle])
+            for user_id, (loaded_at, _) in list(self._user_rooms.items()):
+                if loaded_at < cutoff:
+                    del self._user_rooms[user_id]
+        return len(idle)
+
+    # Versions and events
+
+    def _publish(self, room_id, event_type, user_id, data):
+        """Record a member change: bump the room version and notify streams."""
+        with self._lock:
+            version = self._versions.get(room_id, self._version_floor) + 1
+            self._versions[room_id] = version
+            log = self._changes.get(room_id)
+            if log is None:
+                log = self._changes[room_id] = deque(maxlen=ROOM_CHANGE_LOG_SIZE)
+            log.append((version, user_id))
+        events.bus.publish(room_id, event_type, data, version)
+
+    def version(self, room_id):
+        with self._lock:
+            return self._versions.get(room_id, self._version_floor)
+
+    def snapshot(self, room_id):
+        """(version, member views). The version is read first, so a change
+        racing with the snapshot is sent again rather than missed."""
+        version = self.version(room_id)
+        return version, [member.view() for member in self.members(room_id)]
+
+    def changes_since(self, room_id, since):
+        """Member changes after version `since`.
+
+        Returns (version, changed member views, removed user ids), or None if
+        `since` is unknown or too old and the caller should send everything.
+        """
+        self._roster(room_id)
+        with self._lock:
+            version = self._versions.get(room_id, self._version_floor)
+            if since == version:
+                return version, [], []
+            log = self._changes.get(room_id)
+            if since > version or not log or log[0][0] > since + 1:
+                return None
+            roster = self._rooms.get(room_id, {})
+            user_ids = {user_id for changed_at, user_id in log if changed_at > since}
+            changed = [roster[user_id].view() for user_id in user_ids if user_id in roster]
+            removed = [user_id for user_id in user_ids if user_id not in roster]
+            return version, changed, removed
+
+    def _roster(self, room_id, refresh=False):
+        with self._lock:
+            roster = self._rooms.get(room_id)
+            loaded_at = self._loaded_at.get(room_id)
+            fresh = roster is not None and loaded_at is not None and time.monotonic() - loaded_at < self.roster_ttl
+        if fresh and not refresh:
+            return roster
+        return self._load_room(room_id)
+
+    def is_member(self, room_id, user_id):
+        if user_id in self._roster(room_id):
+            return True
+        # The user may have joined through another worker since our last
+        # load; reload, but not more than once per MEMBER_MISS_RELOAD_INTERVAL
+        # so requests for non-members cannot turn into a query each. A room
+        # that was not cached after loading does not exist.
+        with self._lock:
+            loaded_at = self._loaded_at.get(room_id)
+        if loaded_at is None or time.monotonic() - loaded_at < MEMBER_MISS_RELOAD_INTERVAL:
+            return False
+        return user_id in self._roster(room_id, refresh=True)
+
+    def members(self, room_id):
+        """Snapshot of the room's members (copies, safe to read without the lock)."""
+        roster = self._roster(room_id)
+        with self._lock:
+            return [m.copy() for m in roster.values()]
+
+    def user_rooms(self, user_id):
+        """Ids of the rooms user_id is a member of, cached for roster_ttl."""
+        with self._lock:
+            cached = self._user_rooms.get(user_id)
+        if cached and time.monotonic() - cached[0] < self.roster_ttl:
+            return cached[1]
+        room_ids = []
+        for conn in each_shard():
+            room_ids.extend(repository.user_room_ids(conn, user_id))
+        with self._lock:
+            self._user_rooms[user_id] = (time.monotonic(), room_ids)
+        return room_ids
+
+    def invalidate(self, room_id):
+        """Force the next read of room_id to reload membership from SQLite."""
+        with self._lock:
+            self._loaded_at.pop(room_id, None)
+
+    def member_joined(self, room_id, user_id):
+        with self._lock:
+            loaded = room_id in self._rooms
+            self._user_rooms.pop(user_id, None)
+        # Reloading a loaded room publishes the join itself
+        roster = self._load_room(room_id)
+        with self._lock:
+            member = roster.get(user_id)
+            if member is None:
+                return
+            view = member.view()
+        if not loaded:
+            self._publish(room_id, 'join', user_id, view)
+
+    def remove_member(self, room_id, user_id):
+        with self._lock:
+            roster = self._rooms.get(room_id)
+            if roster:
+                roster.pop(user_id, None)
+            self._dirty.discard((room_id, user_id))
+            self._user_rooms.pop(user_id, None)
+        self._publish(room_id, 'leave', user_id, {'userId': user_id})
+
+    def refresh_user(self, user_id):
+        """Reload rooms containing user_id after their profile (avatar) changed."""
+        with self._lock:
+            room_ids = [room_id for room_id, roster in self._rooms.items() if user_id in roster]
+        for room_id in room_ids:
+            self._load_room(room_id)
+
+    def forget_user(self, user_id, room_ids=()):
+        with self._lock:
+            room_ids = set(room_ids) | {room_id for room_id, roster in self._rooms.items() if user_id in roster}
+            self._user_rooms.pop(user_id, None)
+        for room_id in room_ids:
+            self.remove_member(room_id, user_id)
+
+    # Heartbeats
+
+    def record(self, room_id, user_id, active_app, focus_mode, now):
+        """Store a heartbeat. Returns False if user_id is not a member."""
+        return bool(self.record_rooms([room_id], user_id, active_app, focus_mode, now))
+
+    def record_rooms(self, room_ids, user_id, active_app, focus_mode, now):
+        """Store one heartbeat in several rooms; they are written by the same
+        flush. Returns the rooms user_id is a member of."""
+        recorded = [room_id for room_id in room_ids
+                    if self._record(room_id, user_id, active_app, focus_mode, now)]
+        if not recorded:
+            return recorded
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._flusher.ensure_started()
+        self._sweeper.ensure_started()
+        return recorded
+
+    def _record(self, room_id, user_id, active_app, focus_mode, now):
+        if not self.is_member(room_id, user_id):
+            return False
+        focus_mode = bool(focus_mode)
+        with self._lock:
+            # The roster may have been evicted since is_member()
+            member = self._rooms.get(room_id, {}).get(user_id)
+            if member is None:
+                return False
+            was_online = member.online
+            changed = (member.active_app, member.focus_mode) != (active_app, focus_mode)
+            member.active_app = active_app
+            member.last_seen = now
+            member.focus_mode = focus_mode
+            member.online = True
+            self._dirty.add((room_id, user_id))
+            self._schedule(room_id, member)
+            view = member.view() if changed or not was_online else None
+
+        if view:
+            self._publish(room_id, 'update' if was_online else 'online', user_id, view)
+        return True
+
+    def _schedule(self, room_id, member):
+        """File an online member under the second it expires in. Called with
+        the lock held; entries left behind by later heartbeats are skipped
+        when their second comes up."""
+        second = math.floor(member.expires_at())
+        timers = self._timers.get(second)
+        if timers is None:
+            timers = self._timers[second] = set()
+        timers.add((room_id, member.user_id))
+
+    def sweep(self, now=None):
+        """Flip members whose heartbeats stopped offline and announce them."""
+        now = now or time.time()
+        current = math.floor(now)
+        expired = []
+        with self._lock:
+            # The wheel spans OFFLINE_THRESHOLD_SECONDS, so this is a short scan
+            due = [second for second in self._timers if second <= current]
+            for second in sorted(due):
+                for room_id, user_id in self._timers.pop(second):
+                    member = self._rooms.get(room_id, {}).get(user_id)
+                    if member is None or not member.online:
+                        continue
+                    if member.expired(now):
+                        member.online = False
+                        expired.append((room_id, member.view()))
+                    elif math.floor(member.expires_at()) <= current:
+                        # Due later within this second
+                        self._schedule(room_id, member)
+        for room_id, view in expired:
+            self._publish(room_id, 'offline', view['userId'], view)
+        return len(expired)
+
+    def flush(self):
+        """Write dirty entries to room_members, one transaction per shard."""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, set()
+            by_shard = {}   # pool -> (keys, rows)
+            for room_id, user_id in dirty:
+                member = self._rooms.get(room_id, {}).get(user_id)
+                if member:
+                    keys, rows = by_shard.setdefault(room_pool(room_id), (set(), []))
+                    keys.add((room_id, user_id))
+                    rows.append((member.active_app, member.last_seen, member.focus_mode,
+                                 room_id, user_id, member.last_seen))
+
+        written = 0
+        error = None
+        for shard_pool, (keys, rows) in by_shard.items():
+            try:
+                with db_connection(shard_pool) as conn:
+                    repository.update_presence(conn, rows)
+                    conn.commit()
+                written += len(rows)
+            except Exception as e:
+                with self._lock:
+                    self._dirty |= keys
+                logger.exception('Failed to flush %d presence entries', len(rows))
+                error = e
+        if error:
+            raise error
+        return written
+
+
+store = PresenceStore()
+atexit.register(store.flush)
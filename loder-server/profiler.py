@@ -0,0 +1,89 @@
+"""Opt-in sampling profiler for slow requests.
+
+With PROFILE_SLOW_REQUEST_MS > 0, every request registers its thread here
+(see metrics.RequestTracker). A background thread samples the stacks of
+registered threads every PROFILE_SAMPLE_INTERVAL seconds and counts them;
+when a request took longer than the threshold its counts are written to
+PROFILE_DIR as a folded stack file ("module:function;... count" per line),
+which flamegraph.pl and speedscope read directly. Threads that are not
+serving a request are never sampled, and with the threshold at 0 nothing
+runs at all.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from config import PROFILE_DIR, PROFILE_SAMPLE_INTERVAL, PROFILE_SLOW_REQUEST_MS
+from utils import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Profiles kept in PROFILE_DIR; later slow requests are not written
+MAX_PROFILES = 500
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    def __init__(self, threshold_ms=PROFILE_SLOW_REQUEST_MS, interval=PROFILE_SAMPLE_INTERVAL,
+                 directory=PROFILE_DIR):
+        self.threshold_ms = threshold_ms
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._active = {}   # thread id -> Counter of folded stacks
+        self._sampler = PeriodicTask('profiler', interval if threshold_ms > 0 else 0, self.sample)
+
+    @property
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def start(self):
+        """Start sampling the calling thread."""
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+        self._sampler.ensure_started()
+
+    def stop(self):
+        """Stop sampling the calling thread; returns its stack counts."""
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+
+    def sample(self):
+        with self._lock:
+            if not self._active:
+                return
+            thread_ids = list(self._active)
+        frames = sys._current_frames()
+        stacks = [(thread_id, _fold(frames[thread_id])) for thread_id in thread_ids if thread_id in frames]
+        with self._lock:
+            for thread_id, stack in stacks:
+                counts = self._active.get(thread_id)
+                if counts is not None:
+                    counts[stack] += 1
+
+    def finish(self, endpoint, seconds, samples):
+        """Write samples out if the request was slow. Returns the file path, if any."""
+        if not samples or seconds * 1000 < self.threshold_ms:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        if len(os.listdir(self.directory)) >= MAX_PROFILES:
+            logger.warning('%s holds %d profiles; not writing more', self.directory, MAX_PROFILES)
+            return None
+        name = f'{int(time.time() * 1000)}-{endpoint}-{int(seconds * 1000)}ms.folded'
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+profiler = SamplingProfiler()
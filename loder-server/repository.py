@@ -0,0 +1,263 @@
+"""Data access for users, rooms and memberships.
+
+Every query here has fixed SQL text (lists are passed as one JSON parameter
+and expanded with json_each), so sqlite3's per-connection statement cache
+is always hit. The statements that run per request or per flush are module
+constants (*_SQL), which indexes.py checks for usable indexes. Lookups that routes used to do one by one are combined into
+single queries, and results are small namedtuples instead of sqlite3.Row.
+
+User functions take a connection to DATABASE_PATH, room and membership
+functions one to the room's shard (see shards.py); no query spans both.
+"""
+import json
+import uuid
+from collections import namedtuple
+
+User = namedtuple('User', 'id device_id email name avatar_path created_at avatar_source_url')
+Room = namedtuple('Room', 'id created_by password max_members created_at')
+Member = namedtuple('Member', 'user_id active_app last_seen focus_mode')
+Profile = namedtuple('Profile', 'user_id avatar_path name email')
+JoinCheck = namedtuple('JoinCheck', 'password max_members is_member member_count')
+
+_USER_COLUMNS = 'id, device_id, email, name, avatar_path, created_at, avatar_source_url'
+
+# Users
+
+GET_USER_SQL = f'SELECT {_USER_COLUMNS} FROM users WHERE id = ?'
+GET_USER_BY_DEVICE_SQL = f'SELECT {_USER_COLUMNS} FROM users WHERE device_id = ?'
+GET_USER_BY_EMAIL_SQL = f'SELECT {_USER_COLUMNS} FROM users WHERE email = ?'
+
+
+def get_user(conn, user_id):
+    row = conn.execute(GET_USER_SQL, (user_id,)).fetchone()
+    return User._make(row) if row else None
+
+
+def get_user_by_device(conn, device_id):
+    row = conn.execute(GET_USER_BY_DEVICE_SQL, (device_id,)).fetchone()
+    return User._make(row) if row else None
+
+
+def get_user_by_email(conn, email):
+    row = conn.execute(GET_USER_BY_EMAIL_SQL, (email,)).fetchone()
+    return User._make(row) if row else None
+
+
+def user_exists(conn, user_id):
+    return conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+
+
+def create_user(conn, user_id, device_id, email=None, name=None, avatar_path=None):
+    conn.execute(
+        'INSERT INTO users (id, device_id, email, name, avatar_path) VALUES (?, ?, ?, ?, ?)',
+        (user_id, device_id, email, name, avatar_path)
+    )
+
+
+def update_user_profile(conn, user_id, name, avatar_path):
+    conn.execute('UPDATE users SET name = ?, avatar_path = ? WHERE id = ?', (name, avatar_path, user_id))
+
+
+def set_avatar_path(conn, user_id, avatar_path, source_url=None):
+    conn.execute('UPDATE users SET avatar_path = ?, avatar_source_url = ? WHERE id = ?',
+                 (avatar_path, source_url, user_id))
+
+
+def set_fetched_avatar(conn, user_id, avatar_path, source_url, expected_avatar_path):
+    """Store a downloaded picture unless the avatar changed meanwhile. Returns whether it did."""
+    cursor = conn.execute(
+        'UPDATE users SET avatar_path = ?, avatar_source_url = ? WHERE id = ? AND avatar_path IS ?',
+        (avatar_path, source_url, user_id, expected_avatar_path)
+    )
+    return cursor.rowcount > 0
+
+
+def users_with_avatars(conn):
+    """(user_id, avatar_path) for every user with an avatar set."""
+    return conn.execute('SELECT id, avatar_path FROM users WHERE avatar_path IS NOT NULL').fetchall()
+
+
+AVATAR_IN_USE_SQL = 'SELECT 1 FROM users WHERE avatar_path = ? LIMIT 1'
+
+
+def avatar_in_use(conn, avatar_path):
+    """Whether any user has avatar_path (content-addressed avatars can be shared)."""
+    return conn.execute(AVATAR_IN_USE_SQL, (avatar_path,)).fetchone() is not None
+
+
+USER_AVATARS_SQL = 'SELECT id, avatar_path FROM users WHERE id IN (SELECT value FROM json_each(?))'
+
+
+def user_avatars(conn, user_ids):
+    """{user_id: avatar_path} for the given users."""
+    rows = conn.execute(USER_AVATARS_SQL, (json.dumps(list(user_ids)),)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+USER_PROFILES_SQL = '''
+    SELECT u.id, u.avatar_path, u.name, u.email
+    FROM json_each(?) ids
+    JOIN users u ON u.id = ids.value
+    ORDER BY ids.key
+'''
+
+
+def user_profiles(conn, user_ids):
+    """Profiles of the given users, in the same order (unknown ids left out)."""
+    rows = conn.execute(USER_PROFILES_SQL, (json.dumps(list(user_ids)),)).fetchall()
+    return [Profile._make(row) for row in rows]
+
+
+DELETE_USER_SQL = (
+    'DELETE FROM users WHERE id = ?',
+    'DELETE FROM archive_ids WHERE user_id = ?',
+)
+
+
+def delete_user(conn, user_id):
+    for sql in DELETE_USER_SQL:
+        conn.execute(sql, (user_id,))
+
+
+def archive_ids(conn, user_ids):
+    """{user_id: archive id} for the activity archives (see retention.py).
+
+    Archive ids are random and archive_ids is the only link back to a user,
+    so delete_user() unlinks everything archived under one. Only existing
+    users get a stored id; anyone else (anonymized activity, or an account
+    deleted since the rows were read) gets a fresh id that is never stored.
+    """
+    user_ids = sorted(set(user_ids))
+    conn.executemany('''
+        INSERT OR IGNORE INTO archive_ids (user_id, archive_id)
+        SELECT id, ? FROM users WHERE id = ?
+    ''', [(uuid.uuid4().hex, user_id) for user_id in user_ids])
+    stored = dict(conn.execute('''
+        SELECT a.user_id, a.archive_id
+        FROM json_each(?) ids JOIN archive_ids a ON a.user_id = ids.value
+    ''', (json.dumps(user_ids),)).fetchall())
+    return {user_id: stored.get(user_id) or uuid.uuid4().hex for user_id in user_ids}
+
+
+FORGET_ACTIVITY_SQL = (
+    'UPDATE activity_logs SET user_id = ? WHERE user_id = ?',
+    'UPDATE activity_hourly SET user_id = ? WHERE user_id = ?',
+    'UPDATE activity_daily SET user_id = ? WHERE user_id = ?',
+)
+FORGET_MEMBERSHIPS_SQL = 'DELETE FROM room_members WHERE user_id = ?'
+
+
+def forget_member(conn, user_id, anon_id):
+    """Remove a deleted user from the rooms in this shard, keeping their
+    activity under anon_id. Returns affected room ids."""
+    room_ids = user_room_ids(conn, user_id)
+    for sql in FORGET_ACTIVITY_SQL:
+        conn.execute(sql, (anon_id, user_id))
+    conn.execute(FORGET_MEMBERSHIPS_SQL, (user_id,))
+    return room_ids
+
+# Rooms
+
+GET_ROOM_SQL = 'SELECT id, created_by, password, max_members, created_at FROM rooms WHERE id = ?'
+
+
+def get_room(conn, room_id):
+    row = conn.execute(GET_ROOM_SQL, (room_id,)).fetchone()
+    return Room._make(row) if row else None
+
+
+def room_exists(conn, room_id):
+    return conn.execute('SELECT 1 FROM rooms WHERE id = ?', (room_id,)).fetchone() is not None
+
+
+def create_room(conn, room_id, created_by, password_hash, max_members, at):
+    conn.execute(
+        'INSERT INTO rooms (id, created_by, password, max_members) VALUES (?, ?, ?, ?)',
+        (room_id, created_by, password_hash, max_members)
+    )
+    add_member(conn, room_id, created_by, at)
+
+
+JOIN_CHECK_SQL = '''
+    SELECT r.password, r.max_members,
+           EXISTS (SELECT 1 FROM room_members WHERE room_id = r.id AND user_id = :user_id),
+           (SELECT COUNT(*) FROM room_members WHERE room_id = r.id)
+    FROM rooms r
+    WHERE r.id = :room_id
+'''
+
+
+def join_check(conn, room_id, user_id):
+    """Everything join_room needs from the room's shard in one query; None if
+    the room does not exist."""
+    row = conn.execute(JOIN_CHECK_SQL, {'room_id': room_id, 'user_id': user_id}).fetchone()
+    if not row:
+        return None
+    return JoinCheck(row[0], row[1], bool(row[2]), row[3])
+
+# Memberships
+
+def is_member(conn, room_id, user_id):
+    return conn.execute(
+        'SELECT 1 FROM room_members WHERE room_id = ? AND user_id = ?', (room_id, user_id)
+    ).fetchone() is not None
+
+
+MEMBERSHIPS_SQL = '''
+    SELECT room_id FROM room_members
+    WHERE user_id = ? AND room_id IN (SELECT value FROM json_each(?))
+'''
+
+
+def memberships(conn, user_id, room_ids):
+    """Subset of room_ids that user_id is a member of."""
+    rows = conn.execute(MEMBERSHIPS_SQL, (user_id, json.dumps(list(room_ids)))).fetchall()
+    return {row[0] for row in rows}
+
+
+USER_ROOM_IDS_SQL = 'SELECT room_id FROM room_members WHERE user_id = ?'
+
+
+def user_room_ids(conn, user_id):
+    return [row[0] for row in conn.execute(USER_ROOM_IDS_SQL, (user_id,))]
+
+
+def add_member(conn, room_id, user_id, at):
+    conn.execute(
+        'INSERT INTO room_members (room_id, user_id, active_app, last_seen) VALUES (?, ?, ?, ?)',
+        (room_id, user_id, None, at)
+    )
+
+
+REMOVE_MEMBER_SQL = 'DELETE FROM room_members WHERE room_id = ? AND user_id = ?'
+
+
+def remove_member(conn, room_id, user_id):
+    conn.execute(REMOVE_MEMBER_SQL, (room_id, user_id))
+
+
+ROOM_MEMBERS_SQL = 'SELECT user_id, active_app, last_seen, focus_mode FROM room_members WHERE room_id = ?'
+
+
+def room_members(conn, room_id):
+    rows = conn.execute(ROOM_MEMBERS_SQL, (room_id,)).fetchall()
+    return [Member._make(row) for row in rows]
+
+
+def member_ids(conn, room_id):
+    return [row[0] for row in conn.execute('SELECT user_id FROM room_members WHERE room_id = ?', (room_id,))]
+
+
+UPDATE_PRESENCE_SQL = '''
+    UPDATE room_members
+    SET active_app = ?, last_seen = ?, focus_mode = ?
+    WHERE room_id = ? AND user_id = ? AND (last_seen IS NULL OR last_seen <= ?)
+'''
+
+
+def update_presence(conn, rows):
+    """rows: (active_app, last_seen, focus_mode, room_id, user_id, last_seen).
+
+    Never overwrites a newer heartbeat written by another worker.
+    """
+    conn.executemany(UPDATE_PRESENCE_SQL, rows)
@@ -0,0 +1,219 @@
+"""Retention for activity data.
+
+activity_logs rows are only needed for recent stats: /stats reads the
+rollups (see rollups.py) and touches raw rows only for the partial hour a
+week-long period starts in. apply() keeps the hot database small:
+
+- activity_logs rows older than ACTIVITY_RETENTION_DAYS (whole UTC days)
+  are appended to ACTIVITY_ARCHIVE_DIR/activity-YYYY-MM.jsonl.gz, one JSON
+  object per row, and then deleted. Archive files are written before the
+  rows are deleted, so a crash in between can only duplicate rows (they
+  carry their id).
+- Archived rows name their user by archive_user_id, a random id from the
+  archive_ids table (repository.archive_ids), never by user_id. Deleting
+  an account deletes its archive id, after which its archived activity is
+  as anonymous as the anonymized rows in the database. Archives written
+  before archive ids existed are rewritten once (pseudonymize_archives).
+- activity_hourly rows older than HOURLY_ROLLUP_RETENTION_DAYS are deleted;
+  activity_daily keeps their totals, so 'all' stats are unchanged.
+- Freed pages are returned to the filesystem with incremental_vacuum.
+
+Every delete and vacuum step is a short transaction of at most
+RETENTION_BATCH_SIZE rows, so heartbeats and the activity buffer are never
+locked out for long.
+"""
+import fcntl
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from config import (
+    ACTIVITY_ARCHIVE_DIR, ACTIVITY_RETENTION_DAYS, DATA_DIR, HOURLY_ROLLUP_RETENTION_DAYS,
+    RETENTION_BATCH_SIZE, RETENTION_INTERVAL,
+)
+import repository
+from database import db_connection, pool, shard_pools
+from rollups import DAY
+from utils import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# /stats?period=week reads raw rows and hourly rollups up to 8 days back
+MIN_RETENTION_DAYS = 8
+# Pause between batches, letting other writers take the lock
+BATCH_PAUSE = 0.01
+# Pages released per incremental_vacuum step
+VACUUM_STEP_PAGES = 256
+
+_ARCHIVE_COLUMNS = ('id', 'room_id', 'user_id', 'app_name', 'duration_seconds', 'logged_at', 'ended_at')
+_USER = _ARCHIVE_COLUMNS.index('user_id')
+ARCHIVE_BATCH_SQL = f'''
+    SELECT {', '.join(_ARCHIVE_COLUMNS)} FROM activity_logs
+    WHERE logged_at < ? ORDER BY id LIMIT ?
+'''
+DROP_HOURLY_BATCH_SQL = '''
+    DELETE FROM activity_hourly
+    WHERE (room_id, bucket, user_id, app_name) IN (
+        SELECT room_id, bucket, user_id, app_name FROM activity_hourly
+        WHERE bucket < ? LIMIT ?
+    )
+'''
+# Present once the archives hold no user ids (see pseudonymize_archives)
+_PSEUDONYMIZED_MARKER = '.archive-ids'
+
+
+def _cutoff(days, now):
+    """Start of the UTC day `days` days before now (epoch seconds), or None to keep everything."""
+    if days <= 0:
+        return None
+    days = max(days, MIN_RETENTION_DAYS)
+    return (int(now) - days * DAY) // DAY * DAY
+
+
+def archive_path(logged_at):
+    month = datetime.fromtimestamp(logged_at, timezone.utc).strftime('%Y-%m')
+    return os.path.join(ACTIVITY_ARCHIVE_DIR, f'activity-{month}.jsonl.gz')
+
+
+def _archived(row, archive_ids):
+    record = dict(zip(_ARCHIVE_COLUMNS, row))
+    record['archive_user_id'] = archive_ids[record.pop('user_id')]
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def _write_archive(rows, archive_ids):
+    by_file = {}
+    for row in rows:
+        by_file.setdefault(archive_path(row[5]), []).append(row)
+    os.makedirs(ACTIVITY_ARCHIVE_DIR, exist_ok=True)
+    for path, file_rows in by_file.items():
+        # Each append is a new gzip member; readers see one stream
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for row in file_rows:
+                f.write(_archived(row, archive_ids))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def archive_activity(conn, users_conn, cutoff, batch_size=RETENTION_BATCH_SIZE):
+    """Move activity_logs rows logged before `cutoff` to the archive. Returns
+    rows moved. users_conn is a connection to DATABASE_PATH, for archive ids."""
+    moved = 0
+    while True:
+        rows = conn.execute(ARCHIVE_BATCH_SQL, (cutoff, batch_size)).fetchall()
+        if not rows:
+            return moved
+        archive_ids = repository.archive_ids(users_conn, [row[_USER] for row in rows])
+        users_conn.commit()
+        _write_archive([tuple(row) for row in rows], archive_ids)
+        conn.execute('DELETE FROM activity_logs WHERE id IN (SELECT value FROM json_each(?))',
+                     (json.dumps([row[0] for row in rows]),))
+        conn.commit()
+        moved += len(rows)
+        time.sleep(BATCH_PAUSE)
+
+
+def pseudonymize_archives(users_conn):
+    """Replace user_id with archive_user_id in archives written before
+    archive ids existed. Runs once per ACTIVITY_ARCHIVE_DIR; returns the
+    number of files rewritten."""
+    os.makedirs(ACTIVITY_ARCHIVE_DIR, exist_ok=True)
+    marker = os.path.join(ACTIVITY_ARCHIVE_DIR, _PSEUDONYMIZED_MARKER)
+    if os.path.exists(marker):
+        return 0
+    rewritten = 0
+    for name in sorted(os.listdir(ACTIVITY_ARCHIVE_DIR)):
+        if not (name.startswith('activity-') and name.endswith('.jsonl.gz')):
+            continue
+        path = os.path.join(ACTIVITY_ARCHIVE_DIR, name)
+        # Two streaming passes: archives can be larger than memory
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            user_ids = {record['user_id'] for record in map(json.loads, f) if 'user_id' in record}
+        if not user_ids:
+            continue
+        archive_ids = repository.archive_ids(users_conn, user_ids)
+        users_conn.commit()
+        with gzip.open(path, 'rt', encoding='utf-8') as f, gzip.open(path + '.tmp', 'wt', encoding='utf-8') as out:
+            for record in map(json.loads, f):
+                if 'user_id' in record:
+                    record['archive_user_id'] = archive_ids[record.pop('user_id')]
+                out.write(json.dumps(record, separators=(',', ':')) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(path + '.tmp', path)
+        rewritten += 1
+    with open(marker, 'w'):
+        pass
+    if rewritten:
+        logger.info('Replaced user ids in %d activity archive files', rewritten)
+    return rewritten
+
+
+def drop_hourly_rollups(conn, cutoff, batch_size=RETENTION_BATCH_SIZE):
+    """Delete activity_hourly buckets before `cutoff`. Returns rows deleted."""
+    deleted = 0
+    while True:
+        cursor = conn.execute(DROP_HOURLY_BATCH_SQL, (cutoff, batch_size))
+        conn.commit()
+        if cursor.rowcount <= 0:
+            return deleted
+        deleted += cursor.rowcount
+        time.sleep(BATCH_PAUSE)
+
+
+def incremental_vacuum(conn, step_pages=VACUUM_STEP_PAGES):
+    """Release free pages a step at a time. Returns pages released, or None
+    if the database was not created with auto_vacuum=INCREMENTAL."""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return None
+    released = 0
+    while True:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            return released
+        # sqlite3's execute() would step the pragma once, freeing a single page
+        conn.executescript(f'PRAGMA incremental_vacuum({step_pages});')
+        released += min(free, step_pages)
+        time.sleep(BATCH_PAUSE)
+
+
+def apply(now=None):
+    """Apply the retention policy once. Returns a summary dict."""
+    now = time.time() if now is None else now
+    activity_cutoff = _cutoff(ACTIVITY_RETENTION_DAYS, now)
+    hourly_cutoff = _cutoff(HOURLY_ROLLUP_RETENTION_DAYS, now)
+    summary = {'archived': 0, 'hourlyDeleted': 0, 'pagesReleased': None}
+    if activity_cutoff is not None:
+        with db_connection(pool) as users_conn:
+            pseudonymize_archives(users_conn)
+    # Every shard, then the users database for its own free pages
+    for target in dict.fromkeys(shard_pools + [pool]):
+        with db_connection(target) as conn:
+            if target in shard_pools:
+                if activity_cutoff is not None:
+                    with db_connection(pool) as users_conn:
+                        summary['archived'] += archive_activity(conn, users_conn, activity_cutoff)
+                if hourly_cutoff is not None:
+                    summary['hourlyDeleted'] += drop_hourly_rollups(conn, hourly_cutoff)
+            released = incremental_vacuum(conn)
+            if released is not None:
+                summary['pagesReleased'] = (summary['pagesReleased'] or 0) + released
+    return summary
+
+
+def _apply_in_background():
+    # One worker at a time; the others skip this round
+    with open(os.path.join(DATA_DIR, 'retention.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        summary = apply()
+        if summary['archived'] or summary['hourlyDeleted']:
+            logger.info('Retention: %s', summary)
+
+
+task = PeriodicTask('retention', RETENTION_INTERVAL, _apply_in_background)
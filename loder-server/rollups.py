@@ -0,0 +1,104 @@
+"""Hourly and daily activity rollups.
+
+activity_hourly and activity_daily hold SUM(duration_seconds) per
+(room, user, app, bucket), where bucket is the UTC epoch second the hour or
+day starts at. They are updated in the same transaction that writes
+activity_logs (see activity.py), so /stats never has to scan raw rows.
+"""
+import calendar
+
+HOUR = 3600
+DAY = 86400
+
+UPSERT_SQL = '''
+    INSERT INTO {table} (room_id, user_id, app_name, bucket, total_seconds)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (room_id, user_id, app_name, bucket)
+    DO UPDATE SET total_seconds = total_seconds + excluded.total_seconds
+'''
+
+
+def epoch(at):
+    """Naive UTC datetime -> epoch seconds."""
+    return calendar.timegm(at.timetuple())
+
+
+def hour_bucket(at):
+    """Epoch seconds -> start of its hour."""
+    return at // HOUR * HOUR
+
+
+def add(cursor, deltas):
+    """Add {(room_id, user_id, app_name, hour_bucket): seconds} to both rollups."""
+    if not deltas:
+        return
+    hourly = [key + (seconds,) for key, seconds in deltas.items()]
+    daily = {}
+    for (room_id, user_id, app_name, bucket), seconds in deltas.items():
+        key = (room_id, user_id, app_name, bucket // DAY * DAY)
+        daily[key] = daily.get(key, 0) + seconds
+    cursor.executemany(UPSERT_SQL.format(table='activity_hourly'), hourly)
+    cursor.executemany(UPSERT_SQL.format(table='activity_daily'),
+                       [key + (seconds,) for key, seconds in daily.items()])
+
+
+def rebuild(conn):
+    """Recompute both rollups from activity_logs in one transaction.
+
+    Buckets before the oldest remaining row are left alone: their raw rows
+    may have been archived (see retention.py), which removes whole days.
+    With no rows left there is nothing to recompute.
+    """
+    cursor = conn.cursor()
+    oldest = cursor.execute('SELECT MIN(logged_at) FROM activity_logs').fetchone()[0]
+    if oldest is None:
+        return
+    for table, size in (('activity_hourly', HOUR), ('activity_daily', DAY)):
+        cursor.execute(f'DELETE FROM {table} WHERE bucket >= ?', (oldest // size * size,))
+        cursor.execute(f'''
+            INSERT INTO {table} (room_id, user_id, app_name, bucket, total_seconds)
+            SELECT room_id, user_id, app_name,
+                   logged_at / {size} * {size} AS bucket,
+                   SUM(duration_seconds)
+            FROM activity_logs
+            GROUP BY room_id, user_id, app_name, bucket
+        ''')
+    conn.commit()
+
+
+def period_source(room_id, start_time, today_start):
+    """SQL yielding (user_id, app_name, bucket, total_seconds) since start_time.
+
+    The range is split so each row is as coarse as possible while rows from
+    today stay hourly (for the timeline):
+
+        activity_logs    [start, first hour)     partial leading hour only
+        activity_hourly  [first hour, first day)
+        activity_daily   [first day, today)
+        activity_hourly  [today, ...)
+
+    Returns (sql, params).
+    """
+    start = epoch(start_time)
+    today = epoch(today_start)
+    first_hour = -(-start // HOUR) * HOUR
+    first_day = min(-(-start // DAY) * DAY, today)
+
+    parts = []
+    params = ()
+    if first_hour != start:
+        parts.append('SELECT user_id, app_name, ? AS bucket, duration_seconds AS total_seconds FROM activity_logs '
+                     'WHERE room_id = ? AND logged_at >= ? AND logged_at < ?')
+        params += (first_hour - HOUR, room_id, start, first_hour)
+    if first_hour < first_day:
+        parts.append('SELECT user_id, app_name, bucket, total_seconds FROM activity_hourly '
+                     'WHERE room_id = ? AND bucket >= ? AND bucket < ?')
+        params += (room_id, first_hour, first_day)
+    if first_day < today:
+        parts.append('SELECT user_id, app_name, bucket, total_seconds FROM activity_daily '
+                     'WHERE room_id = ? AND bucket >= ? AND bucket < ?')
+        params += (room_id, first_day, today)
+    parts.append('SELECT user_id, app_name, bucket, total_seconds FROM activity_hourly '
+                 'WHERE room_id = ? AND bucket >= ?')
+    params += (room_id, max(first_hour, today))
+    return '\nUNION ALL\n'.join(parts), params
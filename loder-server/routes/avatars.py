@@ -0,0 +1,71 @@
+from datetime import datetime, timezone
+from flask import Blueprint, Response, request, jsonify, send_file
+import avatars
+from config import AVATAR_ACCEL_REDIRECT, AVATAR_SENDFILE
+
+avatars_bp = Blueprint('avatars', __name__)
+
+# Content-addressed URLs never change meaning, so clients may keep them forever
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def requested_size():
+    """?size= as an int (None if absent). Raises ValueError if malformed."""
+    value = request.args.get('size')
+    if value is None:
+        return None
+    size = int(value)
+    if size <= 0:
+        raise ValueError(value)
+    return size
+
+
+def send_avatar(avatar_path, size, immutable):
+    """Response for avatar_path at the variant closest to `size`, or None if missing.
+
+    File metadata and small files come from avatars.cache. Responses carry a
+    strong ETag and Last-Modified and answer conditional requests with 304;
+    immutable=True adds long-lived cache headers, for URLs that name the
+    content hash. With AVATAR_ACCEL_REDIRECT or AVATAR_SENDFILE set, the
+    front proxy sends the bytes.
+    """
+    entry = avatars.cache.file(avatar_path, size)
+    if entry is None:
+        return None
+
+    if AVATAR_ACCEL_REDIRECT:
+        response = Response(mimetype=entry.mimetype)
+        response.headers['X-Accel-Redirect'] = AVATAR_ACCEL_REDIRECT.rstrip('/') + '/' + entry.filename
+    elif AVATAR_SENDFILE:
+        response = Response(mimetype=entry.mimetype)
+        response.headers['X-Sendfile'] = entry.path
+    elif entry.data is not None:
+        response = Response(entry.data, mimetype=entry.mimetype)
+    else:
+        response = send_file(entry.path, mimetype=entry.mimetype, etag=False, conditional=False)
+
+    response.set_etag(entry.etag)
+    response.last_modified = datetime.fromtimestamp(entry.mtime, timezone.utc)
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@avatars_bp.route('/<avatar_path>', methods=['GET'])
+def get_avatar_file(avatar_path):
+    """Avatar by content-addressed name, e.g. /avatars/<hash>.webp?size=64"""
+    if not avatars.parse_name(avatar_path):
+        return jsonify({'error': 'Avatar not found'}), 404
+    try:
+        size = requested_size()
+    except ValueError:
+        return jsonify({'error': 'Invalid size'}), 400
+
+    response = send_avatar(avatar_path, size, immutable=True)
+    if response is None:
+        return jsonify({'error': 'Avatar not found'}), 404
+    return response
@@ -0,0 +1,63 @@
+import time
+from flask import Blueprint, request, jsonify
+import activity
+import sessions
+from presence import store as presence
+from routes.rooms import heartbeat_members
+
+heartbeat_bp = Blueprint('heartbeat', __name__)
+
+# Most room ids one request may name in 'roomIds'
+MAX_ROOM_IDS = 50
+
+@heartbeat_bp.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    """One heartbeat for every room the user is in.
+
+    Takes the same fields as /rooms/<room_id>/heartbeat, plus optional
+    'roomIds' (defaults to all of the user's rooms) and 'sinceVersions'
+    ({roomId: version}). Responds with {'rooms': {roomId: members part}};
+    requested rooms the user is not a member of are listed in 'notMember'.
+    Requested ids are checked against the user's memberships (one query per
+    shard, cached) before any room's roster is loaded.
+    """
+    data = request.get_json() or {}
+    user_id = sessions.request_user_id(data.get('userId'))
+    if not user_id:
+        return jsonify({'error': 'userId is required'}), 400
+
+    room_ids = data.get('roomIds')
+    if room_ids is not None:
+        if not isinstance(room_ids, list) or not all(isinstance(r, str) for r in room_ids):
+            return jsonify({'error': 'roomIds must be a list of room ids'}), 400
+        if len(room_ids) > MAX_ROOM_IDS:
+            return jsonify({'error': f'roomIds takes at most {MAX_ROOM_IDS} rooms'}), 400
+    user_room_ids = presence.user_rooms(user_id)
+    if room_ids is None:
+        room_ids = user_room_ids
+    room_ids = list(dict.fromkeys(room_ids))
+    member_of = set(user_room_ids)
+
+    active_app = data.get('activeApp')
+    focus_mode = data.get('focusMode', False)
+    include_members = data.get('includeMembers', True)
+    since_versions = data.get('sinceVersions')
+    if not isinstance(since_versions, dict):
+        since_versions = {}
+
+    # Presence and activity for all rooms go out in the same background flushes
+    now = int(time.time())
+    recorded = presence.record_rooms([room_id for room_id in room_ids if room_id in member_of],
+                                     user_id, active_app, focus_mode, now)
+    if active_app and not focus_mode:
+        activity.buffer.add_rooms(recorded, user_id, active_app, 5, now)  # 5 seconds per heartbeat
+
+    response = {}
+    if include_members:
+        response['rooms'] = {room_id: heartbeat_members(room_id, since_versions.get(room_id))
+                             for room_id in recorded}
+    else:
+        response['status'] = 'ok'
+    if len(recorded) < len(room_ids):
+        response['notMember'] = [room_id for room_id in room_ids if room_id not in recorded]
+    return jsonify(response)
@@ -1,15 +1,24 @@
 import uuid
 import hashlib
+import time
 from datetime import datetime, timedelta
-from flask import Blueprint, request, jsonify
-from database import get_db
+from flask import Blueprint, Response, request, jsonify
+import activity
+import avatars
+import events
+import repository
+import sessions
+import stats
+from database import get_db, get_room_db
+from presence import store as presence
 from utils import generate_room_id
 
 rooms_bp = Blueprint('rooms', __name__)
 
-# Users are considered offline after 15 seconds without heartbeat
-OFFLINE_THRESHOLD_SECONDS = 15
 MAX_MEMBERS_PER_ROOM = 10
+EVENTS_KEEPALIVE_SECONDS = 15
+# Sent with the 503 when no more event streams can be opened
+EVENTS_RETRY_AFTER_SECONDS = 30
 
 def hash_password(password):
     """Simple password hashing"""
@@ -19,259 +28,227 @@ def hash_password(password):
 
 @rooms_bp.route('/create', methods=['POST'])
 def create_room():
-    data = request.get_json()
-    if not data or 'userId' not in data:
+    data = request.get_json() or {}
+    user_id = sessions.request_user_id(data.get('userId'))
+    if not user_id:
         return jsonify({'error': 'userId is required'}), 400
 
-    user_id = data['userId']
     password = data.get('password')  # Optional password
 
-    conn = get_db()
-    cursor = conn.cursor()
-
-    # Check if user exists
-    cursor.execute('SELECT id FROM users WHERE id = ?', (user_id,))
-    if not cursor.fetchone():
-        conn.close()
+    if not repository.user_exists(get_db(), user_id):
         return jsonify({'error': 'User not found'}), 404
 
-    # Generate unique room ID
-    for _ in range(10):  # Try up to 10 times to get unique ID
-        room_id = generate_room_id()
-        cursor.execute('SELECT id FROM rooms WHERE id = ?', (room_id,))
-        if not cursor.fetchone():
-            break
-    else:
-        conn.close()
+    # Try up to 10 IDs to get a unique one; each is checked in its own shard
+    candidates = (generate_room_id() for _ in range(10))
+    room_id = next((c for c in candidates if not repository.room_exists(get_room_db(c), c)), None)
+    if not room_id:
         return jsonify({'error': 'Failed to generate unique room ID'}), 500
 
-    # Create room with optional password
+    # Create room with optional password and add creator as member
+    conn = get_room_db(room_id)
     password_hash = hash_password(password) if password else None
-    cursor.execute(
-        'INSERT INTO rooms (id, created_by, password, max_members) VALUES (?, ?, ?, ?)',
-        (room_id, user_id, password_hash, MAX_MEMBERS_PER_ROOM)
-    )
-
-    # Add creator as member
-    cursor.execute(
-        'INSERT INTO room_members (room_id, user_id, active_app, last_seen) VALUES (?, ?, ?, ?)',
-        (room_id, user_id, None, datetime.utcnow())
-    )
-
+    repository.create_room(conn, room_id, user_id, password_hash, MAX_MEMBERS_PER_ROOM, int(time.time()))
     conn.commit()
-    conn.close()
+    presence.invalidate(room_id)
 
     return jsonify({'roomId': room_id, 'hasPassword': bool(password)}), 201
 
 @rooms_bp.route('/<room_id>/join', methods=['POST'])
 def join_room(room_id):
-    data = request.get_json()
-    if not data or 'userId' not in data:
+    data = request.get_json() or {}
+    user_id = sessions.request_user_id(data.get('userId'))
+    if not user_id:
         return jsonify({'error': 'userId is required'}), 400
 
-    user_id = data['userId']
     password = data.get('password')
 
-    conn = get_db()
-    cursor = conn.cursor()
+    conn = get_room_db(room_id)
 
-    # Check if room exists and get password
-    cursor.execute('SELECT id, password, max_members FROM rooms WHERE id = ?', (room_id,))
-    room = cursor.fetchone()
-    if not room:
-        conn.close()
+    # Room, membership and member count in one query
+    check = repository.join_check(conn, room_id, user_id)
+    if not check:
         return jsonify({'error': 'Room not found'}), 404
 
     # Check password if room is protected
-    if room['password']:
+    if check.password:
         if not password:
-            conn.close()
             return jsonify({'error': 'Password required', 'passwordRequired': True}), 401
-        if hash_password(password) != room['password']:
-            conn.close()
+        if hash_password(password) != check.password:
             return jsonify({'error': 'Wrong password'}), 401
 
-    # Check if user exists
-    cursor.execute('SELECT id FROM users WHERE id = ?', (user_id,))
-    if not cursor.fetchone():
-        conn.close()
+    if not repository.user_exists(get_db(), user_id):
         return jsonify({'error': 'User not found'}), 404
 
-    # Check if already a member
-    cursor.execute(
-        'SELECT room_id FROM room_members WHERE room_id = ? AND user_id = ?',
-        (room_id, user_id)
-    )
-    if cursor.fetchone():
-        conn.close()
+    if check.is_member:
         return jsonify({'message': 'Already a member'})
 
     # Check member count limit
-    cursor.execute('SELECT COUNT(*) as count FROM room_members WHERE room_id = ?', (room_id,))
-    member_count = cursor.fetchone()['count']
-    max_members = room['max_members'] or MAX_MEMBERS_PER_ROOM
-    if member_count >= max_members:
-        conn.close()
+    max_members = check.max_members or MAX_MEMBERS_PER_ROOM
+    if check.member_count >= max_members:
         return jsonify({'error': f'Room is full (max {max_members} members)'}), 403
 
     # Add as member
-    cursor.execute(
-        'INSERT INTO room_members (room_id, user_id, active_app, last_seen) VALUES (?, ?, ?, ?)',
-        (room_id, user_id, None, datetime.utcnow())
-    )
-
+    repository.add_member(conn, room_id, user_id, int(time.time()))
     conn.commit()
-    conn.close()
+    presence.member_joined(room_id, user_id)
 
     return jsonify({'message': 'Joined room successfully'})
 
 @rooms_bp.route('/<room_id>/leave', methods=['POST'])
 def leave_room(room_id):
-    data = request.get_json()
-    if not data or 'userId' not in data:
+    data = request.get_json() or {}
+    user_id = sessions.request_user_id(data.get('userId'))
+    if not user_id:
         return jsonify({'error': 'userId is required'}), 400
 
-    user_id = data['userId']
-    conn = get_db()
-    cursor = conn.cursor()
+    # Non-members would otherwise publish a 'leave' to the room's streams
+    if not presence.is_member(room_id, user_id):
+        return jsonify({'error': 'Not a member of this room'}), 403
 
-    # Remove from room
-    cursor.execute(
-        'DELETE FROM room_members WHERE room_id = ? AND user_id = ?',
-        (room_id, user_id)
-    )
+    conn = get_room_db(room_id)
 
+    # Remove from room
+    repository.remove_member(conn, room_id, user_id)
     conn.commit()
-    conn.close()
+    presence.remove_member(room_id, user_id)
 
     return jsonify({'message': 'Left room successfully'})
 
 @rooms_bp.route('/<room_id>', methods=['GET'])
 def get_room(room_id):
-    conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT id, created_by, created_at FROM rooms WHERE id = ?', (room_id,))
-    room = cursor.fetchone()
-
+    room = repository.get_room(get_room_db(room_id), room_id)
     if not room:
-        conn.close()
         return jsonify({'error': 'Room not found'}), 404
 
     # Get members with their info
-    threshold = datetime.utcnow() - timedelta(seconds=OFFLINE_THRESHOLD_SECONDS)
-    cursor.execute('''
-        SELECT u.id, u.avatar_path, rm.active_app, rm.last_seen
-        FROM room_members rm
-        JOIN users u ON rm.user_id = u.id
-        WHERE rm.room_id = ?
-    ''', (room_id,))
-
     members = []
-    for row in cursor.fetchall():
-        last_seen = datetime.fromisoformat(row['last_seen']) if row['last_seen'] else None
-        is_online = bool(last_seen and last_seen > threshold)
+    for member in presence.members(room_id):
         members.append({
-            'userId': row['id'],
-            'avatarPath': row['avatar_path'],
-            'activeApp': row['active_app'] if is_online else None,
-            'isOnline': is_online,
-            'lastSeen': row['last_seen']
+            'userId': member.user_id,
+            'avatarPath': member.avatar_path,
+            'avatarVersion': avatars.version(member.avatar_path),
+            'activeApp': member.active_app if member.online else None,
+            'isOnline': member.online,
+            'lastSeen': member.last_seen_text()
         })
 
-    conn.close()
-
     return jsonify({
-        'roomId': room['id'],
-        'createdBy': room['created_by'],
-        'createdAt': room['created_at'],
+        'roomId': room.id,
+        'createdBy': room.created_by,
+        'createdAt': room.created_at,
         'members': members
     })
 
 @rooms_bp.route('/<room_id>/heartbeat', methods=['POST'])
 def heartbeat(room_id):
-    data = request.get_json()
-    if not data or 'userId' not in data:
+    data = request.get_json() or {}
+    user_id = sessions.request_user_id(data.get('userId'))
+    if not user_id:
         return jsonify({'error': 'userId is required'}), 400
 
-    user_id = data['userId']
     active_app = data.get('activeApp')  # None = idle, String = app name
     focus_mode = data.get('focusMode', False)  # Focus mode hides status
-
-    conn = get_db()
-    cursor = conn.cursor()
-
-    # Check if user is member of room
-    cursor.execute(
-        'SELECT room_id FROM room_members WHERE room_id = ? AND user_id = ?',
-        (room_id, user_id)
-    )
-    if not cursor.fetchone():
-        conn.close()
+    # Clients following /events can skip the member list
+    include_members = data.get('includeMembers', True)
+    # Room version from the previous response; only changes since then are sent
+    since_version = data.get('sinceVersion')
+
+    # Update presence in memory; it is flushed to room_members in the background
+    now = int(time.time())
+    if not presence.record(room_id, user_id, active_app, focus_mode, now):
         return jsonify({'error': 'Not a member of this room'}), 403
 
-    # Update heartbeat with focus mode
-    now = datetime.utcnow()
-    cursor.execute('''
-        UPDATE room_members
-        SET active_app = ?, last_seen = ?, focus_mode = ?
-        WHERE room_id = ? AND user_id = ?
-    ''', (active_app, now, focus_mode, room_id, user_id))
-
     # Log activity for statistics (only if user is active in an app and not in focus mode)
+    # Rows are queued and inserted in batches by activity.buffer
     if active_app and not focus_mode:
-        cursor.execute('''
-            INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (room_id, user_id, active_app, 5, now))  # 5 seconds per heartbeat
+        activity.buffer.add(room_id, user_id, active_app, 5, now)  # 5 seconds per heartbeat
+
+    if not include_members:
+        return jsonify({'status': 'ok'})
+
+    return jsonify(heartbeat_members(room_id, since_version))
 
-    conn.commit()
+
+def heartbeat_members(room_id, since_version=None):
+    """Members part of a heartbeat response: only the changes since
+    since_version when they are still known, otherwise every member."""
+    if isinstance(since_version, int):
+        delta = presence.changes_since(room_id, since_version)
+        if delta:
+            version, changed, removed = delta
+            if not changed and not removed:
+                return {'version': version, 'unchanged': True}
+            return {'version': version, 'changed': changed, 'removed': removed}
 
     # Get all members with online status
-    threshold = now - timedelta(seconds=OFFLINE_THRESHOLD_SECONDS)
-    cursor.execute('''
-        SELECT u.id, u.avatar_path, rm.active_app, rm.last_seen, rm.focus_mode
-        FROM room_members rm
-        JOIN users u ON rm.user_id = u.id
-        WHERE rm.room_id = ?
-    ''', (room_id,))
+    version, members = presence.snapshot(room_id)
+    return {'members': members, 'version': version}
 
-    members = []
-    for row in cursor.fetchall():
-        last_seen = datetime.fromisoformat(row['last_seen']) if row['last_seen'] else None
-        is_online = bool(last_seen and last_seen > threshold)
-        is_focus = bool(row['focus_mode']) if row['focus_mode'] is not None else False
-        members.append({
-            'userId': row['id'],
-            'avatarPath': row['avatar_path'],
-            'activeApp': None if is_focus else (row['active_app'] if is_online else None),
-            'isOnline': is_online,
-            'focusMode': is_focus
-        })
 
-    conn.close()
+@rooms_bp.route('/<room_id>/events', methods=['GET'])
+def room_events(room_id):
+    """Server-sent events stream of member changes.
+
+    Starts with a 'snapshot' of all members, then pushes 'join', 'leave',
+    'update', 'online' and 'offline' deltas as they happen.
+    """
+    # EventSource cannot send headers, so the token may come as ?token=
+    user_id = sessions.request_user_id(request.args.get('userId'), query_token=True)
+    if not user_id:
+        return jsonify({'error': 'userId is required'}), 400
+    if not presence.is_member(room_id, user_id):
+        return jsonify({'error': 'Not a member of this room'}), 403
 
-    return jsonify({'members': members})
+    try:
+        subscription = events.bus.subscribe(room_id)
+    except events.TooManyStreams:
+        response = jsonify({'error': 'Too many open event streams; poll heartbeats instead'})
+        response.headers['Retry-After'] = str(EVENTS_RETRY_AFTER_SECONDS)
+        return response, 503
+
+    def stream():
+        try:
+            version, members = presence.snapshot(room_id)
+            yield events.format_sse('snapshot', {'members': members, 'version': version}, version)
+            while True:
+                event = subscription.get(timeout=EVENTS_KEEPALIVE_SECONDS)
+                if subscription.overflowed:
+                    # Dropped events; the client should reconnect for a fresh snapshot
+                    yield events.format_sse('resync', {})
+                    return
+                if event is None:
+                    yield ': keepalive\n\n'
+                    continue
+                yield events.format_sse(*event)
+        finally:
+            subscription.close()
+
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # let nginx pass events through unbuffered
+    })
+    # Also frees the stream slot when the client goes away before the first event
+    response.call_on_close(subscription.close)
+    return response
 
 
 @rooms_bp.route('/<room_id>/stats', methods=['GET'])
 def get_room_stats(room_id):
     """Get comprehensive statistics for a room"""
-    user_id = request.args.get('userId')
+    user_id = sessions.request_user_id(request.args.get('userId'))
     period = request.args.get('period', 'today')  # today, week, all
+    try:
+        # e.g. ?include=totals,topApps; defaults to every section
+        sections = stats.parse_include(request.args.get('include'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    conn = get_db()
-    cursor = conn.cursor()
+    conn = get_room_db(room_id)
 
-    # Check if user is member of room
-    if user_id:
-        cursor.execute(
-            'SELECT room_id FROM room_members WHERE room_id = ? AND user_id = ?',
-            (room_id, user_id)
-        )
-        if not cursor.fetchone():
-            conn.close()
-            return jsonify({'error': 'Not a member of this room'}), 403
+    member_ids = repository.member_ids(conn, room_id)
+    if user_id and user_id not in member_ids:
+        return jsonify({'error': 'Not a member of this room'}), 403
+    profiles = repository.user_profiles(get_db(), member_ids)
 
     # Determine time range
     now = datetime.utcnow()
@@ -282,125 +259,74 @@ def get_room_stats(room_id):
     else:
         start_time = datetime(2000, 1, 1)  # All time
 
-    # Get all members with online status
-    threshold = now - timedelta(seconds=OFFLINE_THRESHOLD_SECONDS)
-    cursor.execute('''
-        SELECT u.id, u.avatar_path, u.name, u.email, rm.active_app, rm.last_seen
-        FROM room_members rm
-        JOIN users u ON rm.user_id = u.id
-        WHERE rm.room_id = ?
-    ''', (room_id,))
+    # Online status comes from in-memory presence
+    online = {m.user_id: m for m in presence.members(room_id) if m.online}
     members = {}
-    for row in cursor.fetchall():
-        last_seen = datetime.fromisoformat(row['last_seen']) if row['last_seen'] else None
-        is_online = bool(last_seen and last_seen > threshold)
-        members[row['id']] = {
-            'userId': row['id'],
-            'avatarPath': row['avatar_path'],
-            'name': row['name'],
-            'email': row['email'],
-            'isOnline': is_online,
-            'currentApp': row['active_app'] if is_online else None
+    for profile in profiles:
+        member = online.get(profile.user_id)
+        members[profile.user_id] = {
+            'userId': profile.user_id,
+            'avatarPath': profile.avatar_path,
+            'avatarVersion': avatars.version(profile.avatar_path),
+            'name': profile.name,
+            'email': profile.email,
+            'isOnline': member is not None,
+            'currentApp': member.active_app if member else None
         }
 
-    # Get total time per user
-    cursor.execute('''
-        SELECT user_id, SUM(duration_seconds) as total_seconds
-        FROM activity_logs
-        WHERE room_id = ? AND logged_at >= ?
-        GROUP BY user_id
-    ''', (room_id, start_time))
-
-    user_totals = {}
-    for row in cursor.fetchall():
-        user_totals[row['user_id']] = row['total_seconds'] or 0
-
-    # Get time per app per user
-    cursor.execute('''
-        SELECT user_id, app_name, SUM(duration_seconds) as total_seconds
-        FROM activity_logs
-        WHERE room_id = ? AND logged_at >= ?
-        GROUP BY user_id, app_name
-        ORDER BY total_seconds DESC
-    ''', (room_id, start_time))
-
-    user_apps = {}
-    for row in cursor.fetchall():
-        uid = row['user_id']
-        if uid not in user_apps:
-            user_apps[uid] = []
-        user_apps[uid].append({
-            'appName': row['app_name'],
-            'totalSeconds': row['total_seconds'] or 0
-        })
-
-    # Get hourly activity for today (for timeline chart)
+    # One pass over the hourly/daily rollups produces every requested section.
+    # Results are cached per room/period/sections for the current hour.
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    cursor.execute('''
-        SELECT user_id, strftime('%H', logged_at) as hour, SUM(duration_seconds) as total_seconds
-        FROM activity_logs
-        WHERE room_id = ? AND logged_at >= ?
-        GROUP BY user_id, hour
-        ORDER BY hour
-    ''', (room_id, today_start))
-
-    hourly_activity = {}
-    for row in cursor.fetchall():
-        uid = row['user_id']
-        if uid not in hourly_activity:
-            hourly_activity[uid] = {str(h).zfill(2): 0 for h in range(24)}
-        hourly_activity[uid][row['hour']] = row['total_seconds'] or 0
-
-    # Get top apps overall
-    cursor.execute('''
-        SELECT app_name, SUM(duration_seconds) as total_seconds
-        FROM activity_logs
-        WHERE room_id = ? AND logged_at >= ?
-        GROUP BY app_name
-        ORDER BY total_seconds DESC
-        LIMIT 10
-    ''', (room_id, start_time))
-
-    top_apps = [{'appName': row['app_name'], 'totalSeconds': row['total_seconds'] or 0} for row in cursor.fetchall()]
-
-    conn.close()
+    cache_key = (room_id, period, frozenset(sections), now.replace(minute=0, second=0, microsecond=0))
+    cached = stats.cache.get(cache_key)
+    if cached:
+        aggregates, generated_at = cached
+    else:
+        generation = stats.cache.generation(room_id)
+        aggregates = stats.aggregate(conn.cursor(), room_id, start_time, today_start, sections)
+        generated_at = now
+        stats.cache.put(cache_key, (aggregates, generated_at), generation)
 
     # Build response
     member_stats = []
     for uid, member in members.items():
-        member_stats.append({
-            **member,
-            'totalSeconds': user_totals.get(uid, 0),
-            'apps': user_apps.get(uid, []),
-            'hourlyActivity': hourly_activity.get(uid, {str(h).zfill(2): 0 for h in range(24)})
-        })
+        member_stat = dict(member)
+        if 'totals' in sections:
+            member_stat['totalSeconds'] = aggregates['totals'].get(uid, 0)
+        if 'apps' in sections:
+            member_stat['apps'] = aggregates['apps'].get(uid, [])
+        if 'hourly' in sections:
+            member_stat['hourlyActivity'] = aggregates['hourly'].get(uid) or stats.empty_hourly()
+        member_stats.append(member_stat)
 
     # Sort by total time
-    member_stats.sort(key=lambda x: x['totalSeconds'], reverse=True)
+    if 'totals' in sections:
+        member_stats.sort(key=lambda x: x['totalSeconds'], reverse=True)
 
-    return jsonify({
+    response = {
         'roomId': room_id,
         'period': period,
         'members': member_stats,
-        'topApps': top_apps,
-        'generatedAt': now.isoformat()
-    })
+        'generatedAt': generated_at.isoformat()
+    }
+    if 'topApps' in sections:
+        response['topApps'] = aggregates['topApps']
+
+    # Unchanged results revalidate with If-None-Match -> 304
+    response = jsonify(response)
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 @rooms_bp.route('/<room_id>/check', methods=['GET'])
 def check_room(room_id):
     """Check if room exists and if it requires password"""
-    conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT id, password FROM rooms WHERE id = ?', (room_id,))
-    room = cursor.fetchone()
-    conn.close()
-
+    room = repository.get_room(get_room_db(room_id), room_id)
     if not room:
         return jsonify({'exists': False}), 404
 
     return jsonify({
         'exists': True,
-        'hasPassword': bool(room['password'])
+        'hasPassword': bool(room.password)
     })
@@ -1,8 +1,13 @@
-import os
 import uuid
-from flask import Blueprint, request, jsonify, send_file
-from database import get_db
-from config import AVATARS_DIR, MAX_AVATAR_SIZE, ALLOWED_EXTENSIONS
+from flask import Blueprint, request, jsonify
+import activity
+import avatars
+import repository
+import sessions
+from database import get_db, each_shard
+from presence import store as presence
+from routes.avatars import requested_size, send_avatar
+from config import MAX_AVATAR_SIZE, ALLOWED_EXTENSIONS
 
 users_bp = Blueprint('users', __name__)
 
@@ -17,56 +22,49 @@ def register():
 
     device_id = data['deviceId']
     conn = get_db()
-    cursor = conn.cursor()
 
     # Check if user already exists
-    cursor.execute('SELECT id, device_id, avatar_path, created_at FROM users WHERE device_id = ?', (device_id,))
-    row = cursor.fetchone()
-
-    if row:
-        conn.close()
+    user = repository.get_user_by_device(conn, device_id)
+    if user:
         return jsonify({
-            'id': row['id'],
-            'deviceId': row['device_id'],
-            'avatarPath': row['avatar_path'],
-            'isNew': False
+            'id': user.id,
+            'deviceId': user.device_id,
+            'avatarPath': user.avatar_path,
+            'isNew': False,
+            'sessionToken': sessions.issue(user.id)
         })
 
     # Create new user
     user_id = str(uuid.uuid4())
-    cursor.execute('INSERT INTO users (id, device_id) VALUES (?, ?)', (user_id, device_id))
+    repository.create_user(conn, user_id, device_id)
     conn.commit()
-    conn.close()
 
     return jsonify({
         'id': user_id,
         'deviceId': device_id,
         'avatarPath': None,
-        'isNew': True
+        'isNew': True,
+        'sessionToken': sessions.issue(user_id)
     }), 201
 
 @users_bp.route('/<user_id>/avatar', methods=['POST'])
 def upload_avatar(user_id):
+    sessions.request_user_id(user_id)
     conn = get_db()
-    cursor = conn.cursor()
 
     # Check if user exists
-    cursor.execute('SELECT id FROM users WHERE id = ?', (user_id,))
-    if not cursor.fetchone():
-        conn.close()
+    user = repository.get_user(conn, user_id)
+    if not user:
         return jsonify({'error': 'User not found'}), 404
 
     if 'avatar' not in request.files:
-        conn.close()
         return jsonify({'error': 'No avatar file provided'}), 400
 
     file = request.files['avatar']
     if file.filename == '':
-        conn.close()
         return jsonify({'error': 'No file selected'}), 400
 
     if not allowed_file(file.filename):
-        conn.close()
         return jsonify({'error': 'Invalid file type'}), 400
 
     # Check file size
@@ -74,92 +72,90 @@ def upload_avatar(user_id):
     size = file.tell()
     file.seek(0)
     if size > MAX_AVATAR_SIZE:
-        conn.close()
         return jsonify({'error': 'File too large (max 1MB)'}), 400
 
-    # Save file
-    ext = file.filename.rsplit('.', 1)[1].lower()
-    filename = f'{user_id}.{ext}'
-    filepath = os.path.join(AVATARS_DIR, filename)
-
-    # Remove old avatar if exists
-    cursor.execute('SELECT avatar_path FROM users WHERE id = ?', (user_id,))
-    row = cursor.fetchone()
-    if row and row['avatar_path']:
-        old_path = os.path.join(AVATARS_DIR, row['avatar_path'])
-        if os.path.exists(old_path):
-            os.remove(old_path)
-
-    file.save(filepath)
+    # Resize into the standard variants, stored under a content hash
+    try:
+        avatar_path = avatars.store(file.read())
+    except avatars.InvalidImage as e:
+        return jsonify({'error': str(e)}), 400
 
-    # Update database
-    cursor.execute('UPDATE users SET avatar_path = ? WHERE id = ?', (filename, user_id))
+    # Update database, then drop the old avatar unless someone else uses it
+    repository.set_avatar_path(conn, user_id, avatar_path)
     conn.commit()
-    conn.close()
+    avatars.cache.forget_user(user_id)
+    old_avatar = user.avatar_path
+    if old_avatar and old_avatar != avatar_path and not repository.avatar_in_use(conn, old_avatar):
+        avatars.remove(old_avatar)
+    presence.refresh_user(user_id)
 
-    return jsonify({'avatarPath': filename})
+    return jsonify({'avatarPath': avatar_path})
 
 @users_bp.route('/<user_id>/avatar', methods=['GET'])
 def get_avatar(user_id):
-    conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT avatar_path FROM users WHERE id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-
-    if not row:
+    try:
+        size = requested_size()
+    except ValueError:
+        return jsonify({'error': 'Invalid size'}), 400
+
+    # The user's avatar name is cached briefly; uploads here reset it
+    found, avatar_path = avatars.cache.user_avatar(user_id)
+    if found and avatar_path:
+        # This URL keeps pointing at the user's current avatar, so it is
+        # revalidated by ETag rather than cached forever
+        response = send_avatar(avatar_path, size, immutable=False)
+        if response is not None:
+            return response
+        # Replaced through another worker since we cached it
+
+    user = repository.get_user(get_db(), user_id)
+    if not user:
         return jsonify({'error': 'User not found'}), 404
+    avatars.cache.set_user_avatar(user_id, user.avatar_path)
 
-    if not row['avatar_path']:
+    if not user.avatar_path:
         return jsonify({'error': 'No avatar set'}), 404
 
-    filepath = os.path.join(AVATARS_DIR, row['avatar_path'])
-    if not os.path.exists(filepath):
+    response = send_avatar(user.avatar_path, size, immutable=False)
+    if response is None:
         return jsonify({'error': 'Avatar file not found'}), 404
-
-    return send_file(filepath)
+    return response
 
 
 @users_bp.route('/<user_id>', methods=['DELETE'])
 def delete_account(user_id):
     """Delete user account and anonymize their data"""
+    sessions.request_user_id(user_id)
     conn = get_db()
-    cursor = conn.cursor()
 
     # Check if user exists
-    cursor.execute('SELECT id, avatar_path FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
+    user = repository.get_user(conn, user_id)
     if not user:
-        conn.close()
         return jsonify({'error': 'User not found'}), 404
 
-    # Delete avatar file if exists
-    if user['avatar_path']:
-        filepath = os.path.join(AVATARS_DIR, user['avatar_path'])
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-            except:
-                pass
-
     # Generate anonymous ID for data preservation
     anon_id = f"deleted_{uuid.uuid4().hex[:8]}"
 
-    # Anonymize activity logs (keep data but remove user identity)
-    cursor.execute('''
-        UPDATE activity_logs
-        SET user_id = ?
-        WHERE user_id = ?
-    ''', (anon_id, user_id))
-
-    # Remove from all rooms
-    cursor.execute('DELETE FROM room_members WHERE user_id = ?', (user_id,))
-
-    # Delete user account
-    cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-
+    # Take the user out of cached rosters and queued activity first, so no
+    # heartbeat is written under user_id after the shards are anonymized
+    room_ids = list(presence.user_rooms(user_id))
+    presence.forget_user(user_id, room_ids)
+    activity.buffer.forget_user(user_id, anon_id)
+
+    # Anonymize activity (keep data but remove user identity) and remove the
+    # user from all rooms in every shard, then delete the account
+    for shard_conn in each_shard():
+        room_ids += repository.forget_member(shard_conn, user_id, anon_id)
+        shard_conn.commit()
+    repository.delete_user(conn, user_id)
     conn.commit()
-    conn.close()
+    avatars.cache.forget_user(user_id)
+    # A roster reloaded before forget_member committed may list the user again
+    for room_id in set(room_ids):
+        presence.invalidate(room_id)
+
+    # Delete avatar files unless another user has the same image
+    if user.avatar_path and not repository.avatar_in_use(conn, user.avatar_path):
+        avatars.remove(user.avatar_path)
 
     return jsonify({'message': 'Account deleted and data anonymized'})
@@ -0,0 +1,129 @@
+"""Signed session tokens.
+
+/users/register and /auth/google hand out a token carrying the user id,
+signed with HMAC-SHA256. Clients send it as "Authorization: Bearer <token>";
+only the event stream, where EventSource cannot set headers, also takes
+?token= (URLs end up in access logs, so nothing else does). Verifying it
+is a hash, not a users lookup, and a request can no longer act as a userId
+it has not been given a token for.
+
+Requests without a token still identify themselves by userId unless
+REQUIRE_SESSION_TOKEN is set.
+
+Admin endpoints take ADMIN_TOKEN as their bearer token instead (require_admin).
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+from flask import request
+
+from config import ADMIN_TOKEN, DATA_DIR, REQUIRE_SESSION_TOKEN, SESSION_SECRET, SESSION_TOKEN_TTL
+
+
+class SessionError(Exception):
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _load_secret():
+    """SESSION_SECRET, or a random secret kept in DATA_DIR across restarts."""
+    if SESSION_SECRET:
+        return SESSION_SECRET.encode()
+    path = os.path.join(DATA_DIR, 'session_secret')
+    try:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    secret = secrets.token_hex(32).encode()
+    try:
+        # O_EXCL: if another worker got there first, use its secret
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+_secret = _load_secret()
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _sign(payload):
+    return _b64encode(hmac.new(_secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+
+def issue(user_id, now=None):
+    issued_at = int(time.time() if now is None else now)
+    payload = _b64encode(f'{user_id}:{issued_at}'.encode())
+    return f'{payload}.{_sign(payload)}'
+
+
+def verify(token, now=None):
+    """The user id in a valid, unexpired token, else None."""
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        user_id, issued_at = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode().rsplit(':', 1)
+        issued_at = int(issued_at)
+    except (ValueError, AttributeError, TypeError, UnicodeError):
+        return None
+    now = time.time() if now is None else now
+    if SESSION_TOKEN_TTL > 0 and issued_at + SESSION_TOKEN_TTL < now:
+        return None
+    return user_id
+
+
+def bearer_token(authorization):
+    if authorization and authorization[:7].lower() == 'bearer ':
+        return authorization[7:].strip()
+    return None
+
+
+def resolve_user(token, claimed_user_id):
+    """The caller's user id, from the token if one was sent.
+
+    Raises SessionError for a bad token, a token for a different user than
+    claimed_user_id, or a missing token when REQUIRE_SESSION_TOKEN is set.
+    Returns claimed_user_id (possibly None) for token-less requests.
+    """
+    if token:
+        user_id = verify(token)
+        if user_id is None:
+            raise SessionError('Invalid or expired session token')
+        if claimed_user_id and claimed_user_id != user_id:
+            raise SessionError('Session token does not match userId', 403)
+        return user_id
+    if REQUIRE_SESSION_TOKEN:
+        raise SessionError('Session token required')
+    return claimed_user_id
+
+
+def request_user_id(claimed_user_id, query_token=False):
+    """resolve_user() for the current Flask request. The token comes from the
+    Authorization header, or with query_token from ?token= as well."""
+    token = bearer_token(request.headers.get('Authorization'))
+    if not token and query_token:
+        token = request.args.get('token')
+    return resolve_user(token, claimed_user_id)
+
+
+def require_admin():
+    """Raise SessionError unless the current request carries ADMIN_TOKEN."""
+    if not ADMIN_TOKEN:
+        raise SessionError('Admin endpoints are disabled', 404)
+    token = bearer_token(request.headers.get('Authorization')) or ''
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise SessionError('Admin token required')
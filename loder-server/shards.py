@@ -0,0 +1,106 @@
+"""Room to SQLite file mapping.
+
+Rooms never share data, so each room's rows (rooms, room_members,
+activity_logs and the rollups) live in one of ROOM_SHARDS files and
+writes to different shards do not wait for each other's lock. Users are
+looked up by id from everywhere and stay in DATABASE_PATH. Every file
+carries the full schema (see migrations.py); unused tables stay empty.
+
+A room's shard is chosen by rendezvous hashing of its id, so it needs no
+lookup table and changing the shard count moves only the rooms whose
+highest-scoring shard changed. Workers read ROOM_SHARDS at startup, so
+rebalance() is run with the server stopped.
+"""
+import functools
+import glob
+import hashlib
+import os
+import sqlite3
+
+from config import DATABASE_PATH, ROOM_SHARDS, ROOM_SHARDS_DIR
+
+# Per-room tables, in copy order
+ROOM_TABLES = ('rooms', 'room_members', 'activity_logs', 'activity_hourly', 'activity_daily')
+_ACTIVITY_COLUMNS = 'room_id, user_id, app_name, duration_seconds, logged_at, ended_at'
+
+
+def shard_paths(count=ROOM_SHARDS):
+    if count <= 1:
+        return [DATABASE_PATH]
+    return [os.path.join(ROOM_SHARDS_DIR, f'rooms-{index}.db') for index in range(count)]
+
+
+@functools.lru_cache(maxsize=65536)
+def shard_index(room_id, count=ROOM_SHARDS):
+    if count <= 1:
+        return 0
+
+    def score(index):
+        digest = hashlib.blake2b(f'{index}:{room_id}'.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    return max(range(count), key=score)
+
+
+def existing_paths():
+    """DATABASE_PATH plus every shard file present, whatever the current count."""
+    paths = [DATABASE_PATH] + sorted(glob.glob(os.path.join(ROOM_SHARDS_DIR, 'rooms-*.db')))
+    return [path for path in dict.fromkeys(paths) if os.path.exists(path)]
+
+
+def rebalance(count=ROOM_SHARDS, log=print):
+    """Move every room into the file shard_index() assigns it for `count` shards.
+
+    Target files must already have the schema (database.init_db() creates
+    it). Each room is copied to its target in one transaction and then
+    deleted from its source in a second one; a room found in both after a
+    crash is copied again, so the tool can simply be re-run. Returns the
+    number of rooms moved.
+    """
+    targets = [os.path.realpath(path) for path in shard_paths(count)]
+    moved = 0
+    for source in existing_paths():
+        conn = sqlite3.connect(source)
+        try:
+            room_ids = [row[0] for row in conn.execute('SELECT id FROM rooms')]
+            for room_id in room_ids:
+                target = targets[shard_index(room_id, count)]
+                if target == os.path.realpath(source):
+                    continue
+                _move_room(conn, room_id, target)
+                moved += 1
+            if room_ids:
+                log(f'{os.path.basename(source)}: {len(room_ids)} rooms checked')
+        finally:
+            conn.close()
+    return moved
+
+
+def _move_room(conn, room_id, target):
+    conn.execute('ATTACH DATABASE ? AS target', (target,))
+    try:
+        # Leftovers of an interrupted move are replaced
+        for table in ROOM_TABLES:
+            column = 'id' if table == 'rooms' else 'room_id'
+            conn.execute(f'DELETE FROM target.{table} WHERE {column} = ?', (room_id,))
+        conn.execute('INSERT INTO target.rooms SELECT * FROM main.rooms WHERE id = ?', (room_id,))
+        conn.execute('INSERT INTO target.room_members SELECT * FROM main.room_members WHERE room_id = ?',
+                     (room_id,))
+        # Row ids are per file, so activity rows get new ones
+        conn.execute(f'''
+            INSERT INTO target.activity_logs ({_ACTIVITY_COLUMNS})
+            SELECT {_ACTIVITY_COLUMNS} FROM main.activity_logs WHERE room_id = ? ORDER BY id
+        ''', (room_id,))
+        for table in ('activity_hourly', 'activity_daily'):
+            conn.execute(f'INSERT INTO target.{table} SELECT * FROM main.{table} WHERE room_id = ?', (room_id,))
+        conn.commit()
+
+        for table in ROOM_TABLES:
+            column = 'id' if table == 'rooms' else 'room_id'
+            conn.execute(f'DELETE FROM main.{table} WHERE {column} = ?', (room_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute('DETACH DATABASE target')
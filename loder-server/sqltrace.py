@@ -0,0 +1,129 @@
+"""Slow SQL log with query plans.
+
+Pooled connections time every statement (metrics.InstrumentedConnection).
+While tracing is on, statements slower than the threshold are logged with
+their parameters redacted to types and lengths, together with their
+EXPLAIN QUERY PLAN. Plan steps that scan a whole table, such as an
+activity_logs query that cannot use idx_activity_logs_room_time, are
+flagged. The last RECENT_SIZE slow statements are kept for /debug/sql.
+
+Tracing starts on with SQL_TRACE=1 and can be turned on or off at runtime
+with POST /debug/sql (ADMIN_TOKEN required; each worker has its own
+tracer). SQL_TRACE_SLOW_MS sets the threshold. Plans are captured once per
+statement text. Statements are only timed with METRICS_ENABLED, so without
+it there is nothing to trace and check_timed() warns at startup.
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from flask import has_request_context, request
+
+from config import METRICS_ENABLED, SQL_TRACE, SQL_TRACE_SLOW_MS
+
+logger = logging.getLogger(__name__)
+
+# Slow statements kept for /debug/sql
+RECENT_SIZE = 100
+# Statement texts whose plans are remembered
+PLAN_CACHE_SIZE = 256
+
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def redact(parameters):
+    """Parameter types (and lengths for text/blobs) instead of values."""
+    def describe(value):
+        if value is None:
+            return 'NULL'
+        if isinstance(value, (str, bytes)):
+            return f'<{type(value).__name__}:{len(value)}>'
+        return f'<{type(value).__name__}>'
+
+    if isinstance(parameters, dict):
+        return {name: describe(value) for name, value in parameters.items()}
+    return [describe(value) for value in parameters]
+
+
+def full_scans(plan):
+    """Plan steps that read a whole table (SCAN without an index)."""
+    scans = []
+    for detail in plan:
+        if not detail.startswith('SCAN ') or 'VIRTUAL TABLE' in detail or 'CONSTANT ROW' in detail:
+            continue
+        if 'USING' in detail or detail.startswith('SCAN ('):
+            continue
+        scans.append(detail[5:].split(' ', 1)[0])
+    return scans
+
+
+class SqlTracer:
+    def __init__(self, enabled=SQL_TRACE, threshold_ms=SQL_TRACE_SLOW_MS):
+        self.enabled = enabled
+        self.threshold = threshold_ms / 1000
+        self._lock = threading.Lock()
+        self._plans = {}
+        self.recent = deque(maxlen=RECENT_SIZE)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        logger.warning('SQL tracing %s (threshold %.0f ms)', 'on' if self.enabled else 'off', self.threshold * 1000)
+        self.check_timed()
+
+    def check_timed(self):
+        """Warn if tracing is on but statements are not timed."""
+        if self.enabled and not METRICS_ENABLED:
+            logger.warning('SQL tracing is on but METRICS_ENABLED is off, so statements are not timed '
+                           'and none will be traced')
+
+    def _plan(self, conn, sql, parameters):
+        with self._lock:
+            plan = self._plans.get(sql)
+        if plan is not None:
+            return plan
+        if parameters is None:
+            # Without sample values, ?s are planned as NULLs
+            parameters = (None,) * sql.count('?')
+        if not sql.lstrip()[:7].upper().startswith(_EXPLAINABLE):
+            plan = []
+        else:
+            try:
+                # A plain cursor, so the EXPLAIN itself is not traced or counted
+                cursor = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+                plan = [row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+            except sqlite3.Error as e:
+                return [f'(no plan: {e})']
+        with self._lock:
+            if len(self._plans) >= PLAN_CACHE_SIZE:
+                self._plans.clear()
+            self._plans[sql] = plan
+        return plan
+
+    def record(self, conn, sql, parameters, seconds):
+        """Log a slow statement. parameters may be None (executemany without a sample)."""
+        plan = self._plan(conn, sql, parameters)
+        scans = full_scans(plan)
+        entry = {
+            'at': time.time(),
+            'ms': round(seconds * 1000, 1),
+            'endpoint': (request.endpoint if has_request_context() else None) or 'background',
+            'sql': _WHITESPACE.sub(' ', sql).strip(),
+            'params': redact(parameters) if parameters is not None else None,
+            'plan': plan,
+            'fullScans': scans,
+        }
+        self.recent.append(entry)
+        logger.warning('Slow SQL %.1f ms in %s%s: %s params=%s plan=%s', entry['ms'], entry['endpoint'],
+                       f" (full scan of {', '.join(scans)})" if scans else '', entry['sql'],
+                       entry['params'], ' | '.join(plan))
+
+    def info(self):
+        return {'enabled': self.enabled, 'timed': METRICS_ENABLED, 'thresholdMs': self.threshold * 1000,
+                'recent': list(self.recent)}
+
+
+tracer = SqlTracer()
@@ -0,0 +1,161 @@
+"""Single-pass aggregation for GET /rooms/<id>/stats.
+
+One grouped query over the rollup source (see rollups.period_source)
+produces every section; totals, per-app breakdowns, the hourly timeline and
+top apps are then derived in Python. Sections a client does not ask for are
+left out of the GROUP BY, so e.g. a leaderboard does not pay for the timeline.
+
+Results are kept in a small TTL + LRU cache that is invalidated per room
+whenever the activity buffer flushes new rows for it.
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from config import STATS_CACHE_SIZE, STATS_CACHE_TTL
+import rollups
+
+SECTIONS = ('totals', 'apps', 'hourly', 'topApps')
+TOP_APPS_LIMIT = 10
+
+
+def parse_include(value):
+    """Parse ?include=a,b into a set of sections. Raises ValueError on unknown names."""
+    if not value:
+        return set(SECTIONS)
+    sections = {part.strip() for part in value.split(',') if part.strip()}
+    unknown = sections - set(SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown stats section: {', '.join(sorted(unknown))}")
+    return sections
+
+
+def empty_hourly():
+    return {str(h).zfill(2): 0 for h in range(24)}
+
+
+def aggregate_query(room_id, start_time, today_start, sections):
+    """(sql, params) of the one query behind aggregate()."""
+    by_user = bool(sections & {'totals', 'apps', 'hourly'})
+    by_app = bool(sections & {'apps', 'topApps'})
+    by_hour = 'hourly' in sections
+
+    columns = [
+        'user_id' if by_user else 'NULL',
+        'app_name' if by_app else 'NULL',
+        'CASE WHEN bucket >= ? THEN bucket % 86400 / 3600 END' if by_hour else 'NULL',
+    ]
+    group_by = [name for name, wanted in (('user_id', by_user), ('app_name', by_app), ('hour', by_hour)) if wanted]
+
+    source, params = rollups.period_source(room_id, start_time, today_start)
+    sql = f'''
+        SELECT {columns[0]} AS user_id, {columns[1]} AS app_name, {columns[2]} AS hour,
+               SUM(total_seconds) AS total_seconds
+        FROM ({source})
+    '''
+    if by_hour:
+        params = (rollups.epoch(today_start),) + params
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)}"
+    return sql, params
+
+
+def aggregate(cursor, room_id, start_time, today_start, sections):
+    """Compute the requested sections in one query.
+
+    Returns a dict with keys 'totals' {user_id: seconds}, 'apps'
+    {user_id: [{appName, totalSeconds}]}, 'hourly' {user_id: {'HH': seconds}}
+    and 'topApps' [{appName, totalSeconds}], each present only if requested.
+    """
+    cursor.execute(*aggregate_query(room_id, start_time, today_start, sections))
+
+    totals = defaultdict(int)
+    apps = defaultdict(lambda: defaultdict(int))
+    hourly = {}
+    top_apps = defaultdict(int)
+    for user_id, app_name, hour, seconds in cursor.fetchall():
+        seconds = seconds or 0
+        totals[user_id] += seconds
+        apps[user_id][app_name] += seconds
+        top_apps[app_name] += seconds
+        if hour is not None:
+            if user_id not in hourly:
+                hourly[user_id] = empty_hourly()
+            hourly[user_id][str(hour).zfill(2)] += seconds
+
+    result = {}
+    if 'totals' in sections:
+        result['totals'] = dict(totals)
+    if 'apps' in sections:
+        result['apps'] = {
+            user_id: _ranked(per_app)
+            for user_id, per_app in apps.items()
+        }
+    if 'hourly' in sections:
+        result['hourly'] = hourly
+    if 'topApps' in sections:
+        result['topApps'] = _ranked(top_apps)[:TOP_APPS_LIMIT]
+    return result
+
+
+def _ranked(seconds_by_app):
+    ranked = sorted(seconds_by_app.items(), key=lambda item: item[1], reverse=True)
+    return [{'appName': app_name, 'totalSeconds': seconds} for app_name, seconds in ranked]
+
+
+class StatsCache:
+    """TTL + LRU cache of aggregate() results.
+
+    Each room has a generation number that invalidate() bumps; entries
+    computed under an older generation are treated as misses.
+    """
+
+    def __init__(self, ttl=STATS_CACHE_TTL, max_entries=STATS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (generation, expires_at, value)
+        self._generations = defaultdict(int)
+
+    def generation(self, room_id):
+        with self._lock:
+            return self._generations[room_id]
+
+    def get(self, key):
+        """key is (room_id, ...). Returns the cached value or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == self._generations[key[0]] and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self._generations[key[0]]:
+                return  # new activity arrived while computing
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._generations[room_id] += 1
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                    'maxSize': self.max_entries, 'ttl': self.ttl}
+
+
+cache = StatsCache()
@@ -0,0 +1,34 @@
+"""Test setup: run against a throwaway DATA_DIR.
+
+    cd loder-server && python -m pytest tests
+
+config.py reads the environment when it is first imported, so the
+variables are set here, before any test module imports the server.
+"""
+import base64
+import json
+import os
+import sys
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(SERVER_DIR, 'tests', 'fixtures')
+
+_data_dir = tempfile.mkdtemp(prefix='loder-tests-')
+os.environ.update({
+    'DATA_DIR': _data_dir,
+    'DATABASE_PATH': os.path.join(_data_dir, 'loder.db'),
+    'AVATARS_DIR': os.path.join(_data_dir, 'avatars'),
+    'ACTIVITY_ARCHIVE_DIR': os.path.join(_data_dir, 'archive'),
+    'SESSION_SECRET': 'test-session-secret',
+})
+sys.path.insert(0, SERVER_DIR)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return json.load(f)
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
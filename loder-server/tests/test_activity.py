@@ -0,0 +1,104 @@
+"""Activity buffer: deleted accounts and queued activity."""
+import pytest
+
+import activity
+from app import app
+from database import db_connection, shard_pools
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def register(client, device_id):
+    body = client.post('/api/v1/users/register', json={'deviceId': device_id}).get_json()
+    return body['id'], {'Authorization': f"Bearer {body['sessionToken']}"}
+
+
+def rows_for(user_id):
+    counts = {}
+    for shard_pool in shard_pools:
+        with db_connection(shard_pool) as conn:
+            for table in ('activity_logs', 'activity_hourly', 'activity_daily'):
+                count = conn.execute(f'SELECT COUNT(*) FROM {table} WHERE user_id = ?', (user_id,)).fetchone()[0]
+                counts[table] = counts.get(table, 0) + count
+    return counts
+
+
+def heartbeat(client, room_id, headers):
+    response = client.post(f'/api/v1/rooms/{room_id}/heartbeat', json={'activeApp': 'Xcode'}, headers=headers)
+    assert response.status_code == 200
+
+
+def test_queued_activity_of_deleted_user_is_anonymized(client):
+    user_id, headers = register(client, 'activity-delete')
+    room_id = client.post('/api/v1/rooms/create', json={}, headers=headers).get_json()['roomId']
+    heartbeat(client, room_id, headers)
+
+    assert client.delete(f'/api/v1/users/{user_id}', headers=headers).status_code == 200
+    activity.buffer.flush()
+    assert rows_for(user_id) == {'activity_logs': 0, 'activity_hourly': 0, 'activity_daily': 0}
+
+
+def test_open_session_of_deleted_user_is_anonymized(client):
+    user_id, headers = register(client, 'activity-delete-open')
+    room_id = client.post('/api/v1/rooms/create', json={}, headers=headers).get_json()['roomId']
+    heartbeat(client, room_id, headers)
+    activity.buffer.flush()
+    # Extended by the next flush, after the account is gone
+    heartbeat(client, room_id, headers)
+
+    assert client.delete(f'/api/v1/users/{user_id}', headers=headers).status_code == 200
+    activity.buffer.flush()
+    assert rows_for(user_id) == {'activity_logs': 0, 'activity_hourly': 0, 'activity_daily': 0}
+
+
+def test_heartbeats_of_forgotten_user_are_dropped():
+    buffer = activity.ActivityBuffer(flush_interval=60)
+    buffer.add('ROOM', 'user-1', 'Xcode', 5, 1_700_000_000)
+    buffer.forget_user('user-1', 'deleted_1')
+    buffer.add('ROOM', 'user-1', 'Xcode', 5, 1_700_000_005)
+    assert len(buffer) == 1
+    assert [key[1] for key in buffer._rollup] == ['deleted_1']
+
+
+def add_rows(conn, room_id, start, count):
+    conn.executemany('''
+        INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at)
+        VALUES (?, 'compact-user', 'Xcode', 5, ?)
+    ''', [(room_id, start + i * 5) for i in range(count)])
+    conn.commit()
+
+
+def room_rows(conn, room_id):
+    return tuple(conn.execute('SELECT COUNT(*), SUM(duration_seconds) FROM activity_logs WHERE room_id = ?',
+                              (room_id,)).fetchone())
+
+
+def test_compaction_is_one_immediate_transaction():
+    with db_connection(shard_pools[0]) as conn:
+        add_rows(conn, 'COMPACT1', 1_600_000_000 // 3600 * 3600, 10)
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            activity.compact_activity_logs(conn)
+        finally:
+            conn.set_trace_callback(None)
+        assert room_rows(conn, 'COMPACT1') == (1, 50)
+    assert statements[0] == 'BEGIN IMMEDIATE'
+    assert [s for s in statements if s in ('BEGIN IMMEDIATE', 'COMMIT')] == ['BEGIN IMMEDIATE', 'COMMIT']
+
+
+def test_compaction_leaves_previous_hour_during_grace(monkeypatch):
+    hour = 1_600_000_000 // 3600 * 3600
+    with db_connection(shard_pools[0]) as conn:
+        add_rows(conn, 'COMPACT2', hour - 600, 10)
+        # Just after the hour: a flush may still extend these rows
+        monkeypatch.setattr(activity.time, 'time', lambda: hour + 10)
+        activity.compact_activity_logs(conn)
+        assert room_rows(conn, 'COMPACT2') == (10, 50)
+
+        monkeypatch.setattr(activity.time, 'time', lambda: hour + activity.COMPACT_GRACE_SECONDS + 1)
+        activity.compact_activity_logs(conn)
+        assert room_rows(conn, 'COMPACT2') == (1, 50)
@@ -0,0 +1,228 @@
+"""Google ID token verification against the fixture keys in tests/fixtures.
+
+google_private_jwks.json holds two RSA keys with their private exponents,
+google_jwks.json the matching public JWKS (as GOOGLE_JWKS_FILE would).
+"""
+import json
+import os
+import time
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from conftest import FIXTURES_DIR, b64encode, load_fixture
+
+import google_oauth
+import google_tokens
+from google_oauth import GoogleAuthError
+from google_tokens import InvalidToken
+
+AUDIENCE = 'test-client.apps.googleusercontent.com'
+PRIVATE_KEYS = {key['kid']: key for key in load_fixture('google_private_jwks.json')['keys']}
+
+
+def _int(value):
+    return int.from_bytes(google_tokens._b64decode(value), 'big')
+
+
+def _private_key(kid):
+    key = PRIVATE_KEYS[kid]
+    n, e, d = _int(key['n']), _int(key['e']), _int(key['d'])
+    p, q = rsa.rsa_recover_prime_factors(n, e, d)
+    return rsa.RSAPrivateNumbers(
+        p, q, d, rsa.rsa_crt_dmp1(d, p), rsa.rsa_crt_dmq1(d, q), rsa.rsa_crt_iqmp(p, q),
+        rsa.RSAPublicNumbers(e, n),
+    ).private_key()
+
+
+def sign(claims, kid='fixture-key-1'):
+    """RS256 JWT for claims, signed with a fixture key."""
+    header = b64encode(json.dumps({'alg': 'RS256', 'kid': kid, 'typ': 'JWT'}).encode())
+    payload = b64encode(json.dumps(claims).encode())
+    signature = _private_key(kid).sign(f'{header}.{payload}'.encode(), padding.PKCS1v15(), hashes.SHA256())
+    return f'{header}.{payload}.{b64encode(signature)}'
+
+
+def claims(**overrides):
+    now = int(time.time())
+    values = {
+        'iss': 'https://accounts.google.com', 'aud': AUDIENCE, 'sub': '1234567890',
+        'email': 'ada@example.com', 'email_verified': True, 'name': 'Ada',
+        'iat': now, 'exp': now + 3600,
+    }
+    values.update(overrides)
+    return values
+
+
+def jwks(*kids):
+    """Public JWKS document with the given fixture keys."""
+    return {'keys': [key for key in load_fixture('google_jwks.json')['keys'] if key['kid'] in kids]}
+
+
+@pytest.fixture
+def file_keys():
+    return google_tokens.FileKeySource(os.path.join(FIXTURES_DIR, 'google_jwks.json'))
+
+
+def test_valid_token(file_keys):
+    verified = google_tokens.verify(sign(claims()), file_keys, AUDIENCE)
+    assert verified['email'] == 'ada@example.com'
+    assert verified['sub'] == '1234567890'
+
+
+def test_tampered_signature(file_keys):
+    header, payload, signature = sign(claims()).split('.')
+    forged = b64encode(json.dumps(claims(email='eve@example.com')).encode())
+    with pytest.raises(InvalidToken, match='Bad signature'):
+        google_tokens.verify(f'{header}.{forged}.{signature}', file_keys, AUDIENCE)
+
+
+def test_signature_from_other_key(file_keys):
+    header = sign(claims(), kid='fixture-key-1').split('.')[0]
+    _, payload, signature = sign(claims(), kid='fixture-key-2').split('.')
+    with pytest.raises(InvalidToken, match='Bad signature'):
+        google_tokens.verify(f'{header}.{payload}.{signature}', file_keys, AUDIENCE)
+
+
+@pytest.mark.parametrize('email_verified', [False, 'true'])
+def test_unverified_email(file_keys, email_verified):
+    token = sign(claims(email_verified=email_verified))
+    with pytest.raises(InvalidToken, match='Email not verified'):
+        google_tokens.verify(token, file_keys, AUDIENCE)
+
+
+def test_missing_email_verified(file_keys):
+    values = claims()
+    del values['email_verified']
+    with pytest.raises(InvalidToken, match='Email not verified'):
+        google_tokens.verify(sign(values), file_keys, AUDIENCE)
+
+
+def test_wrong_audience(file_keys):
+    with pytest.raises(InvalidToken, match='Wrong audience'):
+        google_tokens.verify(sign(claims(aud='someone-else')), file_keys, AUDIENCE)
+
+
+def test_wrong_issuer(file_keys):
+    with pytest.raises(InvalidToken, match='Wrong issuer'):
+        google_tokens.verify(sign(claims(iss='https://evil.example.com')), file_keys, AUDIENCE)
+
+
+def test_expired_token(file_keys):
+    now = int(time.time())
+    token = sign(claims(iat=now - 7200, exp=now - google_tokens.CLOCK_SKEW_SECONDS - 1))
+    with pytest.raises(InvalidToken, match='Token expired'):
+        google_tokens.verify(token, file_keys, AUDIENCE)
+
+
+def test_expiry_within_clock_skew(file_keys):
+    now = int(time.time())
+    token = sign(claims(iat=now - 3600, exp=now - google_tokens.CLOCK_SKEW_SECONDS // 2))
+    assert google_tokens.verify(token, file_keys, AUDIENCE)['sub'] == '1234567890'
+
+
+def test_unknown_key(file_keys):
+    token = sign(claims())
+    with pytest.raises(InvalidToken, match='Unknown signing key'):
+        google_tokens.verify(token, google_tokens.HttpKeySource('http://keys.invalid'), AUDIENCE)
+
+
+# Sign-in flow: refreshing keys over HTTP
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self._body = body
+        self.status_code = status_code
+        self.headers = headers or {'Cache-Control': 'public, max-age=3600'}
+
+    def json(self):
+        return self._body
+
+
+class FakeSession:
+    """Stands in for google_oauth._session; answers key fetches from `responses`."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **options):
+        self.requests.append((method, url))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def http_keys(monkeypatch):
+    keys = google_tokens.HttpKeySource('https://keys.example.com/certs')
+    monkeypatch.setattr(google_tokens, 'keys', keys)
+    monkeypatch.setattr(google_oauth, 'GOOGLE_CLIENT_ID', AUDIENCE)
+    return keys
+
+
+def use_session(monkeypatch, *responses):
+    session = FakeSession(*responses)
+    monkeypatch.setattr(google_oauth, '_session', session)
+    return session
+
+
+def test_first_sign_in_fetches_keys(monkeypatch, http_keys):
+    session = use_session(monkeypatch, FakeResponse(jwks('fixture-key-1')))
+    profile = google_oauth.fetch_profile({'idToken': sign(claims())})
+    assert profile.email == 'ada@example.com'
+    assert session.requests == [('GET', 'https://keys.example.com/certs')]
+
+    # Cached for the response's max-age
+    google_oauth.fetch_profile({'idToken': sign(claims())})
+    assert len(session.requests) == 1
+
+
+def test_unknown_kid_triggers_refresh(monkeypatch, http_keys):
+    http_keys.update(FakeResponse(jwks('fixture-key-1')))
+    # Rotated keys are only looked for once per UNKNOWN_KID_REFRESH_INTERVAL
+    http_keys._refreshed_at -= google_tokens.UNKNOWN_KID_REFRESH_INTERVAL
+    session = use_session(monkeypatch, FakeResponse(jwks('fixture-key-1', 'fixture-key-2')))
+
+    profile = google_oauth.fetch_profile({'idToken': sign(claims(), kid='fixture-key-2')})
+    assert profile.google_id == '1234567890'
+    assert len(session.requests) == 1
+    assert http_keys.get('fixture-key-2') is not None
+
+
+def test_unknown_kid_refresh_is_rate_limited(monkeypatch, http_keys):
+    http_keys.update(FakeResponse(jwks('fixture-key-1')))
+    session = use_session(monkeypatch)
+
+    with pytest.raises(GoogleAuthError) as raised:
+        google_oauth.fetch_profile({'idToken': sign(claims(), kid='fixture-key-2')})
+    assert raised.value.status == 401
+    assert session.requests == []
+
+
+def test_failed_refresh_falls_back_to_cached_keys(monkeypatch, http_keys):
+    http_keys.update(FakeResponse(jwks('fixture-key-1'), headers={'Cache-Control': 'max-age=0'}))
+    assert http_keys.needs_refresh('fixture-key-1')
+    session = use_session(monkeypatch, ConnectionError('Google is down'))
+
+    profile = google_oauth.fetch_profile({'idToken': sign(claims())})
+    assert profile.email == 'ada@example.com'
+    assert len(session.requests) == 1
+    # The next login does not wait on Google again right away
+    assert not http_keys.needs_refresh('fixture-key-1')
+
+
+def test_failed_refresh_without_cached_key(monkeypatch, http_keys):
+    use_session(monkeypatch, FakeResponse({}, status_code=503))
+    with pytest.raises(GoogleAuthError) as raised:
+        google_oauth.fetch_profile({'idToken': sign(claims())})
+    assert raised.value.status == 401
+    assert 'Token verification failed' in raised.value.message
+
+
+def test_file_key_source_never_refreshes(file_keys):
+    assert not file_keys.needs_refresh('fixture-key-1')
+    assert not file_keys.needs_refresh('no-such-key')
+    assert file_keys.get('fixture-key-2') is not None
@@ -0,0 +1,47 @@
+"""Batch heartbeat: which rooms a request may name."""
+import pytest
+
+from app import app
+from presence import store as presence
+from routes.heartbeat import MAX_ROOM_IDS
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def register(client, device_id):
+    body = client.post('/api/v1/users/register', json={'deviceId': device_id}).get_json()
+    return body['id'], {'Authorization': f"Bearer {body['sessionToken']}"}
+
+
+def test_heartbeat_for_member_and_other_rooms(client):
+    _, headers = register(client, 'batch-member')
+    room_id = client.post('/api/v1/rooms/create', json={}, headers=headers).get_json()['roomId']
+    _, other_headers = register(client, 'batch-other')
+    other_room = client.post('/api/v1/rooms/create', json={}, headers=other_headers).get_json()['roomId']
+
+    body = client.post('/api/v1/heartbeat', json={'roomIds': [room_id, other_room, 'NOROOM']},
+                       headers=headers).get_json()
+    assert list(body['rooms']) == [room_id]
+    assert body['notMember'] == [other_room, 'NOROOM']
+
+
+def test_too_many_room_ids(client):
+    _, headers = register(client, 'batch-too-many')
+    room_ids = [f'R{i:06d}' for i in range(MAX_ROOM_IDS + 1)]
+    response = client.post('/api/v1/heartbeat', json={'roomIds': room_ids}, headers=headers)
+    assert response.status_code == 400
+
+
+def test_unknown_room_ids_load_no_rosters(client, monkeypatch):
+    _, headers = register(client, 'batch-unknown')
+    loaded = []
+    monkeypatch.setattr(presence, '_load_room', lambda room_id: loaded.append(room_id))
+
+    room_ids = [f'FAKE{i:04d}' for i in range(MAX_ROOM_IDS)]
+    body = client.post('/api/v1/heartbeat', json={'roomIds': room_ids}, headers=headers).get_json()
+    assert body['notMember'] == room_ids
+    assert loaded == []
+
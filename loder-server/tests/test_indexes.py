@@ -0,0 +1,47 @@
+"""Index advisor against the migrated test database."""
+import logging
+
+import activity
+import indexes
+import repository
+import retention
+
+
+def all_findings():
+    return [f for results in indexes.check_all().values() for f in results]
+
+
+def test_migrated_schema_has_no_problems():
+    assert [indexes.describe(f) for f in all_findings() if indexes.is_problem(f)] == []
+
+
+def test_every_sql_constant_is_checked():
+    checked = {sql for queries in indexes.HOT_QUERIES.values() for sql in queries.values()}
+    for module in (repository, activity, retention):
+        for name in dir(module):
+            if name.endswith('_SQL'):
+                value = getattr(module, name)
+                statements = value if isinstance(value, tuple) else (value,)
+                assert set(statements) <= checked, f'{module.__name__}.{name} is not in HOT_QUERIES'
+
+
+def test_account_deletion_is_indexed():
+    names = {name for _, name, _ in all_findings()}
+    assert not names & {'forget_logs', 'forget_hourly', 'forget_daily', 'forget_memberships'}
+
+
+def test_retention_scan_is_accepted(caplog):
+    assert ('accepted', 'archive_batch', 'activity_logs') in all_findings()
+    with caplog.at_level(logging.INFO, logger='indexes'):
+        assert indexes.report() == 0
+    record, = [r for r in caplog.records if 'archive_batch' in r.getMessage()]
+    assert record.levelno == logging.INFO
+    assert 'accepted: retention reads the oldest rows' in record.getMessage()
+
+
+def test_unaccepted_scan_is_a_problem(monkeypatch, caplog):
+    monkeypatch.setitem(indexes.HOT_QUERIES['rooms'], 'by_app', 'SELECT id FROM activity_logs WHERE app_name = ?')
+    with caplog.at_level(logging.INFO, logger='indexes'):
+        assert indexes.report() >= 1
+    record, = [r for r in caplog.records if 'by_app' in r.getMessage()]
+    assert record.levelno == logging.WARNING
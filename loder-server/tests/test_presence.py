@@ -0,0 +1,69 @@
+"""Presence store: roster caching, invalidate() and eviction."""
+import time
+
+from app import app
+from config import OFFLINE_THRESHOLD_SECONDS
+from presence import PresenceStore, store as presence
+
+
+def test_roster_reloads_after_invalidate():
+    client = app.test_client()
+    user_id = client.post('/api/v1/users/register', json={'deviceId': 'presence-invalidate'}).get_json()['id']
+    room_id = client.post('/api/v1/rooms/create', json={'userId': user_id}).get_json()['roomId']
+    assert presence.is_member(room_id, user_id)
+
+    # invalidate() drops the load time but keeps the cached roster; the next
+    # read used to look the load time up unguarded and raise KeyError
+    presence.invalidate(room_id)
+    assert presence.is_member(room_id, user_id)
+    assert [member.user_id for member in presence.members(room_id)] == [user_id]
+
+
+def create_room(client, device_id):
+    user_id = client.post('/api/v1/users/register', json={'deviceId': device_id}).get_json()['id']
+    room_id = client.post('/api/v1/rooms/create', json={'userId': user_id}).get_json()['roomId']
+    return user_id, room_id
+
+
+def test_missing_room_is_not_cached():
+    store = PresenceStore(flush_interval=0)
+    assert not store.is_member('NOSUCHROOM', 'user-1')
+    assert store.members('NOSUCHROOM') == []
+    assert 'NOSUCHROOM' not in store._rooms
+    assert 'NOSUCHROOM' not in store._loaded_at
+
+
+def test_idle_roster_is_evicted():
+    user_id, room_id = create_room(app.test_client(), 'presence-evict')
+    store = PresenceStore(flush_interval=0, roster_ttl=0)
+    assert store.is_member(room_id, user_id)
+    store.remove_member(room_id, 'someone-else')
+    assert store.evict_idle() == 0   # the creator is still online
+    store.sweep(now=time.time() + OFFLINE_THRESHOLD_SECONDS + 1)
+    assert store.evict_idle() == 1
+    for state in (store._rooms, store._loaded_at, store._versions, store._changes):
+        assert room_id not in state
+    # Reloads on the next read
+    assert store.is_member(room_id, user_id)
+
+
+def test_online_roster_is_kept():
+    user_id, room_id = create_room(app.test_client(), 'presence-evict-online')
+    store = PresenceStore(flush_interval=0, roster_ttl=0)
+    assert store.record(room_id, user_id, 'Xcode', False, int(time.time()))
+    assert store.evict_idle() == 0
+    assert room_id in store._rooms
+
+
+def test_version_after_eviction_is_new():
+    user_id, room_id = create_room(app.test_client(), 'presence-evict-version')
+    store = PresenceStore(flush_interval=0, roster_ttl=0)
+    store.is_member(room_id, user_id)
+    store.remove_member(room_id, 'someone-else')
+    store.sweep(now=time.time() + OFFLINE_THRESHOLD_SECONDS + 1)
+    seen = store.version(room_id)
+    assert store.evict_idle() == 1
+
+    # The client's version must not pass for the reloaded room's
+    assert store.version(room_id) > seen
+    assert store.changes_since(room_id, seen) is None
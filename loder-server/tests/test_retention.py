@@ -0,0 +1,100 @@
+"""Activity archives: written under archive ids, unlinked on account deletion."""
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+import retention
+from app import app
+from config import ACTIVITY_ARCHIVE_DIR
+from database import db_connection, pool, shard_pools
+
+# Far enough back that no other test's activity is archived with it
+LOGGED_AT = int(datetime(2020, 3, 2, tzinfo=timezone.utc).timestamp())
+CUTOFF = LOGGED_AT + 86400
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def register(client, device_id):
+    body = client.post('/api/v1/users/register', json={'deviceId': device_id}).get_json()
+    return body['id'], body['sessionToken']
+
+
+def add_activity(user_id, sessions=3):
+    with db_connection(shard_pools[0]) as conn:
+        conn.executemany('''
+            INSERT INTO activity_logs (room_id, user_id, app_name, duration_seconds, logged_at)
+            VALUES ('ARCHIVE', ?, 'Xcode', 60, ?)
+        ''', [(user_id, LOGGED_AT + i * 60) for i in range(sessions)])
+        conn.commit()
+
+
+def archive():
+    with db_connection(shard_pools[0]) as conn, db_connection(pool) as users_conn:
+        return retention.archive_activity(conn, users_conn, CUTOFF, batch_size=2)
+
+
+def archived_records():
+    with gzip.open(retention.archive_path(LOGGED_AT), 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def archive_contents():
+    contents = ''
+    for name in os.listdir(ACTIVITY_ARCHIVE_DIR):
+        path = os.path.join(ACTIVITY_ARCHIVE_DIR, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            contents += f.read()
+    return contents
+
+
+def test_archive_has_no_user_ids(client):
+    user_id, _ = register(client, 'retention-archive')
+    add_activity(user_id)
+    assert archive() == 3
+
+    records = [r for r in archived_records() if r['room_id'] == 'ARCHIVE']
+    assert records and all('user_id' not in r for r in records)
+    # One archive id per user, across batches
+    assert len({r['archive_user_id'] for r in records}) == 1
+    assert user_id not in archive_contents()
+
+
+def test_deleted_account_is_unlinked_from_archive(client):
+    user_id, token = register(client, 'retention-delete')
+    add_activity(user_id)
+    archive()
+    with db_connection(pool) as conn:
+        archive_id = conn.execute('SELECT archive_id FROM archive_ids WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    response = client.delete(f'/api/v1/users/{user_id}', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+
+    assert user_id not in archive_contents()
+    with db_connection(pool) as conn:
+        assert conn.execute('SELECT 1 FROM archive_ids WHERE archive_id = ?', (archive_id,)).fetchone() is None
+
+
+def test_legacy_archive_is_rewritten(client):
+    user_id, _ = register(client, 'retention-legacy')
+    os.makedirs(ACTIVITY_ARCHIVE_DIR, exist_ok=True)
+    legacy_path = os.path.join(ACTIVITY_ARCHIVE_DIR, 'activity-2019-01.jsonl.gz')
+    with gzip.open(legacy_path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'id': 1, 'room_id': 'LEGACY', 'user_id': user_id, 'app_name': 'Xcode',
+                            'duration_seconds': 60, 'logged_at': 1546300800, 'ended_at': None}) + '\n')
+    marker = os.path.join(ACTIVITY_ARCHIVE_DIR, retention._PSEUDONYMIZED_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    with db_connection(pool) as users_conn:
+        assert retention.pseudonymize_archives(users_conn) >= 1
+        # Once only
+        assert retention.pseudonymize_archives(users_conn) == 0
+    assert user_id not in archive_contents()
@@ -0,0 +1,107 @@
+"""Session tokens: issuing, verifying, expiry and how routes accept them."""
+import time
+
+import pytest
+
+import sessions
+from app import app
+from config import SESSION_TOKEN_TTL
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def register(client, device_id):
+    body = client.post('/api/v1/users/register', json={'deviceId': device_id}).get_json()
+    return body['id'], body['sessionToken']
+
+
+def bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def test_issued_token_verifies():
+    assert sessions.verify(sessions.issue('user-1')) == 'user-1'
+
+
+def test_user_id_with_separator():
+    assert sessions.verify(sessions.issue('a:b:c')) == 'a:b:c'
+
+
+def test_token_expires():
+    issued_at = time.time() - SESSION_TOKEN_TTL - 10
+    token = sessions.issue('user-1', now=issued_at)
+    assert sessions.verify(token, now=issued_at + 1) == 'user-1'
+    assert sessions.verify(token) is None
+
+
+@pytest.mark.parametrize('token', ['', 'garbage', 'a.b.c', None])
+def test_malformed_token_rejected(token):
+    assert sessions.verify(token) is None
+
+
+def test_tampered_token_rejected():
+    payload, signature = sessions.issue('user-1').split('.')
+    other_payload = sessions.issue('user-2').split('.')[0]
+    assert sessions.verify(f'{other_payload}.{signature}') is None
+
+
+def test_bearer_token_parsing():
+    assert sessions.bearer_token('Bearer abc') == 'abc'
+    assert sessions.bearer_token('bearer  abc ') == 'abc'
+    assert sessions.bearer_token('Basic abc') is None
+    assert sessions.bearer_token(None) is None
+
+
+def test_register_issues_token(client):
+    user_id, token = register(client, 'session-register')
+    assert sessions.verify(token) == user_id
+
+
+def test_token_identifies_caller(client):
+    user_id, token = register(client, 'session-caller')
+    response = client.post('/api/v1/rooms/create', json={}, headers=bearer(token))
+    assert response.status_code == 201
+
+
+def test_invalid_token_rejected(client):
+    user_id, _ = register(client, 'session-invalid')
+    response = client.post('/api/v1/rooms/create', json={'userId': user_id}, headers=bearer('forged.token'))
+    assert response.status_code == 401
+
+
+def test_token_for_other_user_is_forbidden(client):
+    user_id, _ = register(client, 'session-owner')
+    _, other_token = register(client, 'session-other')
+    response = client.post('/api/v1/rooms/create', json={'userId': user_id}, headers=bearer(other_token))
+    assert response.status_code == 403
+    assert response.get_json()['error'] == 'Session token does not match userId'
+
+
+def test_query_token_ignored_outside_event_stream(client, monkeypatch):
+    monkeypatch.setattr(sessions, 'REQUIRE_SESSION_TOKEN', True)
+    _, token = register(client, 'session-query')
+    response = client.get(f'/api/v1/rooms/NOROOM/stats?token={token}')
+    assert response.status_code == 401
+    response = client.get('/api/v1/rooms/NOROOM/stats', headers=bearer(token))
+    assert response.status_code != 401
+
+
+def test_query_token_accepted_on_event_stream(client, monkeypatch):
+    monkeypatch.setattr(sessions, 'REQUIRE_SESSION_TOKEN', True)
+    _, token = register(client, 'session-events')
+    room_id = client.post('/api/v1/rooms/create', json={}, headers=bearer(token)).get_json()['roomId']
+    response = client.get(f'/api/v1/rooms/{room_id}/events?token={token}', buffered=False)
+    try:
+        assert response.status_code == 200
+    finally:
+        response.close()
+
+
+def test_token_required_when_configured(client, monkeypatch):
+    user_id, _ = register(client, 'session-required')
+    monkeypatch.setattr(sessions, 'REQUIRE_SESSION_TOKEN', True)
+    response = client.post('/api/v1/rooms/create', json={'userId': user_id})
+    assert response.status_code == 401
@@ -0,0 +1,60 @@
+"""Slow SQL tracing: the admin-only /debug/sql endpoint and the startup check."""
+import logging
+
+import pytest
+
+import sessions
+import sqltrace
+from app import app
+
+ADMIN = {'Authorization': 'Bearer test-admin-token'}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(sessions, 'ADMIN_TOKEN', 'test-admin-token')
+    monkeypatch.setattr(sqltrace.tracer, 'enabled', False)
+    return app.test_client()
+
+
+def test_disabled_without_admin_token(client, monkeypatch):
+    monkeypatch.setattr(sessions, 'ADMIN_TOKEN', '')
+    assert client.get('/debug/sql', headers=ADMIN).status_code == 404
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong'}])
+def test_requires_admin_token(client, headers):
+    assert client.get('/debug/sql', headers=headers).status_code == 401
+    assert client.post('/debug/sql', json={'enabled': True}, headers=headers).status_code == 401
+    assert not sqltrace.tracer.enabled
+
+
+def test_session_token_is_not_admin(client):
+    token = client.post('/api/v1/users/register', json={'deviceId': 'sqltrace-user'}).get_json()['sessionToken']
+    assert client.get('/debug/sql', headers={'Authorization': f'Bearer {token}'}).status_code == 401
+
+
+def test_admin_turns_tracing_on_and_off(client):
+    response = client.post('/debug/sql', json={'enabled': True}, headers=ADMIN)
+    assert response.status_code == 200
+    assert response.get_json()['enabled'] is True
+    assert sqltrace.tracer.enabled
+
+    assert client.post('/debug/sql', json={'enabled': 'yes'}, headers=ADMIN).status_code == 400
+    client.post('/debug/sql', json={'enabled': False}, headers=ADMIN)
+    assert client.get('/debug/sql', headers=ADMIN).get_json()['enabled'] is False
+
+
+def test_warns_when_statements_are_not_timed(monkeypatch, caplog):
+    monkeypatch.setattr(sqltrace, 'METRICS_ENABLED', False)
+    tracer = sqltrace.SqlTracer(enabled=True)
+    with caplog.at_level(logging.WARNING, logger='sqltrace'):
+        tracer.check_timed()
+    assert 'METRICS_ENABLED is off' in caplog.text
+
+
+def test_no_warning_when_timed(monkeypatch, caplog):
+    monkeypatch.setattr(sqltrace, 'METRICS_ENABLED', True)
+    with caplog.at_level(logging.WARNING, logger='sqltrace'):
+        sqltrace.SqlTracer(enabled=True).check_timed()
+    assert caplog.text == ''
@@ -1 +1,2 @@
 from .room_id import generate_room_id
+from .background import PeriodicTask
@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Runs a function every `interval` seconds on a daemon thread.
+
+    The thread is started lazily and restarted after a fork, so it is safe to
+    create at import time under gunicorn. `trigger()` runs the function early.
+    """
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def ensure_started(self):
+        if self.interval <= 0:
+            return
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._wake = threading.Event()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def trigger(self):
+        self.ensure_started()
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _run(self):
+        wake = self._wake
+        while True:
+            wake.wait(self.interval)
+            wake.clear()
+            if self._stopped:
+                return
+            try:
+                self.func()
+            except Exception:
+                logger.exception('Background task %s failed', self.name)